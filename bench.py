@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the drug CLI.
+
+    python bench.py startup [-n RUNS] [--json] [--baseline FILE] [COMMAND ...]
+    python bench.py pipeline [--labels 10,100,1000] [-n RUNS] [-j JOBS] [--latency MS]
+                             [--jitter MS] [--error-rate P] [--seed N] [--json] [--baseline FILE]
+
+startup starts each command the way every pipeline stage does, in a fresh
+interpreter, with --help so it stops once its imports and argument parsing
+are done. --help skips whatever a command imports only while working, so
+the commands in WORK_COMMANDS are also run for real on a small fixture of
+records given on stdin. For each it reports the median wall time over RUNS,
+the import time measured by `python -X importtime`, how many modules were
+loaded, and whether the HTTP (requests) or XML stacks were among them. Save
+a run with --json and pass it to a later run as --baseline to see what
+changed.
+
+pipeline runs `search | ingredients | filter | ndcs | nadac | fmt`, then
+`compare` on a few of nadac's products, and
+dailymed_search.search_and_filter() against upstream_stub.py, a local
+stand-in for DailyMed and NADAC serving a generated corpus of each --labels
+size, with the response cache off and no rate limit. Stages run in this
+process, each given the previous one's output as a shell pipeline would, so
+the times leave out interpreter start-up (which startup measures). For each
+stage it reports the median time over RUNS, the records it wrote and the
+requests it made; a first, untimed run warms up imports and connections.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DRUG = os.path.join(HERE, "drug.py")
+STUB = os.path.join(HERE, "upstream_stub.py")
+
+STARTUP_COMMANDS = ["search", "ingredients", "filter", "ndcs", "nadac", "fmt", "compare",
+                    "run", "db query"]
+
+# Commands that can do real work without the network, timed on FIXTURE
+WORK_COMMANDS = ["fmt", "fmt -f csv", "filter talc", "compare 10000000101 10001000101"]
+FIXTURE = [
+    {"setid": f"fixture-{i}", "title": f"FLUOXETINE (FLUOXETINE HYDROCHLORIDE) CAPSULE [LABELER {i}]",
+     "manufacturer": f"LABELER {i}", "form": "CAPSULE", "strength": f"{10 * (i + 1)} mg",
+     "inactive_ingredients": ["GELATIN", "TALC" if i % 2 else "STARCH, CORN", "TITANIUM DIOXIDE"],
+     "inactive_unii": ["2G86QN327L", "7SEV7J4R1U" if i % 2 else "O8232NY3SJ", "15FIX9V2JP"],
+     "ndcs": [f"1000{i}000101"], "nadac_available": bool(i % 2)}
+    for i in range(4)]
+
+# Modules whose presence marks a command as loading the HTTP or XML stacks
+HEAVY = {"requests": "requests", "xml": "xml.etree.ElementTree"}
+
+
+# ============ STARTUP ============
+
+def parse_importtime(stderr: str):
+    """Return (total import microseconds, module names) from -X importtime output.
+
+    Each line is "import time: self | cumulative | name", with the name
+    indented two more spaces per level of nesting; the total is the sum of
+    the cumulative times of the top-level imports.
+    """
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # the column header
+        name = parts[2].rstrip()
+        modules.append(name.strip())
+        if not name.startswith("  "):
+            total += int(parts[1])
+    return total, modules
+
+
+def _env() -> dict:
+    env = dict(os.environ, XCIPIENT_DAEMON="0")  # time this process, not a server
+    # Installed copies run from cached bytecode; don't time recompiling
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def measure_startup(command: str, runs: int, work: bool = False) -> dict:
+    """Time command with --help or, if work is set, on FIXTURE."""
+    argv = [sys.executable, DRUG, *command.split()]
+    if work:
+        fixture = json.dumps(FIXTURE)
+    else:
+        argv.append("--help")
+        fixture = ""
+    env = _env()
+
+    def run(argv, stderr=subprocess.DEVNULL):
+        return subprocess.run(argv, env=env, input=fixture, stdout=subprocess.DEVNULL, stderr=stderr,
+                              text=True, check=True)
+
+    # The first run writes the bytecode cache
+    run(argv)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(argv)
+        times.append((time.perf_counter() - start) * 1000)
+
+    proc = run([sys.executable, "-X", "importtime", *argv[1:]], stderr=subprocess.PIPE)
+    total, modules = parse_importtime(proc.stderr)
+    result = {
+        "command": f"{command} <fixture" if work else command,
+        "wall_ms": round(statistics.median(times), 1),
+        "import_ms": round(total / 1000, 1),
+        "modules": len(modules),
+    }
+    result.update({key: module in modules for key, module in HEAVY.items()})
+    return result
+
+
+def interpreter_ms(runs: int) -> float:
+    """Median wall time of `python -c pass`, the floor under every command."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], env=_env(), check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 1)
+
+
+def cmd_startup(args):
+    parser = argparse.ArgumentParser(prog="bench.py startup",
+                                     description="Measure per-command cold-start time of drug.py.")
+    parser.add_argument("commands", nargs="*", default=STARTUP_COMMANDS,
+                        help=f"Commands to time (default: {', '.join(STARTUP_COMMANDS)})")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="Runs per command (default: 10)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    opts = parser.parse_args(args)
+
+    floor = interpreter_ms(opts.runs)
+    results = [measure_startup(command, opts.runs) for command in opts.commands]
+    results += [measure_startup(command, opts.runs, work=True) for command in WORK_COMMANDS
+                if command.split()[0] in opts.commands]
+    if opts.json:
+        json.dump({"python": sys.version.split()[0], "interpreter_ms": floor, "commands": results},
+                  sys.stdout, indent=2)
+        print()
+        return
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f:
+            baseline = {r["command"]: r for r in json.load(f)["commands"]}
+
+    print(f"Python {sys.version.split()[0]}, bare interpreter start: {floor:.1f} ms\n")
+    width = max(14, *(len(r["command"]) + 2 for r in results))
+    print(f"{'command':<{width}}{'wall ms':>9}{'imports ms':>12}{'modules':>9}  loads")
+    for r in results:
+        loads = ", ".join(key for key in HEAVY if r[key]) or "-"
+        line = f"{r['command']:<{width}}{r['wall_ms']:>9.1f}{r['import_ms']:>12.1f}{r['modules']:>9}  {loads}"
+        if r["command"] in baseline:
+            line += f"  ({r['wall_ms'] - baseline[r['command']]['wall_ms']:+.1f} ms vs baseline)"
+        print(line)
+
+
+# ============ PIPELINE ============
+
+PIPELINE_SIZES = [10, 100, 1000]
+
+# The README's pipeline; stages that fetch get -j
+EXCIPIENT = "propylene glycol"
+PIPELINE = [["search"], ["ingredients"], ["filter", EXCIPIENT], ["ndcs"], ["nadac"], ["fmt", "-f", "csv"],
+            ["compare"]]
+FETCHING = ("search", "ingredients", "ndcs", "nadac")
+
+# compare is a side branch: like fmt it reads nadac's output, and it
+# compares the first NDC of the first COMPARE_PRODUCTS records there
+BRANCH_FROM = {"compare": "nadac"}
+COMPARE_PRODUCTS = 4
+
+
+def start_stub(labels: int, opts):
+    """Start upstream_stub.py in a child process; returns (process, base URL).
+
+    A separate process keeps the stub's work off the measured interpreter.
+    """
+    proc = subprocess.Popen([sys.executable, STUB, "--labels", str(labels), "--seed", str(opts.seed),
+                             "--latency", str(opts.latency), "--jitter", str(opts.jitter),
+                             "--error-rate", str(opts.error_rate)],
+                            stdout=subprocess.PIPE, text=True)
+    url = proc.stdout.readline().strip()
+    if not url:
+        proc.wait()
+        sys.exit("bench.py: upstream_stub.py did not start")
+    return proc, url
+
+
+def stub_requests(url: str) -> int:
+    with urllib.request.urlopen(f"{url}/stats") as resp:
+        return json.load(resp)["requests"]
+
+
+def _point_at(url: str):
+    """Send the tools' DailyMed and NADAC requests to the stub at url."""
+    import dailymed_search
+    import drug
+    import nadac_index
+    import upstream_stub
+    drug.BASE_URL = dailymed_search.BASE_URL = url + upstream_stub.DAILYMED_PATH
+    nadac_index.NADAC_API = url + upstream_stub.NADAC_PATH
+
+
+def _count(stage: str, out: str) -> int:
+    if stage == "fmt":
+        return max(0, len(out.splitlines()) - 1)  # CSV header
+    if stage == "compare":
+        return len(json.loads(out)["products"])
+    return len(json.loads(out))
+
+
+def _compare_ndcs(data: str) -> list:
+    records = json.loads(data)
+    return [r["ndcs"][0] for r in records if r.get("ndcs")][:COMPARE_PRODUCTS]
+
+
+def measure_pipeline(labels: int, opts) -> dict:
+    """Time each pipeline stage and search_and_filter() against a stub of labels labels."""
+    import dailymed_search
+    import drug
+    import upstream_stub
+    proc, url = start_stub(labels, opts)
+    try:
+        _point_at(url)
+        times = {argv[0]: [] for argv in PIPELINE}
+        stages = []
+        for run in range(opts.runs + 1):  # run 0 warms up: imports, connections
+            data = ""
+            outputs = {}
+            for argv in PIPELINE:
+                stage = argv[0]
+                stdin = outputs[BRANCH_FROM[stage]] if stage in BRANCH_FROM else data
+                argv = argv + ([upstream_stub.SEARCH_TERM] if stage == "search" else []) \
+                    + (["-j", str(opts.jobs)] if stage in FETCHING else []) \
+                    + (_compare_ndcs(stdin) if stage == "compare" else [])
+                before = stub_requests(url)
+                start = time.perf_counter()
+                status, data, err = drug._execute(argv, stdin=stdin)
+                outputs[stage] = data
+                if status:
+                    sys.exit(f"bench.py: drug {stage} failed:\n{err}")
+                if run:
+                    times[stage].append((time.perf_counter() - start) * 1000)
+                else:
+                    stages.append({"stage": stage, "records": _count(stage, data),
+                                   "requests": stub_requests(url) - before})
+        for entry in stages:
+            entry["ms"] = round(statistics.median(times[entry["stage"]]), 1)
+
+        monolithic = []
+        for run in range(opts.runs + 1):
+            before = stub_requests(url)
+            with contextlib.redirect_stdout(io.StringIO()):  # its progress lines
+                start = time.perf_counter()
+                found = dailymed_search.search_and_filter(upstream_stub.SEARCH_TERM, [EXCIPIENT],
+                                                          check_availability=True, verbose=False,
+                                                          jobs=opts.jobs)
+                elapsed = (time.perf_counter() - start) * 1000
+            if run:
+                monolithic.append(elapsed)
+            else:
+                requests = stub_requests(url) - before
+        stages.append({"stage": "search_and_filter", "records": len(found), "requests": requests,
+                       "ms": round(statistics.median(monolithic), 1)})
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return {
+        "labels": labels,
+        "pipeline_ms": round(sum(e["ms"] for e in stages if e["stage"] != "search_and_filter"), 1),
+        "stages": stages,
+    }
+
+
+def cmd_pipeline(args):
+    parser = argparse.ArgumentParser(prog="bench.py pipeline",
+                                     description="Time each pipeline stage against a local DailyMed/NADAC stub.")
+    parser.add_argument("--labels", default=",".join(map(str, PIPELINE_SIZES)),
+                        help="Comma-separated corpus sizes (default: %(default)s)")
+    parser.add_argument("-n", "--runs", type=int, default=3, help="Runs per size (default: 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Concurrent requests per stage (default: 8)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub delay per answer in ms (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Vary the delay by up to this many ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the stub fails with 503")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus and fault seed (default: 0)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    opts = parser.parse_args(args)
+    sizes = [int(n) for n in opts.labels.split(",") if n.strip()]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # No response cache, NADAC index or label store from the user's runs
+        os.environ["XCIPIENT_CACHE_DIR"] = cache_dir
+        import http_client
+        http_client.configure(use_cache=False, rate=0)
+        results = [measure_pipeline(n, opts) for n in sizes]
+
+    if opts.json:
+        json.dump({"python": sys.version.split()[0], "jobs": opts.jobs, "runs": opts.runs,
+                   "stub": {"latency_ms": opts.latency, "jitter_ms": opts.jitter,
+                            "error_rate": opts.error_rate, "seed": opts.seed},
+                   "sizes": results}, sys.stdout, indent=2)
+        print()
+        return
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f:
+            baseline = {(size["labels"], e["stage"]): e for size in json.load(f)["sizes"]
+                        for e in size["stages"]}
+
+    print(f"Python {sys.version.split()[0]}, -j {opts.jobs}, stub latency {opts.latency:g} ms "
+          f"\u00b1{opts.jitter:g}, error rate {opts.error_rate:g}\n")
+    print(f"{'labels':>7}  {'stage':<18}{'ms':>9}{'records':>9}{'requests':>10}")
+    for size in results:
+        for e in size["stages"]:
+            line = f"{size['labels']:>7}  {e['stage']:<18}{e['ms']:>9.1f}{e['records']:>9}{e['requests']:>10}"
+            if (size["labels"], e["stage"]) in baseline:
+                line += f"  ({e['ms'] - baseline[size['labels'], e['stage']]['ms']:+.1f} ms vs baseline)"
+            print(line)
+        print(f"{size['labels']:>7}  {'(pipeline total)':<18}{size['pipeline_ms']:>9.1f}\n")
+
+
+# ============ MAIN ============
+
+COMMANDS = {
+    "startup": cmd_startup,
+    "pipeline": cmd_pipeline,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(__doc__)
+        sys.exit(0 if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help") else 1)
+    COMMANDS[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
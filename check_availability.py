@@ -1,7 +1,7 @@
 """Check NADAC availability for drugs in results.csv"""
 
 import csv
-from dailymed_search import get_dailymed_ndcs, check_ndc_in_nadac, print_status, print_progress
+from dailymed_search import get_dailymed_ndcs, check_ndcs_in_nadac, print_status, print_progress
 
 
 def check_csv_availability(input_file: str, output_file: str = None):
@@ -43,10 +43,11 @@ def check_csv_availability(input_file: str, output_file: str = None):
             unavailable.append(drug)
             continue
 
-        # Check first NDC in NADAC
-        if check_ndc_in_nadac(ndcs[0]):
+        # Check all package NDCs in NADAC
+        found = check_ndcs_in_nadac(ndcs)
+        if found:
             drug["Available"] = "YES"
-            drug["NDC"] = ndcs[0]
+            drug["NDC"] = found[0]
             available.append(drug)
         else:
             drug["Available"] = "NO"
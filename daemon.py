@@ -0,0 +1,144 @@
+"""
+Local API server behind `drug serve`.
+
+A resident server keeps what every cold `drug` invocation pays for again:
+the interpreter and its imports, the pooled HTTP session, parsed SPL labels
+and the NADAC index. It listens on a Unix socket (or a localhost TCP port)
+and speaks JSON over HTTP:
+
+    GET  /health          {"status": "ok", "pid": ..., "uptime": ...}
+    GET  /metrics         request, cache, parse and per-command metrics since start,
+                          as OpenMetrics (or Prometheus text, per the Accept header)
+    POST /cli             {"argv": [...], "stdin": "...", "cwd": "...", "env": {...}}
+                          -> {"status": 0, "stdout": "...", "stderr": "..."}
+    POST /<command>       {"args": [...], "records": [...]}
+                          -> the command's JSON output, or {"error": ..., "status": ...}
+
+The CLI hands whole invocations to /cli through daemon_client;
+/<command> is for other programs. Running the commands is up to the
+execute callable given to serve(). The Unix socket can only be reached by
+the user who started the server; requests over TCP are marked untrusted,
+so that execute can refuse whatever would write files.
+"""
+
+import http.server
+import json
+import os
+import signal
+import socketserver
+import sys
+import time
+
+import daemon_client
+import metrics
+
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "xcipient-drug"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print(f"drug serve: {format % args}", file=sys.stderr)
+
+    def _reply(self, code: int, body, content_type: str = "application/json"):
+        data = (body if isinstance(body, str) else json.dumps(body)).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        try:
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client went away, e.g. on Ctrl-C; nobody is left to answer
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._reply(200, {"status": "ok", "pid": os.getpid(),
+                                     "uptime": round(time.time() - self.server.started, 3)})
+        if self.path == "/metrics":
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            return self._reply(200, metrics.totals().exposition(openmetrics),
+                               OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+        self._reply(404, {"error": f"no such endpoint: GET {self.path}"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            return self._reply(400, {"error": f"bad request body: {e}"})
+
+        name = self.path.strip("/")
+        if name == "cli":
+            argv = request.get("argv") or []
+            if not argv or argv[0] not in self.server.commands:
+                return self._reply(200, {"status": 1, "stdout": "",
+                                         "stderr": f"drug serve: cannot run {argv[:1]}\n"})
+            status, out, err = self.server.execute(argv, stdin=request.get("stdin", ""),
+                                                   cwd=request.get("cwd"), env=request.get("env"),
+                                                   trusted=self.server.trusted)
+            return self._reply(200, {"status": status, "stdout": out, "stderr": err})
+
+        if name not in self.server.commands:
+            return self._reply(404, {"error": f"no such endpoint: POST {self.path}"})
+        records = request.get("records")
+        status, out, err = self.server.execute([name] + list(request.get("args", [])),
+                                               records=[] if records is None else records,
+                                               trusted=self.server.trusted)
+        if status:
+            return self._reply(400 if status == 2 else 500, {"error": err.strip(), "status": status})
+        self._reply(200, out)
+
+
+def serve(address: str, execute, commands, verbose: bool = False):
+    """Answer requests on address until interrupted.
+
+    execute(argv, stdin="", records=None, cwd=None, env=None, trusted=True)
+    runs one command line and returns (exit status, stdout, stderr);
+    records, when given, are the already-parsed input, and trusted is False
+    for requests over TCP. commands lists the command names that may be run.
+    """
+    kind, where = daemon_client.parse_address(address)
+    if kind == "unix":
+        if os.path.exists(where):
+            if daemon_client.health(address) is not None:
+                raise OSError(f"a server is already listening on {where}")
+            os.unlink(where)  # left behind by a server that didn't exit cleanly
+        old_umask = os.umask(0o077)  # only this user may connect
+        try:
+            server = _UnixServer(where, _Handler)
+        finally:
+            os.umask(old_umask)
+    else:
+        server = _TCPServer(where, _Handler)
+
+    server.execute = execute
+    server.trusted = kind == "unix"
+    server.commands = set(commands)
+    server.verbose = verbose
+    server.started = time.time()
+    print(f"drug serve: listening on {address} (pid {os.getpid()})", file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # clean up like Ctrl-C does
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if kind == "unix":
+            try:
+                os.unlink(where)
+            except OSError:
+                pass
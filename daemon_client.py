@@ -0,0 +1,105 @@
+"""
+Client side of `drug serve` (see daemon.py for the API).
+
+The CLI loads this on every command to find out whether a server can answer
+for it, so it speaks HTTP/1.1 over a plain socket instead of importing
+http.client, which pulls in the email and ssl packages.
+"""
+
+import json
+import os
+import socket
+
+# Seconds to wait for the server to accept a connection and answer /health.
+# Once a command has been handed over its answer is waited for however long
+# it takes, so that the command never runs twice.
+CONNECT_TIMEOUT = float(os.environ.get("XCIPIENT_DAEMON_TIMEOUT", 5))
+
+
+class NotSent(OSError):
+    """The request never reached the server, so running it elsewhere is safe."""
+
+
+def parse_address(address: str):
+    """Split an address into ("unix", path) or ("tcp", (host, port)).
+
+    "PORT", ":PORT" and "HOST:PORT" are TCP (host defaults to 127.0.0.1);
+    anything else is a socket path.
+    """
+    host, sep, port = address.rpartition(":")
+    if port.isdigit() and (sep or not host) and "/" not in host:
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "unix", address
+
+
+def request(address: str, method: str, path: str, body=None, timeout: float = None,
+            reply_timeout: float = None):
+    """Send one request to a server; returns (HTTP status, decoded JSON body).
+
+    timeout limits connecting and sending, reply_timeout waiting for the
+    answer (None waits as long as it takes). Raises NotSent if the request
+    couldn't be sent, and OSError if the answer is lost or garbage.
+    """
+    kind, where = parse_address(address)
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    head = (f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n")
+
+    try:
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(where)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(where, timeout)
+    except OSError as e:
+        raise NotSent(f"cannot connect to {address}: {e}") from e
+
+    # The server closes the connection after answering (Connection: close)
+    with sock:
+        try:
+            sock.sendall(head.encode("ascii") + data)
+        except OSError as e:
+            raise NotSent(f"cannot send to {address}: {e}") from e
+        sock.settimeout(reply_timeout)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    header, _sep, payload = b"".join(chunks).partition(b"\r\n\r\n")
+    try:
+        status = int(header.split(b" ", 2)[1])
+        return status, json.loads(payload or b"null")
+    except (IndexError, ValueError) as e:
+        raise OSError(f"bad response from {address}: {e}")
+
+
+def health(address: str, timeout: float = 1.0):
+    """Return the server's /health answer, or None if nothing answers."""
+    try:
+        status, body = request(address, "GET", "/health", timeout=timeout, reply_timeout=timeout)
+    except OSError:
+        return None
+    return body if status == 200 else None
+
+
+def call(address: str, argv: list, stdin: str = "", cwd: str = None, env: dict = None,
+         timeout: float = CONNECT_TIMEOUT):
+    """Run a command line on the server; returns (status, stdout, stderr).
+
+    timeout limits handing the command over; the answer is waited for.
+    Raises NotSent if the server never got the command, and OSError if it
+    got it but no answer came back.
+    """
+    status, body = request(address, "POST", "/cli",
+                           {"argv": argv, "stdin": stdin, "cwd": cwd, "env": env or {}}, timeout)
+    if status != 200 or not isinstance(body, dict):
+        raise OSError(f"server at {address} answered HTTP {status}")
+    return body.get("status", 1), body.get("stdout", ""), body.get("stderr", "")
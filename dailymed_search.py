@@ -10,12 +10,16 @@ DailyMed API Documentation: https://dailymed.nlm.nih.gov/dailymed/app-support-we
 import re
 import requests
 import sys
-import time
 from typing import Optional
 
+import excipients
+import http_client
+import metrics
+import nadac_index
+import spl
+
 
 BASE_URL = "https://dailymed.nlm.nih.gov/dailymed/services/v2"
-NADAC_API_URL = "https://data.medicaid.gov/api/1/datastore/query/99315a95-37ac-4eee-946a-3c523b4c481e/0"
 
 HEADERS = {
     "Accept": "application/json",
@@ -41,60 +45,57 @@ def print_status(current: int, total: int, message: str = "", width: int = 30):
         print()  # Newline when complete
 
 
-def search_drugs(drug_name: str, page_size: int = 100, verbose: bool = True) -> list[dict]:
+def search_drugs(drug_name: str, page_size: int = 100, verbose: bool = True,
+                 jobs: int = 8, engine: str = None) -> list[dict]:
     """
     Search for drugs matching a name pattern.
 
+    Page 1 gives the total page count; the remaining pages are then
+    fetched concurrently and merged in page order.
+
     Args:
         drug_name: Drug name or partial name to search for
         page_size: Number of results per page (max 100)
         verbose: Show progress output
+        jobs: Number of pages to fetch at once
+        engine: Fetch engine for http_client.get_many ("threads" or "async")
 
     Returns:
         List of matching drug records with setid, title, etc.
     """
     url = f"{BASE_URL}/spls.json"
-    params = {
-        "drug_name": drug_name,
-        "pagesize": page_size
-    }
 
-    all_results = []
-    page = 1
-    total_pages = None
-
-    while True:
-        params["page"] = page
-
-        if verbose:
-            if total_pages:
-                print_progress(f"\r  Fetching page {page}/{total_pages}...", end="")
-            else:
-                print_progress(f"\r  Fetching page {page}...", end="")
+    def page_request(page):
+        return url, {"drug_name": drug_name, "pagesize": page_size, "page": page}, HEADERS
 
-        response = requests.get(url, params=params, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-
-        results = data.get("data", [])
-        if not results:
-            break
-
-        all_results.extend(results)
+    if verbose:
+        print_progress("\r  Fetching page 1...", end="")
 
-        # Check if there are more pages
-        metadata = data.get("metadata", {})
-        total_pages = metadata.get("total_pages", 1)
-        total_elements = metadata.get("total_elements", len(all_results))
+    response = http_client.get(*page_request(1))
+    response.raise_for_status()
+    data = response.json()
 
-        if verbose:
-            print_progress(f"\r  Fetching page {page}/{total_pages}... found {len(all_results)}/{total_elements} drugs", end="")
-
-        if page >= total_pages:
-            break
+    metadata = data.get("metadata", {})
+    total_pages = metadata.get("total_pages", 1)
+    all_results = list(data.get("data", []))
+    total_elements = metadata.get("total_elements", len(all_results))
+    if verbose:
+        print_progress(f"\r  Fetching page 1/{total_pages}... found {len(all_results)}/{total_elements} drugs", end="")
+
+    if all_results:
+        fetched = http_client.get_many(range(2, total_pages + 1), page_request,
+                                       concurrency=jobs, engine=engine)
+        for page, response in fetched:
+            if isinstance(response, Exception):
+                raise response
+            response.raise_for_status()
+            results = response.json().get("data", [])
+            if not results:
+                break
+            all_results.extend(results)
 
-        page += 1
-        time.sleep(0.5)  # Rate limiting
+            if verbose:
+                print_progress(f"\r  Fetching page {page}/{total_pages}... found {len(all_results)}/{total_elements} drugs", end="")
 
     if verbose:
         print()  # Newline after progress
@@ -136,6 +137,43 @@ def parse_inactive_ingredients_from_xml(xml_text: str) -> list[dict]:
     return ingredients
 
 
+def _get(url: str, params: dict = None):
+    """Like http_client.get(), but returns request errors instead of raising."""
+    try:
+        return http_client.get(url, params=params, headers=HEADERS)
+    except requests.RequestException as e:
+        return e
+
+
+def _fetch_each(drugs: list[dict], path: str, jobs: int = 1, engine: str = None):
+    """
+    Fetch {BASE_URL}/spls/{setid}{path} for each drug, up to jobs at a time.
+
+    Yields (drug, response) in input order; response is the exception
+    instead if the request failed. The listing's spl_version keys the
+    cached copy, so a newly published label is never answered from cache.
+    """
+    return http_client.get_many(
+        drugs, lambda d: (f"{BASE_URL}/spls/{d.get('setid')}{path}", None, HEADERS,
+                          d.get("spl_version")),
+        concurrency=jobs, engine=engine)
+
+
+def _checked(response):
+    """Raise the error carried by a response (or in its place); else return it."""
+    if isinstance(response, Exception):
+        raise response
+    response.raise_for_status()
+    return response
+
+
+def _inactive_from(response) -> list[dict]:
+    try:
+        return parse_inactive_ingredients_from_xml(_checked(response).text)
+    except requests.RequestException:
+        return []
+
+
 def get_inactive_ingredients(setid: str) -> list[dict]:
     """
     Get only inactive ingredients for a drug (fast, for filtering).
@@ -146,13 +184,7 @@ def get_inactive_ingredients(setid: str) -> list[dict]:
     Returns:
         List of inactive ingredient dicts
     """
-    try:
-        url = f"{BASE_URL}/spls/{setid}.xml"
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-        return parse_inactive_ingredients_from_xml(response.text)
-    except requests.RequestException:
-        return []
+    return _inactive_from(_get(f"{BASE_URL}/spls/{setid}.xml"))
 
 
 def get_packaging_info(setid: str) -> dict:
@@ -165,11 +197,12 @@ def get_packaging_info(setid: str) -> dict:
     Returns:
         Dict with products and active_ingredient
     """
+    return _packaging_from(_get(f"{BASE_URL}/spls/{setid}/packaging.json"))
+
+
+def _packaging_from(response) -> dict:
     try:
-        url = f"{BASE_URL}/spls/{setid}/packaging.json"
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-        pkg_data = response.json().get("data", {})
+        pkg_data = _checked(response).json().get("data", {})
         products = pkg_data.get("products", [])
 
         result = {"products": products}
@@ -192,23 +225,56 @@ def get_drug_details(setid: str, title: str = "") -> Optional[dict]:
     Returns:
         Drug details including inactive ingredients, manufacturer, dosage forms
     """
-    result = {"data": {}}
+    details, _ndcs = _label_from(title, _get(f"{BASE_URL}/spls/{setid}.xml"))
+    return {"data": details}
 
-    # Extract manufacturer from title if provided (saves an API call)
-    if title:
-        match = re.search(r'\[([^\]]+)\]', title)
-        if match:
-            result["data"]["labeler"] = match.group(1)
 
-    # Get packaging info (active ingredients, dosage forms)
-    pkg_info = get_packaging_info(setid)
-    result["data"]["products"] = pkg_info.get("products", [])
-    result["data"]["active_ingredient"] = pkg_info.get("active_ingredient", [])
+def _label_from(title: str, response) -> tuple[dict, list[str]]:
+    """
+    Take everything the pipeline needs from one SPL XML response.
 
-    # Get inactive ingredients from XML
-    result["data"]["inactive_ingredient"] = get_inactive_ingredients(setid)
+    The XML carries each product's form, strength, route, active and
+    inactive ingredients and package NDCs, so packaging.json and ndcs.json
+    are not needed. Returns (details, ndcs); both are empty if the request
+    failed.
+    """
+    # Manufacturer comes from the title (saves an API call)
+    match = re.search(r'\[([^\]]+)\]', title)
+    details = {
+        "products": [],
+        "active_ingredient": [],
+        "inactive_ingredient": [],
+        "labeler": match.group(1) if match else "Unknown",
+    }
+    try:
+        response = _checked(response)
+    except requests.RequestException:
+        return details, []
+
+    products = spl.parse_products(response.content)
+    details["products"] = [{
+        "product_name": p["name"],
+        "dosage_form": p["form"],
+        "strength": p["strength"],
+        "route": p["route"],
+        "active_ingredients": p["active_ingredients"],
+    } for p in products]
+    if products:
+        details["active_ingredient"] = products[0]["active_ingredients"]
+
+    # Inactive ingredients across all products, first spelling of each kept;
+    # labels without structured ingredients fall back to the text patterns
+    names = {}
+    for p in products:
+        for name in p["inactive_ingredients"]:
+            names.setdefault(name.lower(), name)
+    if names:
+        details["inactive_ingredient"] = [{"name": name} for name in names.values()]
+    else:
+        details["inactive_ingredient"] = parse_inactive_ingredients_from_xml(response.text)
 
-    return result if result["data"] else None
+    ndcs = list(dict.fromkeys(n for p in products for n in p["ndcs"]))
+    return details, ndcs
 
 
 def get_ndc_info(setid: str) -> list[dict]:
@@ -225,7 +291,7 @@ def get_ndc_info(setid: str) -> list[dict]:
     params = {"setid": setid}
 
     try:
-        response = requests.get(url, params=params, headers=HEADERS, timeout=30)
+        response = http_client.get(url, params=params, headers=HEADERS)
         response.raise_for_status()
         data = response.json()
         return data.get("data", [])
@@ -247,27 +313,25 @@ def normalize_ndc(ndc: str) -> str:
     If NDC has dashes, we use those to determine segment lengths.
     If no dashes, we assume 5-4-2 and just pad to 11.
     """
-    if "-" in ndc:
-        parts = ndc.split("-")
-        if len(parts) == 3:
-            labeler = parts[0].zfill(5)
-            product = parts[1].zfill(4)
-            package = parts[2].zfill(2)
-            return labeler + product + package
-    # No dashes - just pad to 11 digits
-    return ndc.replace("-", "").zfill(11)
+    return spl.normalize_ndc(ndc)
 
 
 def check_ndc_in_nadac(ndc: str) -> bool:
     """
     Check if a single NDC exists in NADAC.
 
+    Answers from the local index when `drug nadac sync` has been run.
+
     Args:
         ndc: Normalized 11-digit NDC
 
     Returns:
         True if found in NADAC
     """
+    index = nadac_index.shared_index()
+    if index is not None:
+        return index.contains(ndc)
+
     params = {
         "conditions[0][property]": "ndc",
         "conditions[0][value]": ndc,
@@ -275,7 +339,7 @@ def check_ndc_in_nadac(ndc: str) -> bool:
     }
 
     try:
-        response = requests.get(NADAC_API_URL, params=params, timeout=10)
+        response = http_client.get(nadac_index.NADAC_API, params=params)
         response.raise_for_status()
         data = response.json()
         return data.get("count", 0) > 0
@@ -283,28 +347,24 @@ def check_ndc_in_nadac(ndc: str) -> bool:
         return False
 
 
-def check_ndcs_in_nadac(ndcs: list[str]) -> list[str]:
+def check_ndcs_in_nadac(ndcs: list[str], batch_size: int = nadac_index.DEFAULT_BATCH_SIZE) -> list[str]:
     """
     Check which NDCs from a list exist in NADAC.
 
+    Sends up to batch_size NDCs per request using the datastore's "in"
+    operator, or answers from the local index when it exists.
+
     Args:
         ndcs: List of normalized 11-digit NDCs
+        batch_size: NDCs per API request
 
     Returns:
         List of NDCs that exist in NADAC
     """
-    # Query NADAC for all NDCs at once using OR conditions
-    # NADAC API supports multiple conditions
     if not ndcs:
         return []
 
-    # Check each NDC (could batch but API doesn't support OR well)
-    found = []
-    for ndc in ndcs:
-        if check_ndc_in_nadac(ndc):
-            found.append(ndc)
-
-    return found
+    return nadac_index.find_in_nadac(ndcs, batch_size=batch_size)
 
 
 def get_nadac_ndcs(drug_name: str) -> set[str]:
@@ -331,7 +391,7 @@ def get_nadac_ndcs(drug_name: str) -> set[str]:
         }
 
         try:
-            response = requests.get(NADAC_API_URL, params=params, timeout=30)
+            response = http_client.get(nadac_index.NADAC_API, params=params)
             response.raise_for_status()
             data = response.json()
 
@@ -365,12 +425,12 @@ def get_dailymed_ndcs(setid: str) -> list[str]:
     Returns:
         List of NDC codes (normalized to 11 digits)
     """
-    url = f"{BASE_URL}/spls/{setid}/ndcs.json"
+    return _dailymed_ndcs_from(_get(f"{BASE_URL}/spls/{setid}/ndcs.json"))
+
 
+def _dailymed_ndcs_from(response) -> list[str]:
     try:
-        response = requests.get(url, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-        data = response.json().get("data", {})
+        data = _checked(response).json().get("data", {})
         ndcs = data.get("ndcs", [])
         return [normalize_ndc(n.get("ndc", "")) for n in ndcs if n.get("ndc")]
     except requests.RequestException:
@@ -379,18 +439,22 @@ def get_dailymed_ndcs(setid: str) -> list[str]:
 
 def filter_by_availability(
     drugs: list[dict],
-    verbose: bool = False
+    verbose: bool = False,
+    jobs: int = 1,
+    engine: str = None
 ) -> list[dict]:
     """
     Filter drugs to only those with NDCs in NADAC (actively purchased).
 
-    Checks each drug's NDCs directly against NADAC by NDC lookup,
+    Checks all of each drug's NDCs directly against NADAC by NDC lookup,
     not by drug name search. This is more accurate when naming
     conventions differ between DailyMed and NADAC.
 
     Args:
         drugs: List of drug records
         verbose: Print progress information
+        jobs: Number of concurrent requests
+        engine: "threads" or "async" (see http_client.get_many)
 
     Returns:
         Filtered list of drugs with at least one NDC in NADAC
@@ -398,26 +462,20 @@ def filter_by_availability(
     available = []
     unavailable_count = 0
 
-    for i, drug in enumerate(drugs):
-        setid = drug.get("setid")
-        title = drug.get("title", "Unknown")
+    # Every drug's NDCs come from its SPL XML (fetched once, then reused)
+    fetch_details(drugs, verbose, jobs, engine)
+    drug_ndcs = [drug.get("_ndcs", []) for drug in drugs]
 
-        if verbose:
-            short_title = title[:30] + "..." if len(title) > 30 else title
-            print_status(i + 1, len(drugs), f"{short_title}")
-
-        # Get this drug's NDCs from DailyMed
-        drug_ndcs = get_dailymed_ndcs(setid)
-
-        # Check which of these NDCs exist in NADAC
-        if drug_ndcs:
-            # Just check first NDC to see if drug is available (faster)
-            # If first NDC exists, drug is in supply chain
-            if check_ndc_in_nadac(drug_ndcs[0]):
-                drug["_available_ndcs"] = drug_ndcs
-                available.append(drug)
-            else:
-                unavailable_count += 1
+    # Then check all of them against NADAC in batches; a drug is available
+    # if any of its packages is purchased
+    all_ndcs = [n for ndcs in drug_ndcs for n in ndcs]
+    found = set(nadac_index.find_in_nadac(all_ndcs, concurrency=jobs, engine=engine))
+
+    for drug, ndcs in zip(drugs, drug_ndcs):
+        matched = [n for n in ndcs if n in found]
+        if matched:
+            drug["_available_ndcs"] = matched
+            available.append(drug)
         else:
             unavailable_count += 1
 
@@ -430,73 +488,42 @@ def filter_by_availability(
 def filter_by_excipients(
     drugs: list[dict],
     excluded_excipients: list[str],
-    verbose: bool = False
+    verbose: bool = False,
+    jobs: int = 1,
+    engine: str = None
 ) -> list[dict]:
     """
     Filter drugs to exclude those containing specific inactive ingredients.
 
-    Optimized: Only 1 API call per drug for filtering (XML for inactive ingredients).
-    Only fetches packaging info for drugs that pass the filter.
+    Needs only the SPL XML (1 API call per drug), which also supplies the
+    dosage info kept for the drugs that pass.
 
     Args:
         drugs: List of drug records from search
         excluded_excipients: List of excipient names to exclude (case-insensitive)
         verbose: Print progress information
+        jobs: Number of concurrent requests
+        engine: "threads" or "async" (see http_client.get_many)
 
     Returns:
         Filtered list of drugs not containing excluded excipients
     """
-    excluded_lower = [e.lower() for e in excluded_excipients]
+    # One automaton for all excipients; "\n" keeps matches within one name
+    excluded = excipients.PatternSet(e.lower() for e in excluded_excipients)
     passed = []
-    excluded_count = 0
 
-    # Phase 1: Filter by inactive ingredients (1 API call each)
-    for i, drug in enumerate(drugs):
-        setid = drug.get("setid")
-        title = drug.get("title", "Unknown")
-
-        if verbose:
-            short_title = title[:30] + "..." if len(title) > 30 else title
-            print_status(i + 1, len(drugs), f"{short_title} ({len(passed)} kept, {excluded_count} excluded)")
-
-        inactive_ingredients = get_inactive_ingredients(setid)
+    for drug in fetch_details(drugs, verbose, jobs, engine):
+        inactive_ingredients = drug.get("_inactive_ingredients", [])
 
         # Check if any excluded excipient is present
-        has_excluded = False
-        for ingredient in inactive_ingredients:
-            ingredient_name = ingredient.get("name", "").lower()
-            for excluded in excluded_lower:
-                if excluded in ingredient_name:
-                    has_excluded = True
-                    break
-            if has_excluded:
-                break
+        has_excluded = excluded.search(
+            "\n".join(ingredient.get("name", "") for ingredient in inactive_ingredients).lower())
 
-        if has_excluded:
-            excluded_count += 1
-        else:
-            drug["_inactive_ingredients"] = inactive_ingredients
-            # Extract manufacturer from title (no API call needed)
-            match = re.search(r'\[([^\]]+)\]', title)
-            drug["_manufacturer"] = match.group(1) if match else "Unknown"
+        if not has_excluded:
             passed.append(drug)
 
-    # Phase 2: Fetch packaging only for drugs that passed
-    if passed:
-        if verbose:
-            print_progress(f"\n  Fetching dosage info for {len(passed)} drugs...")
-
-        for i, drug in enumerate(passed):
-            if verbose:
-                print_status(i + 1, len(passed), "")
-
-            pkg_info = get_packaging_info(drug.get("setid"))
-            drug["_details"] = {
-                "products": pkg_info.get("products", []),
-                "active_ingredient": pkg_info.get("active_ingredient", []),
-                "inactive_ingredient": drug.get("_inactive_ingredients", []),
-                "labeler": drug.get("_manufacturer", "Unknown"),
-            }
+    if verbose:
+        print_progress(f"\n  {len(drugs) - len(passed)} drugs excluded")
 
     return passed
 
@@ -545,20 +572,94 @@ def extract_drug_info(drug: dict) -> dict:
     }
 
 
+def filter_by_manufacturer(drugs: list[dict], manufacturers: list[str], verbose: bool = False) -> list[dict]:
+    """
+    Keep drugs whose labeler (the bracketed part of the title) contains any
+    of manufacturers, case-insensitively. Needs no API calls.
+    """
+    wanted = [m.lower() for m in manufacturers]
+    kept = []
+    for drug in drugs:
+        match = re.search(r'\[([^\]]+)\]', drug.get("title", ""))
+        labeler = match.group(1).lower() if match else ""
+        if any(m in labeler for m in wanted):
+            kept.append(drug)
+    return kept
+
+
+def fetch_details(drugs: list[dict], verbose: bool = False, jobs: int = 1, engine: str = None) -> list[dict]:
+    """
+    Attach details, inactive ingredients and NDCs from each drug's SPL XML
+    (1 API call each). Drugs that already have them are skipped, so every
+    stage can call this and a label is still only downloaded once.
+    """
+    todo = [drug for drug in drugs if "_details" not in drug]
+    for i, (drug, response) in enumerate(_fetch_each(todo, ".xml", jobs, engine)):
+        title = drug.get("title", "")
+
+        if verbose:
+            short_title = title[:40] + "..." if len(title) > 40 else title
+            print_status(i + 1, len(todo), short_title)
+
+        drug["_details"], drug["_ndcs"] = _label_from(title, response)
+        drug["_inactive_ingredients"] = drug["_details"]["inactive_ingredient"]
+    return drugs
+
+
+def plan_stages(
+    excluded_excipients: list[str],
+    check_availability: bool,
+    manufacturers: list[str] = None
+) -> list[tuple]:
+    """
+    Decide which stages search_and_filter runs, cheapest per drug first.
+
+    Each stage only sees the drugs the earlier ones kept. The title check
+    is free; every other stage works from the SPL XML, which is downloaded
+    once per drug by whichever stage needs it first. After that the
+    excipient check costs nothing more, while the availability check still
+    queries NADAC, so it runs last on the fewest drugs.
+
+    Returns a list of (description, stage) where stage(drugs, verbose,
+    jobs, engine) returns the drugs to keep.
+    """
+    stages = []
+    if manufacturers:
+        stages.append((f"Keeping drugs from: {', '.join(manufacturers)}",
+                       lambda d, v, j, e: filter_by_manufacturer(d, manufacturers, v)))
+    if excluded_excipients:
+        stages.append((f"Filtering out drugs containing: {', '.join(excluded_excipients)}",
+                       lambda d, v, j, e: filter_by_excipients(d, excluded_excipients, v, j, e)))
+    if check_availability:
+        stages.append(("Checking availability in NADAC (by NDC lookup)...", filter_by_availability))
+    if not (excluded_excipients or check_availability):
+        stages.append(("Fetching drug details...", fetch_details))
+    return stages
+
+
 def search_and_filter(
     drug_name: str,
     excluded_excipients: list[str] = None,
     check_availability: bool = False,
-    verbose: bool = True
+    verbose: bool = True,
+    jobs: int = 1,
+    engine: str = None,
+    manufacturers: list[str] = None
 ) -> list[dict]:
     """
     Main function to search for drugs and filter by excipients.
 
+    Filters run in the order chosen by plan_stages(), so drugs dropped by a
+    cheap check are never downloaded by a more expensive one.
+
     Args:
         drug_name: Drug name or pattern to search
         excluded_excipients: List of inactive ingredients to exclude
         check_availability: If True, filter to only drugs found in NADAC
         verbose: Print progress information
+        jobs: Number of concurrent requests
+        engine: "threads" or "async" (see http_client.get_many)
+        manufacturers: If given, only keep drugs from these labelers
 
     Returns:
         List of drug info dictionaries
@@ -567,46 +668,19 @@ def search_and_filter(
         excluded_excipients = []
 
     print_progress(f"Searching DailyMed for drugs matching: '{drug_name}'...")
-    drugs = search_drugs(drug_name, verbose=verbose)
+    drugs = search_drugs(drug_name, verbose=verbose, jobs=jobs, engine=engine)
     print_progress(f"Found {len(drugs)} matching drugs in DailyMed")
 
-    if not drugs:
-        return []
-
-    if excluded_excipients:
-        print_progress(f"\nFiltering out drugs containing: {', '.join(excluded_excipients)}")
-        drugs = filter_by_excipients(drugs, excluded_excipients, verbose)
-        print_progress(f"{len(drugs)} drugs remaining after filtering")
-    else:
-        # Fetch details for all drugs (2 API calls each: XML + packaging)
-        print_progress("\nFetching drug details...")
-        for i, drug in enumerate(drugs):
-            setid = drug.get("setid")
-            title = drug.get("title", "")
-
-            if verbose:
-                short_title = title[:40] + "..." if len(title) > 40 else title
-                print_status(i + 1, len(drugs), short_title)
-
-            details = get_drug_details(setid, title)
-            if details:
-                drug["_details"] = details.get("data", {})
-                drug["_inactive_ingredients"] = details.get("data", {}).get(
-                    "inactive_ingredient", []
-                )
+    for description, stage in plan_stages(excluded_excipients, check_availability, manufacturers):
+        if not drugs:
+            return []
+        print_progress(f"\n{description}")
+        drugs = stage(drugs, verbose, jobs, engine)
+        print_progress(f"{len(drugs)} drugs remaining")
 
     if not drugs:
         return []
 
-    # Filter by NADAC availability (check each drug's NDCs)
-    if check_availability:
-        print_progress(f"\nChecking availability in NADAC (by NDC lookup)...")
-        drugs = filter_by_availability(drugs, verbose)
-        print_progress(f"{len(drugs)} drugs available in NADAC")
-
-        if not drugs:
-            return []
-
     # Extract relevant info
     print_progress("\nProcessing results...")
     results = [extract_drug_info(drug) for drug in drugs]
@@ -718,6 +792,7 @@ Examples:
   %(prog)s ibuprofen --exclude "corn starch" lactose --output results.json
   %(prog)s aspirin --exclude lactose --csv results.csv --quiet
   %(prog)s fluoxetine --exclude "propylene glycol" --available
+  %(prog)s sertraline --manufacturer aurobindo --exclude lactose
         """
     )
 
@@ -734,6 +809,14 @@ Examples:
         help="Inactive ingredients (excipients) to exclude"
     )
 
+    parser.add_argument(
+        "-m", "--manufacturer",
+        nargs="+",
+        default=[],
+        metavar="NAME",
+        help="Only keep drugs from labelers whose name contains NAME"
+    )
+
     parser.add_argument(
         "-o", "--output",
         metavar="FILE",
@@ -764,14 +847,21 @@ Examples:
         help="Only show drugs found in NADAC (actively being purchased by pharmacies)"
     )
 
+    http_client.add_engine_args(parser)
+    http_client.add_http_args(parser)
+
     args = parser.parse_args()
+    http_client.apply_http_args(args)
 
     # Run search
     results = search_and_filter(
         drug_name=args.drug_name,
         excluded_excipients=args.exclude,
         check_availability=args.available,
-        verbose=not args.quiet
+        verbose=not args.quiet,
+        jobs=args.jobs,
+        engine=args.engine,
+        manufacturers=args.manufacturer
     )
 
     # Output results
@@ -787,6 +877,9 @@ Examples:
     if not results:
         print_progress("\nNo drugs found matching your criteria.")
 
+    metrics.collector().wrote(len(results))
+    metrics.emit("dailymed_search")
+
 
 if __name__ == "__main__":
     main()
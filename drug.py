@@ -8,315 +8,779 @@ Usage:
     drug filter <excipient>    Filter out drugs with excipient
     drug ndcs                  Add NDC codes
     drug nadac                 Check NADAC availability
+    drug nadac sync            Download NADAC into a local index
+    drug db import <zip> ...   Import DailyMed SPL release ZIPs into a local store
+    drug db sync               Re-download stored labels whose version changed
+    drug db query <name> -x .. Find stored products without given excipients
     drug fmt                   Format output
     drug compare <ndc> ...     Compare ingredients across products by NDC
+    drug run "<a> | <b> ..."   Run a pipeline of these commands in one process
+    drug serve                 Answer commands from a resident process (used automatically)
 
 Examples:
     drug search fluoxetine | drug ingredients | drug filter "propylene glycol" | drug fmt
     drug search fluoxetine -n 10 | drug ingredients | drug fmt -f csv
     drug search fluoxetine | drug ingredients | drug compare 65862019201 00228202611
+    drug run "search fluoxetine | ingredients | filter talc | fmt"
 """
 
 import io
 import json
+import os
 import re
 import sys
-import xml.etree.ElementTree as ET
-import requests
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 
-# Ensure stdout handles unicode (box-drawing chars on Windows)
-if sys.stdout.encoding and sys.stdout.encoding.lower() not in ("utf-8", "utf8"):
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+# This package's modules, and the heavier parts of the standard library,
+# are imported inside the commands that use them, so that e.g. `drug fmt`
+# never loads requests or the XML parser.
 
 BASE_URL = "https://dailymed.nlm.nih.gov/dailymed/services/v2"
-NADAC_API = "https://data.medicaid.gov/api/1/datastore/query/99315a95-37ac-4eee-946a-3c523b4c481e/0"
 HEADERS = {"Accept": "application/json"}
 
 
+# ============ RECORD I/O ============
+
+def _read_records(stream):
+    """Read drug records from a JSON array or NDJSON (one record per line).
+
+    Returns (records, is_ndjson). NDJSON records come back as a generator
+    that parses one line at a time, so a stage can start working before its
+    upstream has finished. Anything else is parsed as a single JSON document.
+    A lone line holding an object is a document if it has a "type" (e.g.
+    `drug compare | jq -c .`) and a one-record NDJSON stream otherwise.
+    Under `drug run` the upstream stage's records are returned as they are.
+    Records are counted for the stage's metrics as it reads them.
+    """
+    data, ndjson = _parse_records(stream)
+    if isinstance(data, dict):
+        return data, ndjson  # a document, not records
+    return _counted(data, "in"), ndjson
+
+
+def _parse_records(stream):
+    if isinstance(stream, _Handoff):
+        if stream.records is not None:
+            return stream.records, stream.ndjson
+        stream.seek(0)  # the stage printed its output, e.g. compare
+    first = stream.readline()
+    while first and not first.strip():
+        first = stream.readline()
+    if not first:
+        return [], False
+
+    if first.lstrip().startswith("{"):
+        try:
+            record = json.loads(first)
+        except ValueError:
+            record = None  # a pretty-printed object, e.g. compare output
+        if record is not None:
+            second = stream.readline()
+            while second and not second.strip():
+                second = stream.readline()
+            if second:
+                return _iter_ndjson([record, json.loads(second)], stream), True
+            if "type" in record:
+                return record, False
+            return [record], True
+
+    return json.loads(first + stream.read()), False
+
+
+def _iter_ndjson(first, stream):
+    yield from first
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _counted(records, direction):
+    """Count records going into ("in") or out of ("out") the current stage.
+
+    A list is counted at once; anything else is wrapped in a generator that
+    counts each record as it passes, so streaming stays lazy.
+    """
+    import metrics
+    stage = metrics.collector().stage
+    if stage is None:
+        return records
+    if isinstance(records, list):
+        metrics.collector().passed(stage, direction, len(records))
+        return records
+    return _counting(records, stage, direction)
+
+
+def _counting(records, stage, direction):
+    import metrics
+    for record in records:
+        metrics.collector().passed(stage, direction)
+        yield record
+
+
+class _Handoff(io.StringIO):
+    """The pipe between two stages of `drug run`.
+
+    As a stage's stdout it keeps the record iterator given to
+    _write_records instead of serializing it (anything printed is kept as
+    text); as the next stage's stdin it hands the iterator to _read_records.
+    """
+    records = None
+    ndjson = False
+
+
+class _RecordWriter:
+    """Write records one at a time as an indented JSON array or as NDJSON.
+
+    Array output is byte-identical to json.dump(records, indent=2).
+    """
+
+    def __init__(self, stream, ndjson=False):
+        self.stream = stream
+        self.ndjson = ndjson
+        self.count = 0
+
+    def write(self, record):
+        if self.ndjson:
+            self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+        else:
+            self.stream.write("[\n  " if self.count == 0 else ",\n  ")
+            self.stream.write(json.dumps(record, indent=2).replace("\n", "\n  "))
+        self.count += 1
+
+    def close(self):
+        if not self.ndjson:
+            self.stream.write("[]" if self.count == 0 else "\n]")
+        self.stream.flush()
+
+
+def _add_io_args(parser):
+    parser.add_argument("--ndjson", action="store_true",
+                        help="Write one JSON record per line (implied when the input is NDJSON)")
+
+
+def _write_records(records, opts, ndjson_input=False):
+    """Stream records to stdout in the format chosen by --ndjson or the input."""
+    ndjson = opts.ndjson or ndjson_input or os.environ.get("XCIPIENT_NDJSON", "") not in ("", "0")
+    if isinstance(sys.stdout, _Handoff):
+        sys.stdout.records, sys.stdout.ndjson = _counted(records, "out"), ndjson
+        return
+    writer = _RecordWriter(sys.stdout, ndjson)
+    for record in records:
+        writer.write(record)
+    writer.close()
+    _wrote(writer.count)
+
+
+def _wrote(count):
+    """Count records the command wrote to its output."""
+    import metrics
+    metrics.collector().wrote(count)
+    if metrics.collector().stage is not None:
+        metrics.collector().passed(metrics.collector().stage, "out", count)
+
+
+def _add_offline_args(parser):
+    parser.add_argument("--offline", action="store_true",
+                        help="Answer from the local label store built by 'drug db import'")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+
+
+def _progress(i, drugs):
+    """Format a 1-based position, with the total when it is known."""
+    return f"{i+1}/{len(drugs)}" if isinstance(drugs, list) else f"{i+1}"
+
+
 # ============ SEARCH ============
 
-def cmd_search(args):
-    """Search DailyMed for drugs."""
-    import argparse
-    parser = argparse.ArgumentParser(prog="drug search")
-    parser.add_argument("drug_name", help="Drug name to search")
-    parser.add_argument("-n", "--limit", type=int, default=0, help="Limit results")
-    parser.add_argument("-v", "--verbose", action="store_true")
-    opts = parser.parse_args(args)
+SEARCH_PAGE_SIZE = 100
+
+
+def _search_records(opts):
+    """Yield search results in page order.
 
-    results = []
-    page = 1
-    while True:
+    Page 1 says how many pages there are; the rest (only as many as --limit
+    needs) are then fetched concurrently. With --offline the local label
+    store is searched instead.
+    """
+    import http_client
+    import label_store
+    if opts.offline:
+        results = label_store.open_store(opts.db).search(opts.drug_name, opts.limit)
         if opts.verbose:
-            print(f"Fetching page {page}...", file=sys.stderr)
+            print(f"Found {len(results)} drugs", file=sys.stderr)
+        yield from results
+        return
 
-        resp = requests.get(f"{BASE_URL}/spls.json",
-                          params={"drug_name": opts.drug_name, "page": page, "pagesize": 100},
-                          headers=HEADERS, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+    def page_request(page):
+        if opts.verbose:
+            print(f"Fetching page {page}...", file=sys.stderr)
+        return (f"{BASE_URL}/spls.json",
+                {"drug_name": opts.drug_name, "page": page, "pagesize": SEARCH_PAGE_SIZE}, HEADERS)
+
+    resp = http_client.get(*page_request(1))
+    resp.raise_for_status()
+    data = resp.json()
+
+    last_page = data.get("metadata", {}).get("total_pages", 1)
+    if opts.limit:
+        last_page = min(last_page, -(-opts.limit // SEARCH_PAGE_SIZE))
+
+    def pages():
+        yield data
+        fetched = http_client.get_many(range(2, last_page + 1), page_request, concurrency=opts.jobs,
+                                       per_host=opts.per_host, engine=opts.engine)
+        for _page, resp in fetched:
+            if isinstance(resp, Exception):
+                raise resp
+            resp.raise_for_status()
+            yield resp.json()
 
-        for drug in data.get("data", []):
+    count = 0
+    for page_data in pages():
+        for drug in page_data.get("data", []):
             title = drug.get("title", "")
             match = re.search(r'\[([^\]]+)\]', title)
-            results.append({
+            yield {
                 "setid": drug.get("setid"),
                 "title": title,
-                "manufacturer": match.group(1) if match else "Unknown"
-            })
-            if opts.limit and len(results) >= opts.limit:
+                "manufacturer": match.group(1) if match else "Unknown",
+                "spl_version": drug.get("spl_version"),
+            }
+            count += 1
+            if opts.limit and count >= opts.limit:
                 break
-
-        if opts.limit and len(results) >= opts.limit:
-            break
-        if page >= data.get("metadata", {}).get("total_pages", 1):
+        if opts.limit and count >= opts.limit:
             break
-        page += 1
 
     if opts.verbose:
-        print(f"Found {len(results)} drugs", file=sys.stderr)
+        print(f"Found {count} drugs", file=sys.stderr)
 
-    json.dump(results, sys.stdout, indent=2)
-
-
-# ============ INGREDIENTS ============
-
-# SPL XML namespace
-NS = {"v3": "urn:hl7-org:v3"}
 
+def cmd_search(args):
+    """Search DailyMed for drugs."""
+    import argparse
+    import http_client
+    parser = argparse.ArgumentParser(prog="drug search")
+    parser.add_argument("drug_name", help="Drug name to search")
+    parser.add_argument("-n", "--limit", type=int, default=0, help="Limit results")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    _add_offline_args(parser)
+    http_client.add_engine_args(parser, default_jobs=8)
+    _add_io_args(parser)
+    http_client.add_http_args(parser)
+    opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
 
-def _normalize_ndc(ndc):
-    """Normalize an NDC to 11-digit format."""
-    if "-" in ndc:
-        p = ndc.split("-")
-        if len(p) == 3:
-            return p[0].zfill(5) + p[1].zfill(4) + p[2].zfill(2)
-    return ndc.replace("-", "").zfill(11)
+    _write_records(_search_records(opts), opts)
 
 
-def _parse_products(xml_text):
-    """Parse per-product data from SPL XML subject blocks.
+# ============ INGREDIENTS ============
 
-    Returns a list of dicts with keys: form, strength, inactive_ingredients, ndcs.
-    Returns empty list if parsing fails (caller should fall back).
+# Parsed products by SPL body digest, kept only by `drug serve` so that
+# repeated queries skip the XML parse (None otherwise)
+_parsed_labels = None
+PARSED_LABELS_MAX = 4096
+
+
+def _parse_label(content):
+    """spl.parse_products(), answered from _parsed_labels when that is kept."""
+    import hashlib
+    import spl
+    if _parsed_labels is None:
+        return spl.parse_products(content)
+    key = hashlib.sha1(content).digest()
+    if key not in _parsed_labels:
+        _parsed_labels[key] = spl.parse_products(content)
+        if len(_parsed_labels) > PARSED_LABELS_MAX:
+            _parsed_labels.popitem(last=False)
+    _parsed_labels.move_to_end(key)
+    return _parsed_labels[key]
+
+
+def _products_from_response(resp):
+    """Parse products from an SPL XML response (or the error fetching it).
+
+    Returns (products, xml_text); both are empty if the fetch failed.
+    xml_text is only decoded when no products were found, since that is
+    the only case where the caller's regex fallback needs it.
     """
+    if resp is None or isinstance(resp, Exception):
+        return [], ""
     try:
-        root = ET.fromstring(xml_text)
-    except ET.ParseError:
-        return []
-
-    products = []
-    # Each <subject> contains one manufacturedProduct (one strength)
-    for subj in root.iter(f"{{{NS['v3']}}}subject"):
-        prod = subj.find(f".//{{{NS['v3']}}}manufacturedProduct")
-        if prod is None:
-            continue
-
-        # Form: <formCode displayName="CAPSULE" .../>
-        form_el = prod.find(f".//{{{NS['v3']}}}formCode")
-        form = form_el.get("displayName", "") if form_el is not None else ""
-
-        # Strength: first <numerator> with a real unit (not "1")
-        strength = ""
-        for num in prod.iter(f"{{{NS['v3']}}}numerator"):
-            unit = num.get("unit", "")
-            val = num.get("value", "")
-            if unit and unit != "1" and val:
-                strength = f"{val} {unit}"
-                break
-
-        # Inactive ingredients: <ingredient classCode="IACT"> -> <name>
+        resp.raise_for_status()
+    except Exception:
+        return [], ""
+    try:
+        products = _parse_label(resp.content)
+    except Exception:
+        products = []
+    return products, "" if products else resp.text
+
+
+def _explode_products(drug, products, xml_text):
+    """Turn one drug plus its parsed products into per-product records."""
+    if products:
+        return [{
+            "setid": drug["setid"],
+            "title": drug.get("title", ""),
+            "manufacturer": drug.get("manufacturer", ""),
+            "product_index": idx,
+            "form": prod["form"],
+            "strength": prod["strength"],
+            "inactive_ingredients": prod["inactive_ingredients"],
+            "ndcs": prod["ndcs"],
+            "inactive_unii": prod.get("inactive_unii", []),
+        } for idx, prod in enumerate(products)]
+
+    # Fallback: flat parse like before
+    try:
+        pattern = r'<ingredient[^>]*classCode="IACT"[^>]*>.*?<name>([^<]+)</name>'
+        matches = re.findall(pattern, xml_text, re.DOTALL | re.IGNORECASE)
+        ingredients = list(set(m.strip() for m in matches))
+    except Exception:
         ingredients = []
-        seen = set()
-        for ing in prod.iter(f"{{{NS['v3']}}}ingredient"):
-            if ing.get("classCode") != "IACT":
-                continue
-            name_el = ing.find(f".//{{{NS['v3']}}}name")
-            if name_el is not None and name_el.text:
-                name = name_el.text.strip()
-                if name.lower() not in seen:
-                    seen.add(name.lower())
-                    ingredients.append(name)
-
-        # NDCs: <code codeSystem="2.16.840.1.113883.6.69" code="..."/>
-        # Only keep 3-segment NDCs (with two dashes)
-        ndcs = []
-        ndc_seen = set()
-        for code_el in subj.iter(f"{{{NS['v3']}}}code"):
-            if code_el.get("codeSystem") == "2.16.840.1.113883.6.69":
-                raw = code_el.get("code", "")
-                if raw.count("-") == 2 and raw not in ndc_seen:
-                    ndc_seen.add(raw)
-                    ndcs.append(_normalize_ndc(raw))
-
-        products.append({
-            "form": form,
-            "strength": strength,
-            "inactive_ingredients": ingredients,
-            "ndcs": ndcs,
-        })
+    record = dict(drug)
+    record["product_index"] = 0
+    record["form"] = ""
+    record["strength"] = ""
+    record["inactive_ingredients"] = ingredients
+    record["ndcs"] = []
+    return [record]
+
+
+def _ingredients_records(opts, drugs):
+    """Yield per-product records for each input drug."""
+    import http_client
+    import label_store
+    counts = {"drugs": 0, "products": 0}
+
+    if opts.offline:
+        store = label_store.open_store(opts.db)
+        for drug in drugs:
+            counts["drugs"] += 1
+            for record in _explode_products(drug, store.products(drug["setid"]), ""):
+                counts["products"] += 1
+                yield record
+        if opts.verbose:
+            print(f"Exploded {counts['drugs']} drugs into {counts['products']} products", file=sys.stderr)
+        return
 
-    return products
+    def spl_request(item):
+        i, drug = item
+        if opts.verbose:
+            print(f"[{_progress(i, drugs)}] Fetching ingredients for {drug.get('title', '')[:40]}...",
+                  file=sys.stderr)
+        return f"{BASE_URL}/spls/{drug['setid']}.xml", None, HEADERS, drug.get("spl_version")
+
+    # Results arrive in input order, so output order never depends on
+    # which fetch finishes first.
+    fetched = http_client.get_many(enumerate(drugs), spl_request, concurrency=opts.jobs,
+                                   per_host=opts.per_host, engine=opts.engine)
+    for (_i, drug), resp in fetched:
+        products, xml_text = _products_from_response(resp)
+        counts["drugs"] += 1
+        for record in _explode_products(drug, products, xml_text):
+            counts["products"] += 1
+            yield record
+
+    if opts.verbose:
+        print(f"Exploded {counts['drugs']} drugs into {counts['products']} products", file=sys.stderr)
 
 
 def cmd_ingredients(args):
     """Add inactive ingredients to drugs, exploded per product."""
     import argparse
+    import http_client
     parser = argparse.ArgumentParser(prog="drug ingredients")
     parser.add_argument("-v", "--verbose", action="store_true")
+    _add_offline_args(parser)
+    http_client.add_engine_args(parser)
+    _add_io_args(parser)
+    http_client.add_http_args(parser)
     opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
 
-    drugs = json.load(sys.stdin)
-    output = []
+    drugs, ndjson = _read_records(sys.stdin)
+    _write_records(_ingredients_records(opts, drugs), opts, ndjson)
 
-    for i, drug in enumerate(drugs):
-        if opts.verbose:
-            print(f"[{i+1}/{len(drugs)}] Fetching ingredients for {drug.get('title', '')[:40]}...",
-                  file=sys.stderr)
 
-        try:
-            resp = requests.get(f"{BASE_URL}/spls/{drug['setid']}.xml", headers=HEADERS, timeout=30)
-            resp.raise_for_status()
-            products = _parse_products(resp.text)
-        except Exception:
-            products = []
-
-        if products:
-            for idx, prod in enumerate(products):
-                record = {
-                    "setid": drug["setid"],
-                    "title": drug.get("title", ""),
-                    "manufacturer": drug.get("manufacturer", ""),
-                    "product_index": idx,
-                    "form": prod["form"],
-                    "strength": prod["strength"],
-                    "inactive_ingredients": prod["inactive_ingredients"],
-                    "ndcs": prod["ndcs"],
-                }
-                output.append(record)
-        else:
-            # Fallback: flat parse like before
-            try:
-                pattern = r'<ingredient[^>]*classCode="IACT"[^>]*>.*?<name>([^<]+)</name>'
-                matches = re.findall(pattern, resp.text, re.DOTALL | re.IGNORECASE)
-                ingredients = list(set(m.strip() for m in matches))
-            except Exception:
-                ingredients = []
-            record = dict(drug)
-            record["product_index"] = 0
-            record["form"] = ""
-            record["strength"] = ""
-            record["inactive_ingredients"] = ingredients
-            record["ndcs"] = []
-            output.append(record)
+# ============ FILTER ============
 
-    if opts.verbose:
-        print(f"Exploded {len(drugs)} drugs into {len(output)} products", file=sys.stderr)
+def _filter_records(opts, drugs):
+    """Yield the drugs that pass the excipient filter.
 
-    json.dump(output, sys.stdout, indent=2)
+    Each excipient is resolved once to the UNIIs of all its known names, so
+    synonyms match ("sunset yellow" finds FD&C YELLOW NO. 6). With
+    --offline, products in the label store are looked up in the set of
+    products that contain an excipient, built once from the ingredient index.
+    """
+    import excipients
+    import label_store
+    store = label_store.open_store(opts.db) if opts.offline else label_store.LabelStore.open_existing(opts.db)
+    matcher = excipients.Matcher(opts.excipient, None if opts.names_only else excipients.Resolver(store))
+    matched = store.with_excipients(opts.excipient) if opts.offline and not opts.names_only else None
+    stored = {}
+    total = kept = 0
+    for drug in drugs:
+        total += 1
+        key = (drug.get("setid"), drug.get("product_index"))
+        if matched is not None and key[1] is not None and key[0] not in stored:
+            stored[key[0]] = store.version(key[0]) is not None
+        if matched is not None and key[1] is not None and stored[key[0]]:
+            has_excipient = key in matched
+        else:
+            has_excipient = matcher.matches(drug)
 
+        if has_excipient == opts.keep:
+            kept += 1
+            yield drug
+
+    if opts.verbose:
+        print(f"Kept {kept}/{total}", file=sys.stderr)
 
-# ============ FILTER ============
 
 def cmd_filter(args):
     """Filter out drugs containing excipient."""
     import argparse
+    import excipients
+    import metrics
     parser = argparse.ArgumentParser(prog="drug filter")
-    parser.add_argument("excipient", nargs="+", help="Excipients to exclude")
+    parser.add_argument("excipient", nargs="*", help="Excipients to exclude")
+    parser.add_argument("-f", "--from-file", action="append", default=[], metavar="FILE",
+                        help="Read more excipients from FILE, one per line (# starts a comment)")
     parser.add_argument("--keep", action="store_true", help="Invert: keep matches")
+    parser.add_argument("--names-only", action="store_true",
+                        help="Match ingredient names by substring only, without UNII synonyms")
     parser.add_argument("-v", "--verbose", action="store_true")
+    _add_offline_args(parser)
+    _add_io_args(parser)
+    metrics.add_metrics_args(parser)
     opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
 
-    drugs = json.load(sys.stdin)
-    results = []
+    for path in opts.from_file:
+        try:
+            opts.excipient += excipients.read_list(path)
+        except OSError as e:
+            parser.error(f"cannot read {path}: {e}")
+    if not opts.excipient:
+        parser.error("give at least one excipient or --from-file")
 
-    for drug in drugs:
-        ingredients = " ".join(drug.get("inactive_ingredients", [])).lower()
-        has_excipient = any(e.lower() in ingredients for e in opts.excipient)
+    drugs, ndjson = _read_records(sys.stdin)
+    _write_records(_filter_records(opts, drugs), opts, ndjson)
 
-        if opts.keep:
-            if has_excipient:
-                results.append(drug)
-        else:
-            if not has_excipient:
-                results.append(drug)
 
-    if opts.verbose:
-        print(f"Kept {len(results)}/{len(drugs)}", file=sys.stderr)
+# ============ NDCS ============
+
+def _ndcs_records(opts, drugs):
+    """Yield drugs with their NDC lists filled in."""
+    import http_client
+    import label_store
+    import spl
+    if opts.offline:
+        store = label_store.open_store(opts.db)
+        for drug in drugs:
+            if not drug.get("ndcs"):
+                drug["ndcs"] = store.ndcs(drug["setid"])
+            yield drug
+        return
 
-    json.dump(results, sys.stdout, indent=2)
+    def ndcs_request(item):
+        i, drug = item
+        # Skip if NDCs already populated (e.g. by ingredients step)
+        if drug.get("ndcs"):
+            if opts.verbose:
+                print(f"[{_progress(i, drugs)}] NDCs already present, skipping", file=sys.stderr)
+            return None
+        if opts.verbose:
+            print(f"[{_progress(i, drugs)}] Fetching NDCs...", file=sys.stderr)
+        return f"{BASE_URL}/spls/{drug['setid']}/ndcs.json", None, HEADERS
 
+    fetched = http_client.get_many(enumerate(drugs), ndcs_request, concurrency=opts.jobs,
+                                   per_host=opts.per_host, engine=opts.engine)
+    for (_i, drug), resp in fetched:
+        if resp is not None:
+            try:
+                ndcs = resp.json().get("data", {}).get("ndcs", [])
+                drug["ndcs"] = [spl.normalize_ndc(n["ndc"]) for n in ndcs if n.get("ndc")]
+            except Exception:
+                drug["ndcs"] = []
+        yield drug
 
-# ============ NDCS ============
 
 def cmd_ndcs(args):
     """Add NDC codes to drugs."""
     import argparse
+    import http_client
     parser = argparse.ArgumentParser(prog="drug ndcs")
     parser.add_argument("-v", "--verbose", action="store_true")
+    _add_offline_args(parser)
+    http_client.add_engine_args(parser)
+    _add_io_args(parser)
+    http_client.add_http_args(parser)
     opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
 
-    drugs = json.load(sys.stdin)
+    drugs, ndjson = _read_records(sys.stdin)
+    _write_records(_ndcs_records(opts, drugs), opts, ndjson)
 
-    for i, drug in enumerate(drugs):
-        # Skip if NDCs already populated (e.g. by ingredients step)
-        if drug.get("ndcs"):
-            if opts.verbose:
-                print(f"[{i+1}/{len(drugs)}] NDCs already present, skipping", file=sys.stderr)
-            continue
 
-        if opts.verbose:
-            print(f"[{i+1}/{len(drugs)}] Fetching NDCs...", file=sys.stderr)
-        try:
-            resp = requests.get(f"{BASE_URL}/spls/{drug['setid']}/ndcs.json", headers=HEADERS, timeout=30)
-            ndcs = resp.json().get("data", {}).get("ndcs", [])
-            drug["ndcs"] = [_normalize_ndc(n["ndc"]) for n in ndcs if n.get("ndc")]
-        except Exception:
-            drug["ndcs"] = []
+# ============ NADAC ============
 
-    json.dump(drugs, sys.stdout, indent=2)
+def cmd_nadac_sync(args):
+    """Download the NADAC dataset into the local index."""
+    import argparse
+    import http_client
+    import nadac_index
+    parser = argparse.ArgumentParser(prog="drug nadac sync")
+    parser.add_argument("--full", action="store_true", help="Re-download everything instead of new rows only")
+    parser.add_argument("--page-size", type=int, default=nadac_index.DEFAULT_PAGE_SIZE,
+                        help="Rows per request")
+    parser.add_argument("--db", help="Index file (default: in the cache directory)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    http_client.add_http_args(parser)
+    opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
 
+    index = nadac_index.NadacIndex(opts.db)
+    try:
+        count = index.sync(page_size=opts.page_size, full=opts.full, verbose=opts.verbose)
+    except Exception as e:
+        print(f"Error: NADAC sync failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Read {count} rows; index has {len(index)} NDCs "
+          f"(effective through {index.get_meta('last_effective_date')})", file=sys.stderr)
+
+
+def _nadac_records(opts, drugs):
+    """Yield drugs annotated with NADAC availability.
+
+    Drugs are buffered only until their NDCs fill one batch per worker, so
+    streamed input keeps flowing while still sending many NDCs per request.
+    """
+    import nadac_index
+    stats = {"total": 0, "available": 0}
+    window = []
+    window_ndcs = {}
+
+    def flush():
+        if opts.verbose:
+            print(f"Checking {len(window_ndcs)} NDCs from {len(window)} drugs in NADAC...", file=sys.stderr)
+        found = set(nadac_index.find_in_nadac(list(window_ndcs), batch_size=opts.batch_size,
+                                              use_index=not opts.online, concurrency=opts.jobs,
+                                              engine=opts.engine))
+        for drug in window:
+            drug["nadac_ndcs"] = [n for n in drug.get("ndcs", []) if n in found]
+            drug["nadac_available"] = bool(drug["nadac_ndcs"])
+            stats["total"] += 1
+            stats["available"] += drug["nadac_available"]
+            if not opts.filter or drug["nadac_available"]:
+                yield drug
+        window.clear()
+        window_ndcs.clear()
+
+    # Every package NDC of every product is checked, so a product counts as
+    # available when any of its packages is purchased, not just the first.
+    for drug in drugs:
+        window.append(drug)
+        window_ndcs.update(dict.fromkeys(drug.get("ndcs", [])))
+        if len(window_ndcs) >= opts.batch_size * max(opts.jobs, 1):
+            yield from flush()
+    if window:
+        yield from flush()
+
+    if opts.verbose:
+        print(f"Available: {stats['available']}/{stats['total']}", file=sys.stderr)
 
-# ============ NADAC ============
 
 def cmd_nadac(args):
     """Check NADAC availability."""
     import argparse
-    parser = argparse.ArgumentParser(prog="drug nadac")
+    import http_client
+    import nadac_index
+    if args and args[0] == "sync":
+        return cmd_nadac_sync(args[1:])
+
+    parser = argparse.ArgumentParser(prog="drug nadac",
+                                     epilog="Run 'drug nadac sync' first to answer from a local index.")
     parser.add_argument("--filter", action="store_true", help="Only output available drugs")
+    parser.add_argument("--online", action="store_true", help="Query the NADAC API even if a local index exists")
+    parser.add_argument("--batch-size", type=int, default=nadac_index.DEFAULT_BATCH_SIZE,
+                        help="NDCs per NADAC API request")
     parser.add_argument("-v", "--verbose", action="store_true")
+    http_client.add_engine_args(parser)
+    _add_io_args(parser)
+    http_client.add_http_args(parser)
     opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
 
-    def check_ndc(ndc):
-        try:
-            resp = requests.get(NADAC_API, params={
-                "conditions[0][property]": "ndc",
-                "conditions[0][value]": ndc,
-                "limit": 1
-            }, timeout=10)
-            return resp.json().get("count", 0) > 0
-        except:
-            return False
-
-    drugs = json.load(sys.stdin)
-    results = []
-
-    for i, drug in enumerate(drugs):
+    index = None if opts.online else nadac_index.shared_index()
+    if index is not None and index.is_stale():
+        print("Warning: local NADAC index is more than "
+              f"{nadac_index.STALE_AFTER_DAYS} days old; run 'drug nadac sync'", file=sys.stderr)
+
+    drugs, ndjson = _read_records(sys.stdin)
+    _write_records(_nadac_records(opts, drugs), opts, ndjson)
+
+
+# ============ LABEL STORE ============
+
+def cmd_db_import(args):
+    """Import DailyMed SPL release ZIPs into the local label store."""
+    import argparse
+    import excipients
+    import label_store
+    import metrics
+    import spl
+    parser = argparse.ArgumentParser(prog="drug db import")
+    parser.add_argument("archives", nargs="+", help="SPL release ZIP files (nested ZIPs are read too)")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-import labels even if the same version is already stored")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help=f"Parse labels in N processes (default: 1; this machine has {os.cpu_count()} CPUs)")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    metrics.add_metrics_args(parser)
+    opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
+
+    store = label_store.LabelStore(opts.db)
+    store.add_unii_names(excipients.builtin_pairs())
+    for path in opts.archives:
         if opts.verbose:
-            print(f"[{i+1}/{len(drugs)}] Checking NADAC...", file=sys.stderr)
+            print(f"Importing {path}...", file=sys.stderr)
+        try:
+            counts = store.import_archive(path, spl.parse_products, force=opts.force, workers=opts.workers,
+                                          verbose=opts.verbose)
+        except OSError as e:
+            print(f"Error: cannot read {path}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{path}: read {counts['read']} labels, imported {counts['imported']}, "
+              f"skipped {counts['skipped']}", file=sys.stderr)
 
-        ndcs = drug.get("ndcs", [])
-        drug["nadac_available"] = bool(ndcs) and check_ndc(ndcs[0])
+    print(f"Store has {len(store)} labels, {store.product_count()} products", file=sys.stderr)
 
-        if not opts.filter or drug["nadac_available"]:
-            results.append(drug)
 
+def cmd_db_sync(args):
+    """Re-download stored (or piped-in) labels whose DailyMed version changed."""
+    import argparse
+    import http_client
+    import label_store
+    import spl
+    parser = argparse.ArgumentParser(prog="drug db sync")
+    parser.add_argument("-i", "--stdin", action="store_true",
+                        help="Sync the setids of the drug records on stdin instead of the whole store")
+    parser.add_argument("--since", help="Look for labels published on or after YYYY-MM-DD "
+                                        "(default: the last sync)")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    http_client.add_engine_args(parser, default_jobs=4)
+    http_client.add_http_args(parser)
+    opts = parser.parse_args(args)
+    http_client.apply_http_args(opts)
+
+    setids = None
+    if opts.stdin:
+        drugs, _ndjson = _read_records(sys.stdin)
+        setids = [d["setid"] for d in drugs if d.get("setid")]
+
+    store = label_store.LabelStore(opts.db)
+    try:
+        counts = store.sync(BASE_URL, spl.parse_products, setids=setids, since=opts.since,
+                            concurrency=opts.jobs, engine=opts.engine, verbose=opts.verbose)
+    except Exception as e:
+        print(f"Error: label sync failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Checked {counts['checked']} labels, {counts['changed']} changed, "
+          f"{counts['updated']} updated", file=sys.stderr)
+
+
+def cmd_db_query(args):
+    """Find products in the label store by name and excipients."""
+    import argparse
+    import label_store
+    import metrics
+    parser = argparse.ArgumentParser(prog="drug db query",
+                                     epilog='Example: drug db query fluoxetine -x "propylene glycol" -x lactose')
+    parser.add_argument("name", nargs="?", default="", help="Product or generic name (default: all products)")
+    parser.add_argument("-x", "--exclude", action="append", default=[], metavar="EXCIPIENT",
+                        help="Drop products containing this excipient (repeatable)")
+    parser.add_argument("-i", "--include", action="append", default=[], metavar="EXCIPIENT",
+                        help="Keep only products containing this excipient (repeatable)")
+    parser.add_argument("-n", "--limit", type=int, default=0, help="Limit results")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    _add_io_args(parser)
+    metrics.add_metrics_args(parser)
+    opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
+
+    records = label_store.open_store(opts.db).query(opts.name, opts.exclude, opts.include, opts.limit)
     if opts.verbose:
-        avail = sum(1 for d in results if d.get("nadac_available"))
-        print(f"Available: {avail}/{len(drugs)}", file=sys.stderr)
+        print(f"Found {len(records)} products", file=sys.stderr)
+    _write_records(records, opts)
+
+
+def cmd_db_unii(args):
+    """Load FDA's UNII names list into the label store's synonym table."""
+    import argparse
+    import excipients
+    import label_store
+    import metrics
+    parser = argparse.ArgumentParser(prog="drug db unii",
+                                     epilog="Download UNII_Names from https://precision.fda.gov/uniisearch/archive")
+    parser.add_argument("file", help="Tab-separated UNII names file with Name and UNII columns")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    metrics.add_metrics_args(parser)
+    opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
+
+    store = label_store.LabelStore(opts.db)
+    try:
+        count = excipients.load_unii_names(store, opts.file, opts.verbose)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    store.add_unii_names(excipients.builtin_pairs())
+    store.db.commit()
+    print(f"Loaded {count} names", file=sys.stderr)
 
-    json.dump(results, sys.stdout, indent=2)
+
+def cmd_db_info(args):
+    """Print the size of the local label store."""
+    import argparse
+    import label_store
+    import metrics
+    parser = argparse.ArgumentParser(prog="drug db info")
+    parser.add_argument("--db", help="Label store file (default: in the cache directory)")
+    metrics.add_metrics_args(parser)
+    opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
+
+    store = label_store.open_store(opts.db)
+    print(f"{store.path}: {len(store)} labels, {store.product_count()} products")
+
+
+DB_COMMANDS = {
+    "import": cmd_db_import,
+    "sync": cmd_db_sync,
+    "query": cmd_db_query,
+    "unii": cmd_db_unii,
+    "info": cmd_db_info,
+}
+
+
+def cmd_db(args):
+    """Manage the local SPL label store."""
+    if not args or args[0] not in DB_COMMANDS:
+        print(f"Usage: drug db {{{'|'.join(DB_COMMANDS)}}} ...", file=sys.stderr)
+        sys.exit(1)
+    return DB_COMMANDS[args[0]](args[1:])
 
 
 # ============ FORMAT ============
@@ -400,11 +864,15 @@ def _fmt_comparison(data):
 def cmd_fmt(args):
     """Format drug data for display."""
     import argparse
+    import metrics
     parser = argparse.ArgumentParser(prog="drug fmt")
     parser.add_argument("-f", "--format", choices=["summary", "table", "csv", "json"], default="summary")
+    _add_io_args(parser)
+    metrics.add_metrics_args(parser)
     opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
 
-    data = json.load(sys.stdin)
+    data, ndjson = _read_records(sys.stdin)
 
     # Detect comparison data
     if isinstance(data, dict) and data.get("type") == "comparison":
@@ -417,11 +885,12 @@ def cmd_fmt(args):
     drugs = data
 
     if opts.format == "json":
-        json.dump(drugs, sys.stdout, indent=2)
+        _write_records(drugs, opts, ndjson)
         return
 
     if opts.format == "csv":
         print("manufacturer,title,form,strength,available,ndcs,inactive_ingredients")
+        count = 0
         for d in drugs:
             form = _short_form(d.get("form", "")) if d.get("form") else _short_form(d.get("title", ""))
             strength = d.get("strength", "")
@@ -429,6 +898,8 @@ def cmd_fmt(args):
             ndcs = ";".join(d.get("ndcs", [])[:3])
             ings = ";".join(d.get("inactive_ingredients", []))
             print(f'"{d.get("manufacturer","")}","{d.get("title","")}",{form},{strength},{avail},"{ndcs}","{ings}"')
+            count += 1
+        _wrote(count)
         return
 
     # Summary format - group by (manufacturer, setid)
@@ -498,16 +969,21 @@ def cmd_compare(args):
     """Compare inactive ingredients across products by NDC."""
     import argparse
     import string
+    import metrics
+    import spl
     parser = argparse.ArgumentParser(prog="drug compare")
     parser.add_argument("ndcs", nargs="+", help="NDC codes to compare (11-digit or dashed)")
+    metrics.add_metrics_args(parser)
     opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
 
     if len(opts.ndcs) < 2:
         print("Error: need at least 2 NDCs to compare", file=sys.stderr)
         sys.exit(1)
 
-    products = json.load(sys.stdin)
-    requested = [_normalize_ndc(n) for n in opts.ndcs]
+    products, _ = _read_records(sys.stdin)
+    products = list(products)
+    requested = [spl.normalize_ndc(n) for n in opts.ndcs]
 
     # Match each requested NDC to a product record
     matched = []
@@ -559,6 +1035,292 @@ def cmd_compare(args):
     json.dump(result, sys.stdout, indent=2)
 
 
+# ============ RUN ============
+
+def _split_pipeline(words):
+    """Split `search x | ingredients | fmt` into [["search", "x"], ["ingredients"], ["fmt"]]."""
+    import shlex
+    if len(words) == 1:
+        lexer = shlex.shlex(words[0], posix=True, punctuation_chars="|")
+        lexer.whitespace_split = True
+        words = list(lexer)
+    stages = [[]]
+    for word in words:
+        if word == "|":
+            stages.append([])
+        else:
+            stages[-1].append(word)
+    # Allow stages copied from a shell pipeline: "drug search x | drug fmt"
+    return [stage[1:] if stage[:1] == ["drug"] else stage for stage in stages]
+
+
+def cmd_run(args):
+    """Run a pipeline of drug commands in one process."""
+    import argparse
+    import metrics
+    parser = argparse.ArgumentParser(
+        prog="drug run",
+        description="Run a pipeline of drug commands in one process. Records pass straight from "
+                    "one stage to the next instead of being written as JSON and parsed again; "
+                    "the output is the same as the shell pipeline's. HTTP and cache options "
+                    "apply to the whole pipeline.",
+        epilog='Example: drug run "search fluoxetine | ingredients | filter talc | fmt"')
+    parser.add_argument("pipeline", nargs=argparse.REMAINDER,
+                        help="Stages separated by |, as one quoted argument")
+    metrics.add_metrics_args(parser)
+    opts = parser.parse_args(args)
+    metrics.apply_metrics_args(opts)
+
+    stages = _split_pipeline(opts.pipeline)
+    for stage in stages:
+        if not stage:
+            parser.error("empty pipeline stage")
+        if stage[0] not in COMMANDS or stage[0] == "run":
+            parser.error(f"unknown command: {stage[0]}")
+
+    stdin, stdout = sys.stdin, sys.stdout
+    try:
+        for i, (name, *stage_args) in enumerate(stages):
+            # Stages are generators, so nothing runs until the last one
+            # starts pulling records through the earlier ones
+            sys.stdout = stdout if i == len(stages) - 1 else _Handoff()
+            metrics.collector().stage = name
+            COMMANDS[name](stage_args)
+            sys.stdin = sys.stdout
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+        metrics.collector().stage = "run"
+
+
+# ============ SERVE ============
+
+# Commands a running `drug serve` answers for the CLI
+SERVED_COMMANDS = ("search", "ingredients", "filter", "ndcs", "nadac", "compare", "fmt", "run")
+
+# Client environment that changes a command's output
+CLIENT_ENV = ("XCIPIENT_NDJSON", "XCIPIENT_METRICS", "XCIPIENT_TEXTFILE_DIR")
+
+# Options that make a command write files where the caller says. Only
+# requests over the Unix socket, which only this user can reach, may use
+# them (or name a metrics file in XCIPIENT_METRICS, or set
+# XCIPIENT_TEXTFILE_DIR).
+FILE_OPTIONS = ("--db", "--record", "--metrics-file", "--textfile-dir")
+
+_serve_lock = threading.Lock()
+
+
+def default_socket():
+    import http_client
+    return os.path.join(http_client.default_cache_dir(), "drug.sock")
+
+
+def _writes_files(argv, env):
+    """Return the option or variable with which argv would write files, or None."""
+    words = argv[1:]
+    if argv[0] == "run":
+        try:
+            words = [word for stage in _split_pipeline(argv[1:]) for word in stage]
+        except ValueError:
+            pass  # cmd_run rejects it the same way
+    for word in words:
+        name = word.split("=", 1)[0]
+        # argparse also takes an unambiguous prefix, e.g. --metrics-f
+        if len(name) > 2 and name != "--metrics" and any(o.startswith(name) for o in FILE_OPTIONS):
+            return name
+    if (env or {}).get("XCIPIENT_METRICS", "-") not in ("", "-", "0"):
+        return "XCIPIENT_METRICS"
+    if (env or {}).get("XCIPIENT_TEXTFILE_DIR"):
+        return "XCIPIENT_TEXTFILE_DIR"
+    return None
+
+
+def _execute(argv, stdin="", records=None, cwd=None, env=None, trusted=True):
+    """Run one command line inside `drug serve`, capturing its output.
+
+    records, when given, are handed to the command as already-parsed input.
+    Commands read and write sys.stdin and sys.stdout, so requests run one
+    at a time; each starts from the server's own HTTP settings. Requests
+    that aren't trusted (those over TCP) may not write files and run in
+    the server's own directory.
+    Returns (exit status, stdout, stderr).
+    """
+    import traceback
+    import http_client
+    import metrics
+    if not trusted:
+        refused = _writes_files(argv, env)
+        if refused:
+            return 2, "", f"drug serve: {refused} is only accepted over the Unix socket\n"
+        cwd = None
+    with _serve_lock:
+        saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd(), http_client.save_settings(),
+                 {k: os.environ.get(k) for k in CLIENT_ENV})
+        if records is not None:
+            sys.stdin = _Handoff()
+            sys.stdin.records = iter(records)
+        else:
+            sys.stdin = io.StringIO(stdin)
+        sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+        status = 0
+        try:
+            for key in CLIENT_ENV:
+                if env and env.get(key) is not None:
+                    os.environ[key] = env[key]
+                else:
+                    os.environ.pop(key, None)
+            if cwd:
+                os.chdir(cwd)
+            metrics.reset(argv[0])
+            COMMANDS[argv[0]](argv[1:])
+        except SystemExit as e:
+            if isinstance(e.code, int) or e.code is None:
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            metrics.emit(argv[0])
+            out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+            sys.stdin, sys.stdout, sys.stderr, old_cwd, http_settings, client_env = saved
+            os.chdir(old_cwd)
+            http_client.restore_settings(http_settings)
+            for key, value in client_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        return status, out, err
+
+
+def cmd_serve(args):
+    """Answer drug commands from a long-running process."""
+    import argparse
+    import socket
+    import daemon
+    global _parsed_labels
+    parser = argparse.ArgumentParser(
+        prog="drug serve",
+        description="Keep the HTTP connection pool, parsed labels and NADAC index in memory and "
+                    "answer drug commands over a local JSON API. While it runs, "
+                    f"{', '.join(SERVED_COMMANDS)} are passed to it automatically "
+                    "(set XCIPIENT_DAEMON=0 to run them locally).",
+        epilog="API: GET /health; POST /cli {argv, stdin}; POST /<command> {args, records}")
+    parser.add_argument("--socket", help="Unix socket to listen on (default: drug.sock in the cache directory)")
+    parser.add_argument("--port", type=int,
+                        help="Listen on this localhost TCP port instead of a Unix socket "
+                             f"(requests over it may not use {', '.join(FILE_OPTIONS)})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log each request on stderr")
+    opts = parser.parse_args(args)
+
+    if opts.port is not None:
+        address = f"127.0.0.1:{opts.port}"
+    elif hasattr(socket, "AF_UNIX"):
+        address = opts.socket or default_socket()
+        os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+    else:
+        parser.error("Unix sockets are not available here; use --port")
+
+    _parsed_labels = OrderedDict()
+    try:
+        daemon.serve(address, _execute, [c for c in COMMANDS if c not in ("serve", "db")], opts.verbose)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _daemon_address():
+    """Return the address of the server to hand commands to, or None.
+
+    XCIPIENT_DAEMON names a socket path or HOST:PORT, or "0" to never
+    delegate; by default the default socket is used when it exists.
+    """
+    setting = os.environ.get("XCIPIENT_DAEMON", "")
+    if setting == "0":
+        return None
+    if setting:
+        return setting
+    path = default_socket()
+    return path if os.path.exists(path) else None
+
+
+def _streams_here(stream):
+    """True if stream is a pipe or other non-file, which a delegated command
+    would have to read to the end before the server could start on it."""
+    import stat
+    try:
+        return not stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False  # not a real file descriptor, e.g. under `drug run`
+
+
+def _is_ndjson(text):
+    """True if text holds more than one line of JSON objects (see _read_records)."""
+    head, _sep, rest = text.lstrip().partition("\n")
+    if not head.startswith("{") or not rest.strip():
+        return False
+    try:
+        json.loads(head)
+    except ValueError:
+        return False
+    return True
+
+
+def _delegate(argv):
+    """Run argv on a running `drug serve` if there is one.
+
+    Returns the exit status, or None if the command should run here, with
+    stdin as it was: when no server answers its health check in time or
+    the command can't be handed over, and when handing it over would stop
+    records from streaming through a pipeline, i.e. when the input is a
+    pipe or NDJSON or NDJSON output was asked for. Once the server has the
+    command, its answer is waited for; the command never runs twice.
+    """
+    if argv[0] not in SERVED_COMMANDS or argv[:2] == ["nadac", "sync"]:
+        return None
+    # The server records and replays by its own environment, not ours
+    if os.environ.get("XCIPIENT_RECORD") or os.environ.get("XCIPIENT_REPLAY"):
+        return None
+    address = _daemon_address()
+    if address is None:
+        return None
+    import daemon_client
+
+    if any("--ndjson" in word for word in argv[1:]) or \
+            os.environ.get("XCIPIENT_NDJSON", "") not in ("", "0"):
+        return None
+    # Commands that start with a search take no input
+    first = _split_pipeline(argv[1:])[0][:1] if argv[0] == "run" else argv[:1]
+    reads_input = first != ["search"] and not sys.stdin.isatty()
+    if reads_input and _streams_here(sys.stdin):
+        return None
+    env = {k: os.environ[k] for k in CLIENT_ENV if k in os.environ}
+    # A server on a TCP port would refuse to write our files
+    if daemon_client.parse_address(address)[0] == "tcp" and _writes_files(argv, env):
+        return None
+    # Answered by a handler thread, so a server busy with a command still replies
+    if daemon_client.health(address, daemon_client.CONNECT_TIMEOUT) is None:
+        return None
+    stdin = sys.stdin.read() if reads_input else ""
+    if _is_ndjson(stdin):
+        sys.stdin = io.StringIO(stdin)
+        return None
+    try:
+        status, out, err = daemon_client.call(address, argv, stdin, os.getcwd(), env)
+    except daemon_client.NotSent:
+        sys.stdin = io.StringIO(stdin)
+        return None
+    except OSError as e:
+        print(f"Error: no answer from drug serve at {address}: {e}", file=sys.stderr)
+        return 1
+    sys.stderr.write(err)
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    return status
+
+
 # ============ MAIN ============
 
 COMMANDS = {
@@ -567,11 +1329,18 @@ COMMANDS = {
     "filter": cmd_filter,
     "ndcs": cmd_ndcs,
     "nadac": cmd_nadac,
+    "db": cmd_db,
     "fmt": cmd_fmt,
     "compare": cmd_compare,
+    "run": cmd_run,
+    "serve": cmd_serve,
 }
 
 def main():
+    # Ensure stdout handles unicode (box-drawing chars on Windows)
+    if sys.stdout.encoding and sys.stdout.encoding.lower() not in ("utf-8", "utf8"):
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", errors="replace")
+
     if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
         print(__doc__)
         sys.exit(0)
@@ -582,7 +1351,24 @@ def main():
         print(f"Available: {', '.join(COMMANDS.keys())}", file=sys.stderr)
         sys.exit(1)
 
-    COMMANDS[cmd](sys.argv[2:])
+    try:
+        status = _delegate(sys.argv[1:])
+        if status is None:
+            import metrics
+            metrics.reset(cmd)
+            try:
+                COMMANDS[cmd](sys.argv[2:])
+            finally:
+                metrics.emit(cmd)
+        elif status:
+            sys.exit(status)
+    except BrokenPipeError:
+        # Downstream stopped reading (e.g. `| head`); exit quietly, outside
+        # the except block so in-flight fetches are cancelled first
+        sys.stdout = open(os.devnull, "w")
+    else:
+        return
+    sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+"""
+Excipient name to UNII resolution.
+
+SPL documents identify every ingredient by its FDA Unique Ingredient
+Identifier (UNII) as well as by a name, and the names vary between labelers
+("FD&C YELLOW NO. 6" and "SUNSET YELLOW FCF" are both H77VEI93A8). An
+excipient given on the command line is resolved once into the set of UNIIs
+whose names contain it; each product is then matched by a set lookup on its
+ingredients' codes, with the name substring match as a fallback.
+
+Names come from three places, merged at lookup time:
+    SYNONYMS        a small built-in table of common excipients
+    the label store every (name, UNII) pair seen in imported labels
+    UNII names file FDA's UNII_Names list, loaded with `drug db unii`
+"""
+
+import sys
+from collections import deque
+
+import label_store
+
+
+# UNII -> names, for common excipients and the color additives whose FD&C
+# and chemical names share nothing a substring match would find.
+SYNONYMS = {
+    "6DC9Q167V3": ["propylene glycol", "1,2-propanediol"],
+    "EWQ57Q8I5X": ["lactose monohydrate", "lactose, hydrous"],
+    "3SY5LH9PMK": ["anhydrous lactose", "lactose, anhydrous"],
+    "70097M6I30": ["magnesium stearate"],
+    "7SEV7J4R1U": ["talc"],
+    "15FIX9V2JP": ["titanium dioxide"],
+    "H77VEI93A8": ["fd&c yellow no. 6", "sunset yellow fcf", "yellow 6"],
+    "I753WB2F1M": ["fd&c yellow no. 5", "tartrazine", "yellow 5"],
+    "WZB9127XOA": ["fd&c red no. 40", "allura red ac", "red 40"],
+    "H3R47K3TBD": ["fd&c blue no. 1", "brilliant blue fcf", "blue 1"],
+    "L06K8R7DQK": ["fd&c blue no. 2", "indigotine", "indigo carmine", "blue 2"],
+    "2G86QN327L": ["gelatin"],
+    "FZ989GH94E": ["povidone", "polyvinylpyrrolidone"],
+    "M28OL1HH48": ["croscarmellose sodium"],
+    "OP1R32D61U": ["microcrystalline cellulose", "cellulose, microcrystalline"],
+    "O8232NY3SJ": ["corn starch", "starch, corn", "maize starch"],
+    "368GB5141J": ["sodium lauryl sulfate", "sodium dodecyl sulfate"],
+    "ETJ7Z6XBU4": ["silicon dioxide", "colloidal silicon dioxide", "silica"],
+    "C151H8M554": ["sucrose"],
+    "3OWL53L36A": ["mannitol"],
+    "506T60A25R": ["sorbitol"],
+    "PDC6A3C0OX": ["glycerin", "glycerol"],
+    "LKG8494WBH": ["benzyl alcohol"],
+    "Z0H242BBR1": ["aspartame"],
+}
+
+
+# Below this many patterns, a loop of `in` tests (each running in C) beats
+# stepping an automaton one character at a time in Python.
+AUTOMATON_MIN_PATTERNS = 32
+
+
+class PatternSet:
+    """Multi-pattern substring search: does a text contain any of the patterns?
+
+    The patterns are compiled once into an Aho-Corasick automaton, so each
+    text is scanned in a single pass however many patterns there are. The
+    pyahocorasick C extension is used when installed; otherwise the
+    automaton is expanded into a full transition table and stepped in
+    Python, and small pattern sets just use `in`.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self._always = "" in self.patterns
+        self._automaton = None
+        self._delta = None
+        if self._always or not self.patterns:
+            return
+        try:
+            import ahocorasick
+        except ImportError:
+            if len(self.patterns) >= AUTOMATON_MIN_PATTERNS:
+                self._delta, self._out = _compile(self.patterns)
+            return
+        self._automaton = ahocorasick.Automaton()
+        for pattern in self.patterns:
+            self._automaton.add_word(pattern, pattern)
+        self._automaton.make_automaton()
+
+    def search(self, text: str) -> bool:
+        if self._always:
+            return True
+        if self._automaton is not None:
+            return next(self._automaton.iter(text), None) is not None
+        if self._delta is not None:
+            delta, out = self._delta, self._out
+            state = 0
+            for ch in text:
+                state = delta[state].get(ch, 0)
+                if out[state]:
+                    return True
+            return False
+        return any(pattern in text for pattern in self.patterns)
+
+
+def _compile(patterns):
+    """Build the Aho-Corasick transition table for patterns.
+
+    Returns (delta, out): delta[state] maps a character to the next state
+    (missing characters go back to the root) with failure links already
+    folded in, and out[state] is true when some pattern ends there.
+    """
+    goto = [{}]
+    out = [False]
+    for pattern in patterns:
+        state = 0
+        for ch in pattern:
+            if ch not in goto[state]:
+                goto.append({})
+                out.append(False)
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        out[state] = True
+
+    # Breadth-first, so each state's failure target is finished before it
+    fail = [0] * len(goto)
+    delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        delta[state] = {**delta[fail[state]], **goto[state]}
+        out[state] = out[state] or out[fail[state]]
+        for ch, nxt in goto[state].items():
+            fail[nxt] = delta[fail[state]].get(ch, 0)
+            queue.append(nxt)
+    return delta, out
+
+
+def read_list(path: str) -> list[str]:
+    """Read an excipient list: one name per line, # starts a comment."""
+    with open(path, encoding="utf-8") as f:
+        names = (line.split("#", 1)[0].strip() for line in f)
+        return [name for name in names if name]
+
+
+def builtin_pairs():
+    """Return SYNONYMS as (name, UNII) pairs."""
+    return [(name, unii) for unii, names in SYNONYMS.items() for name in names]
+
+
+class Resolver:
+    """Resolve excipient names to UNII sets using SYNONYMS and a label store."""
+
+    def __init__(self, store=None):
+        self.store = store
+        self._builtin = [(label_store.normalize_ingredient(name), unii) for name, unii in builtin_pairs()]
+
+    def resolve(self, excipient: str) -> set[str]:
+        """Return the UNIIs of every known name containing excipient."""
+        needle = label_store.normalize_ingredient(excipient)
+        codes = {unii for name, unii in self._builtin if needle in name}
+        if self.store is not None:
+            codes |= self.store.uniis_for(excipient)
+        return codes
+
+
+class Matcher:
+    """Decide whether a record contains any of a list of excipients.
+
+    Ingredient UNIIs are checked against the resolved codes first, which
+    catches synonyms; failing that, the names are matched by substring as
+    drug filter always has, so nothing that matched before stops matching.
+    Without a resolver only the names are matched.
+    """
+
+    def __init__(self, excipients: list[str], resolver: Resolver = None):
+        self.needles = PatternSet(e.lower() for e in excipients)
+        self.codes = set()
+        for excipient in excipients if resolver is not None else ():
+            self.codes |= resolver.resolve(excipient)
+
+    def matches(self, record: dict) -> bool:
+        if self.codes and not self.codes.isdisjoint(record.get("inactive_unii") or ()):
+            return True
+        return self.needles.search(" ".join(record.get("inactive_ingredients", [])).lower())
+
+
+def load_unii_names(store, path: str, verbose: bool = False) -> int:
+    """Load FDA's UNII_Names file (tab-separated, with Name and UNII
+    columns) into the store's synonym table. Returns the rows read."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        try:
+            name_col, unii_col = header.index("Name"), header.index("UNII")
+        except ValueError:
+            raise ValueError(f"{path}: expected a tab-separated file with Name and UNII columns")
+        rows = []
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) > max(name_col, unii_col) and cols[name_col] and cols[unii_col]:
+                rows.append((cols[name_col], cols[unii_col]))
+    store.add_unii_names(rows)
+    if verbose:
+        print(f"Loaded {len(rows)} UNII names from {path}", file=sys.stderr)
+    return len(rows)
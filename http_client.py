@@ -0,0 +1,865 @@
+"""
+Shared HTTP access for the DailyMed and NADAC tools.
+
+Every GET goes through get(), which answers from an on-disk response cache
+when it can, and otherwise uses one pooled keep-alive requests.Session so
+repeated calls to the same host skip the TCP and TLS handshakes. Cache
+entries are keyed by a hash of the URL and query params, expire per
+endpoint (see TTLS), and the whole cache is kept under a size limit by
+evicting the least recently used entries.
+
+Settings can come from the environment or from configure():
+    XCIPIENT_CACHE_DIR      Cache location (default: ~/.cache/xcipient)
+    XCIPIENT_CACHE_MAX_MB   Size limit in megabytes (default: 512)
+    XCIPIENT_NO_CACHE=1     Disable the cache entirely
+    XCIPIENT_TIMEOUT        Read timeout in seconds (default: 30)
+    XCIPIENT_ENGINE         "threads" (default) or "async" for get_many()
+    XCIPIENT_RATE           Requests per second per host (default: 20, 0 = unlimited)
+    XCIPIENT_RECORD         Save every response to this directory (see Recording)
+    XCIPIENT_REPLAY         Answer only from a recorded directory, never the network
+
+get_many() fetches many URLs concurrently, either on a thread pool or, when
+aiohttp is installed, on an asyncio event loop that can keep thousands of
+requests in flight under a global cap and a per-host limit.
+
+requests itself is imported on first use, so commands that never touch the
+network can import this module for its settings without paying for it.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+import metrics
+
+CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = float(os.environ.get("XCIPIENT_TIMEOUT", 30))
+DEFAULT_MAX_MB = 512
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RATE = float(os.environ.get("XCIPIENT_RATE", 20))
+USER_AGENT = "xcipient/1.0"
+
+# Time-to-live per endpoint, first match wins. SPL documents and their
+# per-setid JSON change only when a new label version is published, but
+# their URLs don't name the version, so they are kept no longer than the
+# search listing that would show a new one; NADAC prices are republished
+# weekly so those answers are kept briefly.
+TTLS = [
+    (re.compile(r"/spls/[^/]+\.xml$"), 24 * 3600),
+    (re.compile(r"/spls/[^/]+/(ndcs|packaging)\.json$"), 24 * 3600),
+    (re.compile(r"/spls\.json$"), 24 * 3600),
+    (re.compile(r"/ndcs\.json$"), 24 * 3600),
+    (re.compile(r"/datastore/query/"), 6 * 3600),
+]
+DEFAULT_TTL = 24 * 3600
+# A response cached for a known label version (get(..., version=)) never
+# changes, so it is kept until evicted for space
+VERSIONED_TTL = 365 * 24 * 3600
+
+
+def default_cache_dir() -> str:
+    """Directory for cached responses and other local data."""
+    if os.environ.get("XCIPIENT_CACHE_DIR"):
+        return os.environ["XCIPIENT_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "xcipient")
+
+
+def ttl_for(url: str, version=None) -> int:
+    """Return the cache lifetime in seconds for a URL."""
+    if version:
+        return VERSIONED_TTL
+    for pattern, ttl in TTLS:
+        if pattern.search(url):
+            return ttl
+    return DEFAULT_TTL
+
+
+class CachedResponse:
+    """Minimal stand-in for requests.Response, built from a cache entry or
+    an async response body."""
+
+    def __init__(self, url: str, status_code: int, headers: dict, content: bytes, encoding: str = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = True
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class ResponseCache:
+    """Content-addressed response store with TTL expiry and LRU eviction.
+
+    Each entry is one file: a JSON header line followed by the raw body.
+    Reads bump the file's mtime, so mtime order is least-recently-used order.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None  # bytes on disk, computed on first write
+
+    @staticmethod
+    def key(url: str, params: dict = None, version=None) -> str:
+        query = urlencode(sorted((params or {}).items()), doseq=True)
+        request = f"GET {url}?{query}"
+        if version:
+            request += f" version={version}"
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, url: str, params: dict = None, ttl: int = DEFAULT_TTL, version=None):
+        """Return a CachedResponse, or None if missing or expired."""
+        path = self._file(self.key(url, params, version))
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - header.get("stored_at", 0) > ttl:
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return CachedResponse(header.get("url", url), header.get("status", 200),
+                              header.get("headers", {}), content, header.get("encoding"))
+
+    def put(self, url: str, params: dict, resp, version=None):
+        """Store a response body. Write errors are ignored."""
+        path = self._file(self.key(url, params, version))
+        header = {
+            "url": url,
+            "status": resp.status_code,
+            "headers": {"Content-Type": resp.headers.get("Content-Type", "")},
+            "encoding": resp.encoding,
+            "stored_at": time.time(),
+        }
+        data = json.dumps(header).encode() + b"\n" + resp.content
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            try:
+                old_size = os.stat(path).st_size  # an expired entry being refreshed
+            except OSError:
+                old_size = 0
+            os.replace(tmp, path)
+        except OSError:
+            return
+
+        with self._lock:
+            if self._total is None:
+                self._total = self._disk_usage()
+            else:
+                self._total += len(data) - old_size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".tmp") or len(name) != 64:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _disk_usage(self) -> int:
+        return sum(size for _mtime, size, _path in self._entries())
+
+    def _evict(self):
+        """Drop least recently used entries until under 90% of the limit."""
+        target = self.max_bytes * 0.9
+        entries = sorted(self._entries())
+        # Recount, since other processes share the directory
+        self._total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if self._total <= target:
+                break
+            try:
+                os.remove(path)
+                self._total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for _mtime, _size, path in list(self._entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._total = 0
+
+
+class Recording:
+    """Request/response pairs saved by --record and answered by --replay.
+
+    Each pair is one gzip file in the directory, named by the response
+    cache's key for the request and holding a JSON header line (URL,
+    params, status) followed by the body. Processes can record into the
+    same directory at once, so a whole shell pipeline can share one. A
+    request made again replaces its pair, and replay answers it the same
+    way every time, without the cache, the rate limiter or the network.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+
+    def _file(self, url: str, params: dict = None) -> str:
+        return os.path.join(self.path, ResponseCache.key(url, params) + ".gz")
+
+    def get(self, url: str, params: dict = None):
+        """Return the recorded CachedResponse, or None if there is none."""
+        import gzip
+        try:
+            with gzip.open(self._file(url, params), "rb") as f:
+                header = json.loads(f.readline())
+                content = f.read()
+        except (OSError, EOFError, ValueError):
+            return None
+        return CachedResponse(header.get("url", url), header.get("status", 200),
+                              header.get("headers", {}), content, header.get("encoding"))
+
+    def put(self, url: str, params: dict, resp):
+        """Save a response, warning on stderr if it can't be written."""
+        import gzip
+        header = {
+            "url": url,
+            "params": params or {},
+            "status": resp.status_code,
+            "headers": {"Content-Type": resp.headers.get("Content-Type", "")},
+            "encoding": resp.encoding,
+        }
+        data = json.dumps(header, default=str).encode() + b"\n" + resp.content
+        path = self._file(url, params)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.GzipFile(tmp, "wb", mtime=0) as f:  # same pair, same bytes
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Warning: could not record {url}: {e}", file=sys.stderr)
+
+
+# ============ RATE LIMITING AND RETRIES ============
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+
+
+class RateLimiter:
+    """Per-host token buckets shared by every worker in the process.
+
+    Each host starts at the configured rate (requests per second). A
+    throttling answer (429/503) halves that host's rate and pauses it for
+    the Retry-After delay; each success then raises the rate by a few
+    percent until it is back at the ceiling, so the request rate settles
+    near what the server accepts.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.max_rate = rate
+        self.burst = burst or max(1, int(rate / 4))
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host, now):
+        if host not in self._hosts:
+            self._hosts[host] = {"rate": self.max_rate, "tokens": float(self.burst),
+                                 "stamp": now, "paused_until": 0.0}
+        return self._hosts[host]
+
+    def reserve(self, host: str) -> float:
+        """Take one token for host; return how long to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            b = self._bucket(host, now)
+            b["tokens"] = min(self.burst, b["tokens"] + (now - b["stamp"]) * b["rate"])
+            b["stamp"] = now
+            b["tokens"] -= 1
+            wait = -b["tokens"] / b["rate"] if b["tokens"] < 0 else 0.0
+            return max(wait, b["paused_until"] - now)
+
+    def throttled(self, host: str, delay: float):
+        """Slow host down after a 429/503 and hold it for delay seconds."""
+        with self._lock:
+            now = time.monotonic()
+            b = self._bucket(host, now)
+            # Requests already in flight are answered with the same verdict;
+            # only the first one per pause should lower the rate
+            if now >= b["paused_until"]:
+                b["rate"] = max(self.max_rate / 64, b["rate"] / 2)
+            b["paused_until"] = max(b["paused_until"], now + delay)
+            b["tokens"] = min(b["tokens"], 0.0)
+
+    def succeeded(self, host: str):
+        with self._lock:
+            b = self._hosts.get(host)
+            if b is not None and b["rate"] < self.max_rate:
+                b["rate"] = min(self.max_rate, b["rate"] + self.max_rate / 50)
+
+    def rate(self, host: str) -> float:
+        with self._lock:
+            b = self._hosts.get(host)
+            return b["rate"] if b else self.max_rate
+
+
+class RetryBudget:
+    """Caps retries after errors at a fraction of all requests made.
+
+    Every request adds ratio tokens and every retry spends one, so a
+    server that fails persistently gets at most about ratio extra load
+    instead of MAX_ATTEMPTS times the traffic. Retries after a 429 don't
+    count; the rate limiter already spaces those out.
+    """
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 10.0):
+        self.ratio = ratio
+        self.cap = reserve
+        self.tokens = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def _retry_after(headers) -> float:
+    """Seconds from a Retry-After header (delta or HTTP date), or None."""
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given retry attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def _retry_delay(url: str, attempt: int, resp=None, error: Exception = None) -> float:
+    """Decide whether to retry after a response or error.
+
+    Returns the delay in seconds before the next attempt, or None to give
+    up. Updates the rate limiter when the server asks us to slow down.
+    """
+    host = _host(url)
+    if error is None:
+        if resp.status_code not in RETRY_STATUSES:
+            if _limiter is not None and resp.status_code < 400:
+                _limiter.succeeded(host)
+            return None
+        delay = _retry_after(resp.headers)
+        if resp.status_code in (429, 503) and _limiter is not None:
+            _limiter.throttled(host, delay if delay is not None else _backoff(attempt))
+    else:
+        delay = None
+    if attempt + 1 >= MAX_ATTEMPTS:
+        return None
+    # Throttling answers are paced by the limiter; only errors spend the budget
+    throttled = error is None and resp.status_code == 429
+    if not throttled and not _retry_budget.withdraw():
+        return None
+    if delay is None:
+        delay = _backoff(attempt)
+    return min(delay, BACKOFF_MAX)
+
+
+def _give_up(url: str, attempts: int, resp=None, error: Exception = None):
+    reason = f"HTTP {resp.status_code}" if error is None else f"{type(error).__name__}: {error}"
+    print(f"Warning: GET {url} failed after {attempts} attempt(s) ({reason})", file=sys.stderr)
+
+
+def _rate_wait(url: str) -> float:
+    return _limiter.reserve(_host(url)) if _limiter is not None else 0.0
+
+
+# ============ MODULE STATE ============
+
+_cache = None
+_use_cache = os.environ.get("XCIPIENT_NO_CACHE", "") in ("", "0")
+_refresh = False
+_session = None
+_session_lock = threading.Lock()
+_pool_size = DEFAULT_POOL_SIZE
+_limiter = RateLimiter(DEFAULT_RATE) if DEFAULT_RATE > 0 else None
+_retry_budget = RetryBudget()
+_recording = Recording(os.environ["XCIPIENT_RECORD"]) if os.environ.get("XCIPIENT_RECORD") else None
+_replay = Recording(os.environ["XCIPIENT_REPLAY"]) if os.environ.get("XCIPIENT_REPLAY") else None
+
+
+def configure(use_cache: bool = None, refresh: bool = None, cache_dir: str = None, max_mb: int = None,
+              pool_size: int = None, rate: float = None, record: str = None, replay: str = None):
+    """Change HTTP and cache behaviour for the rest of the process.
+
+    pool_size is the number of keep-alive connections kept per host; set it
+    to at least the number of concurrent workers. rate is the ceiling in
+    requests per second per host; 0 turns rate limiting off. record and
+    replay name a Recording directory to save responses to or answer from.
+    """
+    global _cache, _use_cache, _refresh, _pool_size, _session, _limiter, _recording, _replay
+    if use_cache is not None:
+        _use_cache = use_cache
+    if refresh is not None:
+        _refresh = refresh
+    if pool_size is not None and pool_size > _pool_size:
+        with _session_lock:
+            _pool_size = pool_size
+            if _session is not None:
+                _mount(_session)
+    if rate is not None:
+        _limiter = RateLimiter(rate) if rate > 0 else None
+    if record is not None:
+        _recording = Recording(record)
+    if replay is not None:
+        _replay = Recording(replay)
+    if cache_dir is not None or max_mb is not None:
+        max_mb = max_mb or int(os.environ.get("XCIPIENT_CACHE_MAX_MB", DEFAULT_MAX_MB))
+        _cache = ResponseCache(cache_dir or os.path.join(default_cache_dir(), "http"),
+                               max_mb * 1024 * 1024)
+
+
+def save_settings():
+    """Return the settings the per-command options change (see
+    apply_http_args), for restore_settings()."""
+    return _use_cache, _refresh, _limiter, _recording, _replay
+
+
+def restore_settings(saved):
+    global _use_cache, _refresh, _limiter, _recording, _replay
+    _use_cache, _refresh, _limiter, _recording, _replay = saved
+
+
+def get_cache() -> ResponseCache:
+    if _cache is None:
+        configure(max_mb=int(os.environ.get("XCIPIENT_CACHE_MAX_MB", DEFAULT_MAX_MB)))
+    return _cache
+
+
+def _replayed(url: str, params: dict = None):
+    """Answer a request from the --replay directory; unrecorded requests fail
+    like unreachable ones."""
+    resp = _replay.get(url, params)
+    metrics.collector().replayed(url)
+    if resp is None:
+        import requests
+        raise requests.ConnectionError(f"not recorded in {_replay.path}: {url}")
+    return resp
+
+
+def _recorded(url: str, params: dict, resp):
+    """Save resp to the --record directory, if there is one; returns resp."""
+    if _recording is not None:
+        _recording.put(url, params, resp)
+    return resp
+
+
+def _mount(sess):
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_pool_size)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+
+
+def session() -> "requests.Session":
+    """Return the shared keep-alive session, creating it on first use."""
+    import requests
+    global _session
+    with _session_lock:
+        if _session is None:
+            sess = requests.Session()
+            sess.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"})
+            _mount(sess)
+            _session = sess
+        return _session
+
+
+def add_http_args(parser):
+    """Add --no-cache/--refresh/--rate/--record/--replay, and the metrics
+    options, to an argparse parser."""
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't read or write the on-disk response cache")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Ignore cached responses but store fresh ones")
+    parser.add_argument("--rate", type=float, default=None,
+                        help=f"Max requests per second per host (default: {DEFAULT_RATE:g}, 0 = unlimited)")
+    parser.add_argument("--record", metavar="DIR",
+                        help="Save every request and response to DIR, for --replay")
+    parser.add_argument("--replay", metavar="DIR",
+                        help="Answer requests only from a --record directory, without the network")
+    metrics.add_metrics_args(parser)
+
+
+def apply_http_args(opts):
+    """Apply options added by add_http_args()."""
+    if opts.no_cache:
+        configure(use_cache=False)
+    if opts.refresh:
+        configure(refresh=True)
+    if opts.rate is not None:
+        configure(rate=opts.rate)
+    if opts.record:
+        configure(record=opts.record)
+    if opts.replay:
+        configure(replay=opts.replay)
+    metrics.apply_metrics_args(opts)
+
+
+def get(url: str, params: dict = None, headers: dict = None, timeout: float = None,
+        cache: bool = True, version=None):
+    """GET a URL, answering from the response cache when possible.
+
+    timeout is the read timeout in seconds (default DEFAULT_TIMEOUT). Pass
+    cache=False for one-off bulk downloads that shouldn't displace cached
+    entries. Requests are paced by the per-host rate limiter; 429/5xx
+    answers and connection errors are retried with backoff, and a request
+    that still fails is reported on stderr. Returns a requests.Response or
+    a CachedResponse; both provide status_code, content, text, json() and
+    raise_for_status().
+    With --replay, answers come only from the recording.
+
+    version names the label version a per-setid URL is expected to return
+    (the search listing's spl_version). It becomes part of the cache key,
+    so a newly published version is fetched at once and a cached one can
+    be kept indefinitely.
+    """
+    if _replay is not None:
+        return _replayed(url, params)
+    cache = get_cache() if _use_cache and cache else None
+    ttl = ttl_for(url, version)
+
+    if cache is not None and not _refresh:
+        cached = cache.get(url, params, ttl, version)
+        metrics.collector().cache(url, cached is not None)
+        if cached is not None:
+            return _recorded(url, params, cached)
+
+    import requests  # only once something has to be fetched
+    _retry_budget.deposit()
+    attempt = 0
+    while True:
+        wait = _rate_wait(url)
+        if wait:
+            time.sleep(wait)
+        start = time.perf_counter()
+        try:
+            resp = session().get(url, params=params, headers=headers,
+                                 timeout=(CONNECT_TIMEOUT, timeout or DEFAULT_TIMEOUT))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.collector().request(url, None, time.perf_counter() - start)
+            delay = _retry_delay(url, attempt, error=e)
+            if delay is None:
+                _give_up(url, attempt + 1, error=e)
+                raise
+        else:
+            metrics.collector().request(url, resp.status_code, time.perf_counter() - start,
+                                        len(resp.content))
+            delay = _retry_delay(url, attempt, resp)
+            if delay is None:
+                if resp.status_code in RETRY_STATUSES:
+                    _give_up(url, attempt + 1, resp)
+                break
+        attempt += 1
+        metrics.collector().retry(url)
+        time.sleep(delay)
+
+    resp.from_cache = False
+    if cache is not None and resp.status_code == 200:
+        cache.put(url, params, resp, version)
+    return _recorded(url, params, resp)
+
+
+# ============ CONCURRENT FETCHING ============
+
+ENGINES = ("threads", "async")
+DEFAULT_ENGINE = os.environ.get("XCIPIENT_ENGINE", "threads")
+
+
+class _AsyncEngine:
+    """aiohttp client running on its own event loop thread.
+
+    There is one per process (see _async_engine()), so its cap on requests
+    in flight holds across get_many() calls, e.g. over all the stages of
+    `drug run`; the cap is the largest concurrency asked for so far. Cache
+    and recording files are read and written on the loop's executor, so
+    disk I/O never stalls the requests in flight.
+
+    submit() can be called from any thread and returns a
+    concurrent.futures.Future, so callers need no asyncio code of their own.
+    """
+
+    def __init__(self):
+        import asyncio
+        import aiohttp
+        self._aiohttp = aiohttp
+        self.capacity = 0
+        self._lock = threading.Lock()
+        self._host_slots = {}  # (host, limit) -> Semaphore, for --per-host
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+
+    async def _open(self):
+        import asyncio
+        aiohttp = self._aiohttp
+        self.slots = asyncio.Semaphore(0)  # opened up by reserve()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=DEFAULT_TIMEOUT),
+            headers={"User-Agent": USER_AGENT},
+        )
+
+    def reserve(self, concurrency: int):
+        """Raise the process-wide cap on requests in flight to concurrency."""
+        with self._lock:
+            for _ in range(concurrency - self.capacity):
+                self.loop.call_soon_threadsafe(self.slots.release)
+            self.capacity = max(self.capacity, concurrency)
+
+    def _disk(self, fn, *args):
+        """Run a blocking cache or recording call on the loop's executor."""
+        return self.loop.run_in_executor(None, fn, *args)
+
+    def _slot(self, url, per_host):
+        """Return the semaphore for url's host under a per-host limit, or None."""
+        import asyncio
+        if not per_host:
+            return None
+        key = (_host(url), per_host)
+        if key not in self._host_slots:
+            self._host_slots[key] = asyncio.Semaphore(per_host)
+        return self._host_slots[key]
+
+    async def _get(self, url, params, headers, version, per_host):
+        import asyncio
+        from contextlib import nullcontext
+        if _replay is not None:
+            return await self._disk(_replayed, url, params)
+        cache = get_cache() if _use_cache else None
+        if cache is not None and not _refresh:
+            cached = await self._disk(cache.get, url, params, ttl_for(url, version), version)
+            metrics.collector().cache(url, cached is not None)
+            if cached is not None:
+                return await self._disk(_recorded, url, params, cached)
+
+        _retry_budget.deposit()
+        attempt = 0
+        host_slot = self._slot(url, per_host)
+        while True:
+            wait = _rate_wait(url)
+            if wait:
+                await asyncio.sleep(wait)
+            async with host_slot or nullcontext(), self.slots:
+                start = time.perf_counter()
+                try:
+                    async with self.session.get(url, params=params, headers=headers) as r:
+                        content = await r.read()
+                        resp = CachedResponse(str(r.url), r.status, dict(r.headers), content, r.charset)
+                except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                else:
+                    error = None
+            if error is not None:
+                metrics.collector().request(url, None, time.perf_counter() - start)
+                delay = _retry_delay(url, attempt, error=error)
+                if delay is None:
+                    _give_up(url, attempt + 1, error=error)
+                    raise error
+            else:
+                metrics.collector().request(url, resp.status_code, time.perf_counter() - start,
+                                            len(content))
+                delay = _retry_delay(url, attempt, resp)
+                if delay is None:
+                    if resp.status_code in RETRY_STATUSES:
+                        _give_up(url, attempt + 1, resp)
+                    break
+            attempt += 1
+            metrics.collector().retry(url)
+            await asyncio.sleep(delay)
+
+        resp.from_cache = False
+        if cache is not None and resp.status_code == 200:
+            await self._disk(cache.put, url, params, resp, version)
+        return await self._disk(_recorded, url, params, resp)
+
+    def submit(self, url, params=None, headers=None, version=None, per_host=0):
+        import asyncio
+        params = {k: str(v) for k, v in (params or {}).items()}
+        return asyncio.run_coroutine_threadsafe(self._get(url, params, headers, version, per_host),
+                                                self.loop)
+
+    def release(self):
+        """Nothing to do: the engine stays open for the next get_many()."""
+
+    def close(self):
+        import asyncio
+
+        async def shutdown():
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            await self.session.close()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class _ThreadEngine:
+    """Fallback engine: blocking get() calls on a thread pool."""
+
+    def __init__(self, concurrency: int):
+        from concurrent.futures import ThreadPoolExecutor
+        configure(pool_size=concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit(self, url, params=None, headers=None, version=None, per_host=0):
+        return self.pool.submit(get, url, params, headers, version=version)
+
+    def release(self):
+        self.pool.shutdown(wait=True)
+
+
+_async = None
+_async_lock = threading.Lock()
+
+
+def _async_engine() -> _AsyncEngine:
+    """Return the process's asyncio engine, starting it on first use."""
+    global _async
+    with _async_lock:
+        if _async is None:
+            import atexit
+            _async = _AsyncEngine()
+            atexit.register(_async.close)
+        return _async
+
+
+def _make_engine(engine: str, concurrency: int):
+    if engine == "async":
+        try:
+            eng = _async_engine()
+        except ImportError:
+            print("Warning: aiohttp is not installed; using the thread engine", file=sys.stderr)
+        else:
+            eng.reserve(concurrency)
+            return eng
+    return _ThreadEngine(concurrency)
+
+
+def get_many(items, to_request, concurrency: int = DEFAULT_POOL_SIZE, per_host: int = 0,
+             engine: str = None):
+    """Fetch one URL per item concurrently, yielding (item, response) in input order.
+
+    to_request(item) returns (url, params, headers), optionally followed by
+    the label version for get(), or None to skip the item; skipped items
+    are yielded with a response of None. A failed
+    request is yielded as its exception instead of a response. At most
+    concurrency requests are in flight and only that many items are read
+    ahead, so items may be a generator over streamed input.
+
+    engine is "threads" or "async" (default: XCIPIENT_ENGINE or threads).
+    With concurrency 1 requests are made one at a time in this thread.
+    """
+    def fetch_now(req):
+        try:
+            return get(*req[:3], version=req[3] if len(req) > 3 else None)
+        except Exception as e:
+            return e
+
+    if concurrency <= 1:
+        for item in items:
+            req = to_request(item)
+            yield item, None if req is None else fetch_now(req)
+        return
+
+    def result(future):
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    eng = _make_engine(engine or DEFAULT_ENGINE, concurrency)
+    try:
+        pending = deque()
+        for item in items:
+            req = to_request(item)
+            pending.append((item, None if req is None else eng.submit(*req, per_host=per_host)))
+            if len(pending) >= concurrency:
+                item, future = pending.popleft()
+                yield item, result(future)
+        while pending:
+            item, future = pending.popleft()
+            yield item, result(future)
+    finally:
+        for _item, future in pending:
+            if future is not None:
+                future.cancel()
+        eng.release()
+
+
+def add_engine_args(parser, default_jobs: int = 1):
+    """Add -j/--jobs, --async and --per-host to an argparse parser."""
+    parser.add_argument("-j", "--jobs", type=int, default=default_jobs,
+                        help=f"Run up to N requests concurrently (default: {default_jobs})")
+    parser.add_argument("--async", dest="engine", action="store_const", const="async", default=None,
+                        help="Use the asyncio engine (needs aiohttp; falls back to threads)")
+    parser.add_argument("--per-host", type=int, default=0,
+                        help="Limit concurrent connections per host with --async (default: no limit)")
@@ -0,0 +1,644 @@
+"""
+Local SPL label store.
+
+`drug db import` reads DailyMed SPL release archives (the full release and
+the monthly, weekly and daily update ZIPs, which wrap one ZIP per label)
+straight from the archive without extracting anything to disk. Each label is
+parsed once and its products are written to a SQLite file keyed by setid,
+with side tables indexing them by package NDC and by inactive ingredient.
+
+search, ingredients and ndcs then answer from this file with --offline.
+Only the newest version of each setid is kept; importing an archive that
+holds an older or equal version of a label leaves the stored one alone.
+
+`drug db sync` keeps the stored labels current from the live API: it lists
+what was published since the last sync and re-downloads only the labels
+whose version went up.
+"""
+
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+
+import http_client
+import metrics
+
+
+V3 = "{urn:hl7-org:v3}"
+HEADER_CHUNK = 16 * 1024
+COMMIT_EVERY = 500
+SYNC_PAGE_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+    setid TEXT PRIMARY KEY,
+    version INTEGER,
+    effective_time TEXT,
+    title TEXT,
+    manufacturer TEXT,
+    source TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS products (
+    setid TEXT,
+    product_index INTEGER,
+    name TEXT,
+    generic_name TEXT,
+    form TEXT,
+    strength TEXT,
+    inactive_ingredients TEXT,
+    ndcs TEXT,
+    inactive_unii TEXT,
+    PRIMARY KEY (setid, product_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS product_ndcs (
+    ndc TEXT,
+    setid TEXT,
+    product_index INTEGER,
+    PRIMARY KEY (ndc, setid, product_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS product_ingredients (
+    ingredient TEXT,
+    setid TEXT,
+    product_index INTEGER,
+    PRIMARY KEY (ingredient, setid, product_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS product_ndcs_setid ON product_ndcs (setid);
+CREATE INDEX IF NOT EXISTS product_ingredients_setid ON product_ingredients (setid);
+CREATE TABLE IF NOT EXISTS ingredient_names (
+    ingredient TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS unii_names (
+    name TEXT,
+    unii TEXT,
+    PRIMARY KEY (name, unii)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS unii_names_unii ON unii_names (unii);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_path() -> str:
+    return os.path.join(http_client.default_cache_dir(), "labels.sqlite")
+
+
+def normalize_ingredient(name: str) -> str:
+    """Lower-case an ingredient name and collapse its whitespace."""
+    return " ".join(name.lower().split())
+
+
+def _like(text: str) -> str:
+    """LIKE pattern matching text anywhere, with wildcards in text escaped."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+# ============ ARCHIVES ============
+
+def iter_spl_documents(source, name: str = ""):
+    """Yield (member name, XML bytes) for every SPL document in a ZIP.
+
+    source is a path or a binary file object. Nested ZIPs are opened in
+    memory and walked recursively; other members (label images) are skipped.
+    """
+    import zipfile
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipFile:
+        print(f"Warning: skipping {name or source}: not a ZIP archive", file=sys.stderr)
+        return
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            member = f"{name}/{info.filename}" if name else info.filename
+            lower = info.filename.lower()
+            if lower.endswith(".zip"):
+                with archive.open(info) as f:
+                    data = f.read()
+                yield from iter_spl_documents(io.BytesIO(data), member)
+            elif lower.endswith(".xml"):
+                with archive.open(info) as f:
+                    yield member, f.read()
+
+
+def parse_header(xml_bytes: bytes):
+    """Read setid, version, effective time and labeler from an SPL header.
+
+    Stops at the first section of the body, so only the top of the
+    document is parsed. Returns a dict, or None if there is no setId.
+    """
+    import xml.etree.ElementTree as ET
+    parser = ET.XMLPullParser(events=("start", "end"))
+    header = {"setid": None, "version": 0, "effective_time": "", "manufacturer": ""}
+    path = []
+
+    try:
+        for i in range(0, len(xml_bytes), HEADER_CHUNK):
+            parser.feed(xml_bytes[i:i + HEADER_CHUNK])
+            for event, elem in parser.read_events():
+                if event == "end":
+                    if path[-2:] == ["representedOrganization", "name"] and not header["manufacturer"]:
+                        header["manufacturer"] = (elem.text or "").strip()
+                    path.pop()
+                    continue
+                tag = elem.tag.replace(V3, "")
+                path.append(tag)
+                if len(path) == 2:
+                    if tag == "setId":
+                        header["setid"] = elem.get("root")
+                    elif tag == "versionNumber":
+                        try:
+                            header["version"] = int(elem.get("value", 0))
+                        except ValueError:
+                            pass
+                    elif tag == "effectiveTime":
+                        header["effective_time"] = elem.get("value", "")
+                    elif tag == "component":
+                        return header if header["setid"] else None
+    except ET.ParseError:
+        return None
+    return header if header["setid"] else None
+
+
+def _title(header: dict, products: list) -> str:
+    """Build a listing title like DailyMed's: NAME (generic) form [Labeler]."""
+    names = list(dict.fromkeys(p.get("name", "").upper() for p in products if p.get("name")))
+    generics = list(dict.fromkeys(p.get("generic_name", "").lower() for p in products if p.get("generic_name")))
+    forms = list(dict.fromkeys(p["form"].lower() for p in products if p.get("form")))
+    title = " and ".join(names) or "UNKNOWN"
+    if generics:
+        title += f" ({', '.join(generics)})"
+    if forms:
+        title += f" {', '.join(forms)}"
+    if header.get("manufacturer"):
+        title += f" [{header['manufacturer']}]"
+    return title
+
+
+# ============ PARSING ============
+
+PRODUCT_FIELDS = ("name", "generic_name", "form", "strength", "inactive_ingredients", "ndcs",
+                  "inactive_unii")
+
+
+def _parse_compact(parse, data: bytes) -> list[tuple]:
+    """Parse one label into plain tuples, which pickle smaller than dicts."""
+    try:
+        products = parse(data)
+    except Exception:
+        return []
+    return [tuple(p.get(field) for field in PRODUCT_FIELDS) for p in products]
+
+
+def _parse_in_worker(parse, data: bytes):
+    """_parse_compact() in a pool worker. Also returns the (name, seconds)
+    timings parse recorded, which would otherwise stay in the worker."""
+    metrics.reset()
+    rows = _parse_compact(parse, data)
+    return rows, [(name, seconds) for name, (_calls, seconds) in metrics.collector().timers.items()]
+
+
+def _from_worker(result) -> list[dict]:
+    rows, timings = result
+    for name, seconds in timings:
+        metrics.collector().timed(name, seconds)
+    return _expand(rows)
+
+
+def _expand(rows: list[tuple]) -> list[dict]:
+    return [dict(zip(PRODUCT_FIELDS, row)) for row in rows]
+
+
+def parse_labels(items, parse, workers: int = 1):
+    """Parse (key, xml_bytes) pairs, yielding (key, products) in input order.
+
+    With workers > 1 the XML is parsed in a process pool. Only a few
+    labels per worker are in flight at a time, so items may be a generator
+    over an archive far larger than memory.
+    """
+    if workers <= 1:
+        for key, data in items:
+            yield key, _expand(_parse_compact(parse, data))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for key, data in items:
+            pending.append((key, pool.submit(_parse_in_worker, parse, data)))
+            if len(pending) >= workers * 4:
+                key, future = pending.popleft()
+                yield key, _from_worker(future.result())
+        while pending:
+            key, future = pending.popleft()
+            yield key, _from_worker(future.result())
+
+
+# ============ STORE ============
+
+class LabelStore:
+    """SQLite-backed store of parsed SPL products."""
+
+    def __init__(self, path: str = None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(products)")}
+        if "inactive_unii" not in columns:
+            self.db.execute("ALTER TABLE products ADD COLUMN inactive_unii TEXT")
+        # Stores imported before the vocabulary table existed
+        if (self.db.execute("SELECT 1 FROM ingredient_names LIMIT 1").fetchone() is None
+                and self.db.execute("SELECT 1 FROM product_ingredients LIMIT 1").fetchone() is not None):
+            self.db.execute("INSERT OR IGNORE INTO ingredient_names "
+                            "SELECT DISTINCT ingredient FROM product_ingredients")
+            self.db.commit()
+
+    @classmethod
+    def open_existing(cls, path: str = None):
+        """Return the store at path, or None if nothing has been imported."""
+        path = path or default_path()
+        if not os.path.exists(path):
+            return None
+        store = cls(path)
+        if store.get_meta("imported_at") is None:
+            return None
+        return store
+
+    def get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM labels").fetchone()[0]
+
+    def product_count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def version(self, setid: str):
+        row = self.db.execute("SELECT version FROM labels WHERE setid = ?", (setid,)).fetchone()
+        return row[0] if row else None
+
+    # ============ IMPORT ============
+
+    def put_label(self, header: dict, products: list, source: str = ""):
+        """Replace everything stored for header["setid"] with products."""
+        setid = header["setid"]
+        for table in ("products", "product_ndcs", "product_ingredients"):
+            self.db.execute(f"DELETE FROM {table} WHERE setid = ?", (setid,))
+        self.db.execute(
+            "INSERT OR REPLACE INTO labels (setid, version, effective_time, title, manufacturer, source) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (setid, header["version"], header["effective_time"], _title(header, products),
+             header["manufacturer"], source))
+        self.db.executemany(
+            "INSERT INTO products (setid, product_index, name, generic_name, form, strength, "
+            "inactive_ingredients, ndcs, inactive_unii) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(setid, idx, p.get("name") or "", p.get("generic_name") or "", p["form"], p["strength"],
+              json.dumps(p["inactive_ingredients"]), json.dumps(p["ndcs"]),
+              json.dumps(p.get("inactive_unii") or []))
+             for idx, p in enumerate(products)])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO product_ndcs (ndc, setid, product_index) VALUES (?, ?, ?)",
+            [(ndc, setid, idx) for idx, p in enumerate(products) for ndc in p["ndcs"]])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO product_ingredients (ingredient, setid, product_index) VALUES (?, ?, ?)",
+            [(normalize_ingredient(name), setid, idx) for idx, p in enumerate(products)
+             for name in p["inactive_ingredients"]])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO ingredient_names (ingredient) VALUES (?)",
+            [(normalize_ingredient(name),) for p in products for name in p["inactive_ingredients"]])
+        self.add_unii_names((name, unii) for p in products
+                            for name, unii in zip(p["inactive_ingredients"], p.get("inactive_unii") or [])
+                            if unii)
+
+    def _is_current(self, header: dict) -> bool:
+        stored = self.version(header["setid"])
+        return stored is not None and stored >= header["version"]
+
+    def import_archive(self, path: str, parse, force: bool = False, workers: int = 1,
+                       verbose: bool = False) -> dict:
+        """Import every SPL document in a release ZIP.
+
+        parse(xml_bytes) returns the product dicts for one label; it must be
+        a module-level function so it can be sent to worker processes. With
+        workers > 1 labels are parsed in that many processes while this one
+        reads the archive and writes the store, in archive order either way.
+        Labels whose stored version is the same or newer are skipped unless
+        force is set. Returns counts of labels read, imported and skipped.
+        """
+        counts = {"read": 0, "imported": 0, "skipped": 0}
+        source = os.path.basename(path)
+
+        def labels():
+            for member, data in iter_spl_documents(path):
+                counts["read"] += 1
+                header = parse_header(data)
+                if header is None or (not force and self._is_current(header)):
+                    counts["skipped"] += 1
+                    continue
+                yield (member, header), data
+
+        for (member, header), products in parse_labels(labels(), parse, workers):
+            # An archive can hold several versions of one label; keep the newest
+            if not products or (not force and self._is_current(header)):
+                if not products and verbose:
+                    print(f"Warning: no products found in {member}", file=sys.stderr)
+                counts["skipped"] += 1
+                continue
+            self.put_label(header, products, source)
+            counts["imported"] += 1
+
+            if counts["imported"] % COMMIT_EVERY == 0:
+                self.db.commit()
+                if verbose:
+                    print(f"{source}: {counts['read']} labels read, {counts['imported']} imported...",
+                          file=sys.stderr)
+
+        self._set_meta("imported_at", str(time.time()))
+        self.db.commit()
+        return counts
+
+    # ============ SYNC ============
+
+    def setids(self) -> list[str]:
+        return [row[0] for row in self.db.execute("SELECT setid FROM labels ORDER BY setid")]
+
+    def _published_since(self, base_url: str, since: str, verbose: bool = False) -> dict:
+        """Return {setid: version} for every label published on or after since."""
+        versions = {}
+        page = 1
+        while True:
+            if verbose:
+                print(f"Listing labels published since {since}, page {page}...", file=sys.stderr)
+            resp = http_client.get(f"{base_url}/spls.json", params={
+                "published_date": since, "published_date_comparison": "gte",
+                "page": page, "pagesize": SYNC_PAGE_SIZE})
+            resp.raise_for_status()
+            data = resp.json()
+            for item in data.get("data", []):
+                versions[item["setid"]] = int(item.get("spl_version") or 0)
+            if page >= data.get("metadata", {}).get("total_pages", 1):
+                return versions
+            page += 1
+
+    def _current_versions(self, base_url: str, setids: list[str], concurrency: int = 1,
+                          engine: str = None) -> dict:
+        """Return {setid: version} as listed by DailyMed, one request per setid."""
+        versions = {}
+        fetched = http_client.get_many(setids, lambda s: (f"{base_url}/spls.json", {"setid": s}, None),
+                                       concurrency=concurrency, engine=engine)
+        for setid, resp in fetched:
+            try:
+                if isinstance(resp, Exception):
+                    raise resp
+                resp.raise_for_status()
+                for item in resp.json().get("data", []):
+                    versions[item["setid"]] = int(item.get("spl_version") or 0)
+            except Exception as e:
+                print(f"Warning: cannot check version of {setid}: {e}", file=sys.stderr)
+        return versions
+
+    def sync(self, base_url: str, parse, setids: list[str] = None, since: str = None,
+             concurrency: int = 1, engine: str = None, verbose: bool = False) -> dict:
+        """Re-download the labels whose DailyMed version is newer than the stored one.
+
+        setids defaults to every stored label; unknown setids are fetched
+        too. Labels published since the last sync (or since, YYYY-MM-DD)
+        are found from the /spls.json listing; on the first sync each
+        label's version is asked for separately. Every request bypasses
+        the response cache and stores the fresh copy, and the process's
+        cache settings are put back afterwards. Returns counts of labels
+        checked, changed and updated.
+
+        The cutoff for the next sync only moves forward after a sync of the
+        whole store that covered everything since the last one; a sync of a
+        few setids leaves it alone, so the rest are still checked next time.
+        """
+        saved = http_client.save_settings()
+        http_client.configure(refresh=True)
+        try:
+            return self._sync(base_url, parse, setids, since, concurrency, engine, verbose)
+        finally:
+            http_client.restore_settings(saved)
+
+    def _sync(self, base_url, parse, setids, since, concurrency, engine, verbose) -> dict:
+        watch = list(dict.fromkeys(setids if setids is not None else self.setids()))
+        started = time.strftime("%Y-%m-%d", time.gmtime())
+        cutoff = self.get_meta("synced_through")
+        whole = setids is None and (since is None or cutoff is None or since <= cutoff)
+        since = since or cutoff
+
+        if since:
+            listed = self._published_since(base_url, since, verbose)
+            stored = {s: self.version(s) for s in watch}
+            changed = [s for s in watch
+                       if stored[s] is None or (s in listed and listed[s] > stored[s])]
+        else:
+            listed = self._current_versions(base_url, watch, concurrency, engine)
+            changed = [s for s in watch
+                       if s in listed and (self.version(s) is None or listed[s] > self.version(s))]
+
+        counts = {"checked": len(watch), "changed": len(changed), "updated": 0}
+
+        def spl_request(setid):
+            if verbose:
+                print(f"Fetching {setid} (version {listed.get(setid, '?')})...", file=sys.stderr)
+            return f"{base_url}/spls/{setid}.xml", None, None, listed.get(setid)
+
+        fetched = http_client.get_many(changed, spl_request, concurrency=concurrency, engine=engine)
+        for setid, resp in fetched:
+            try:
+                if isinstance(resp, Exception):
+                    raise resp
+                resp.raise_for_status()
+            except Exception as e:
+                print(f"Warning: cannot fetch {setid}: {e}", file=sys.stderr)
+                continue
+            header = parse_header(resp.content)
+            products = _expand(_parse_compact(parse, resp.content))
+            if header is None or not products:
+                print(f"Warning: no products found in {setid}", file=sys.stderr)
+                continue
+            self.put_label(header, products, "api")
+            counts["updated"] += 1
+
+        # Only move the cutoff forward once every changed label made it in
+        if whole and counts["updated"] == counts["changed"]:
+            self._set_meta("synced_through", started)
+        self._set_meta("imported_at", str(time.time()))
+        self.db.commit()
+        return counts
+
+    # ============ LOOKUP ============
+
+    def search(self, name: str, limit: int = 0) -> list[dict]:
+        """Return {setid, title, manufacturer} for labels whose product or
+        generic name contains name, ordered by title."""
+        pattern = _like(name.lower())
+        sql = """
+            SELECT setid, title, manufacturer FROM labels WHERE setid IN (
+                SELECT setid FROM products
+                WHERE lower(name) LIKE ? ESCAPE '\\' OR lower(generic_name) LIKE ? ESCAPE '\\'
+            ) ORDER BY title, setid
+        """
+        params = [pattern, pattern]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        keys = ("setid", "title", "manufacturer")
+        return [dict(zip(keys, row)) for row in self.db.execute(sql, params)]
+
+    def products(self, setid: str) -> list[dict]:
+        """Return the stored products of a label in SPL order (empty if unknown)."""
+        rows = self.db.execute(
+            "SELECT name, generic_name, form, strength, inactive_ingredients, ndcs, inactive_unii "
+            "FROM products WHERE setid = ? ORDER BY product_index", (setid,))
+        return [{
+            "name": name,
+            "generic_name": generic,
+            "form": form,
+            "strength": strength,
+            "inactive_ingredients": json.loads(ingredients),
+            "ndcs": json.loads(ndcs),
+            "inactive_unii": json.loads(uniis or "[]"),
+        } for name, generic, form, strength, ingredients, ndcs, uniis in rows]
+
+    def ndcs(self, setid: str) -> list[str]:
+        """Return every package NDC of a label, in product order."""
+        seen = {}
+        for product in self.products(setid):
+            seen.update(dict.fromkeys(product["ndcs"]))
+        return list(seen)
+
+    def by_ndc(self, ndc: str) -> list[tuple[str, int]]:
+        """Return the (setid, product_index) pairs that list an 11-digit NDC."""
+        return self.db.execute("SELECT setid, product_index FROM product_ndcs WHERE ndc = ?",
+                               (ndc,)).fetchall()
+
+    def by_ingredient(self, name: str) -> list[tuple[str, int]]:
+        """Return the (setid, product_index) pairs with an inactive ingredient."""
+        return self.db.execute("SELECT setid, product_index FROM product_ingredients WHERE ingredient = ?",
+                               (normalize_ingredient(name),)).fetchall()
+
+    # ============ UNII SYNONYMS ============
+
+    def add_unii_names(self, pairs):
+        """Record (name, UNII) pairs; names are stored normalized."""
+        self.db.executemany("INSERT OR IGNORE INTO unii_names (name, unii) VALUES (?, ?)",
+                            ((normalize_ingredient(name), unii) for name, unii in pairs))
+
+    def uniis_for(self, excipient: str) -> set[str]:
+        """Return the UNIIs of every known name containing excipient."""
+        return {row[0] for row in self.db.execute(
+            "SELECT DISTINCT unii FROM unii_names WHERE name LIKE ? ESCAPE '\\'",
+            (_like(normalize_ingredient(excipient)),))}
+
+    def names_for(self, codes) -> set[str]:
+        """Return the stored ingredient names recorded with any of codes."""
+        codes = list(codes)
+        if not codes:
+            return set()
+        marks = ", ".join("?" * len(codes))
+        return {row[0] for row in self.db.execute(
+            f"SELECT DISTINCT u.name FROM unii_names u JOIN ingredient_names i ON i.ingredient = u.name "
+            f"WHERE u.unii IN ({marks})", codes)}
+
+    # ============ INGREDIENT INDEX ============
+
+    def ingredient_names(self, excipient: str) -> list[str]:
+        """Return the stored ingredient names that contain excipient.
+
+        This is the same substring match drug filter applies to each
+        record, but done once over the vocabulary of distinct names.
+        """
+        return [row[0] for row in self.db.execute(
+            "SELECT ingredient FROM ingredient_names WHERE ingredient LIKE ? ESCAPE '\\'",
+            (_like(normalize_ingredient(excipient)),))]
+
+    def _postings_sql(self, excipients) -> tuple[str, list]:
+        """SQL selecting (setid, product_index) of products with any of excipients.
+
+        Besides the names containing an excipient, every name that shares
+        a UNII with one of them is included, so synonyms match too.
+        """
+        names = {n for e in excipients for n in self.ingredient_names(e)}
+        codes = {c for e in excipients for c in self.uniis_for(e)}
+        names |= self.names_for(codes)
+        names = sorted(names)
+        marks = ", ".join("?" * len(names)) or "NULL"
+        return (f"SELECT setid, product_index FROM product_ingredients WHERE ingredient IN ({marks})",
+                names)
+
+    def with_excipients(self, excipients) -> set[tuple[str, int]]:
+        """Return the (setid, product_index) pairs containing any of excipients."""
+        sql, params = self._postings_sql(excipients)
+        return set(self.db.execute(sql, params))
+
+    def query(self, name: str = "", exclude=(), include=(), limit: int = 0) -> list[dict]:
+        """Return per-product records whose product or generic name contains
+        name, minus products with any excipient in exclude and, for each
+        excipient in include, restricted to products that have it.
+
+        Excipients are resolved to posting lists in the ingredient index
+        and combined with set operations, so no product's ingredient list
+        is scanned. Records have the same keys as drug ingredients output.
+        """
+        sql = "SELECT setid, product_index FROM products"
+        params = []
+        if name:
+            sql += " WHERE lower(name) LIKE ? ESCAPE '\\' OR lower(generic_name) LIKE ? ESCAPE '\\'"
+            params += [_like(name.lower())] * 2
+        for excipient in include:
+            posting, names = self._postings_sql([excipient])
+            sql += f" INTERSECT {posting}"
+            params += names
+        if exclude:
+            posting, names = self._postings_sql(exclude)
+            sql += f" EXCEPT {posting}"
+            params += names
+
+        sql = f"""
+            SELECT p.setid, l.title, l.manufacturer, p.product_index, p.form, p.strength,
+                   p.inactive_ingredients, p.ndcs, p.inactive_unii
+            FROM ({sql}) AS hit
+            JOIN products p ON p.setid = hit.setid AND p.product_index = hit.product_index
+            JOIN labels l ON l.setid = p.setid
+            ORDER BY l.title, p.setid, p.product_index
+        """
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [{
+            "setid": setid,
+            "title": title,
+            "manufacturer": manufacturer,
+            "product_index": idx,
+            "form": form,
+            "strength": strength,
+            "inactive_ingredients": json.loads(ingredients),
+            "ndcs": json.loads(ndcs),
+            "inactive_unii": json.loads(uniis or "[]"),
+        } for setid, title, manufacturer, idx, form, strength, ingredients, ndcs, uniis
+            in self.db.execute(sql, params)]
+
+
+def open_store(path: str = None) -> LabelStore:
+    """Return the store for --offline use, exiting with a message if it's missing."""
+    store = LabelStore.open_existing(path)
+    if store is None:
+        print(f"Error: no local label store at {path or default_path()}; "
+              "run 'drug db import <zip>' first", file=sys.stderr)
+        sys.exit(1)
+    return store
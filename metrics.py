@@ -0,0 +1,445 @@
+"""
+Per-command measurements for --metrics.
+
+http_client reports every request it makes (by endpoint, with its status,
+size and latency), every cache lookup and every retry; spl times
+parse_products(); drug.py counts the records a command writes, and the
+records each stage reads and writes (the command itself, or each stage of
+`drug run`). When the command finishes, emit() sums these up as one JSON
+line:
+
+    {"command": "ingredients", "wall_ms": ..., "records": ..., "requests": ...,
+     "bytes": ..., "cache": {"hits": ..., "misses": ...}, "retries": ...,
+     "errors": ..., "latency_ms": {"p50": ..., "p95": ..., "p99": ...},
+     "parse": {"calls": ..., "ms": ...},
+     "stages": {"ingredients": {"in": ..., "out": ...}}, "endpoints": {...}}
+
+"requests" counts HTTP exchanges, retries included, and "bytes" their
+(decompressed) bodies; answers from the cache or a --replay recording cost
+neither. --metrics prints the line on stderr; --metrics-file FILE appends
+it to FILE, which every stage of a pipeline can share:
+
+    drug search fluoxetine --metrics-file m.jsonl | drug ingredients --metrics-file m.jsonl
+
+Every command takes these options; XCIPIENT_METRICS=FILE ("-" for
+stderr) turns them on for all of them at once.
+
+The same events also feed Prometheus counters and histograms (see
+FAMILIES), kept per command and for the whole process. `drug serve`
+answers GET /metrics with the process totals, in OpenMetrics text or the
+older Prometheus text format. For scheduled jobs, --textfile-dir DIR (or
+XCIPIENT_TEXTFILE_DIR) adds each command's counts to
+DIR/xcipient_<command>.prom, for node_exporter's textfile collector.
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Endpoint names for request URLs, first match wins
+ENDPOINTS = [
+    (re.compile(r"/spls/[^/]+\.xml$"), "spls/{setid}.xml"),
+    (re.compile(r"/spls/[^/]+/ndcs\.json$"), "spls/{setid}/ndcs.json"),
+    (re.compile(r"/spls/[^/]+/packaging\.json$"), "spls/{setid}/packaging.json"),
+    (re.compile(r"/spls\.json$"), "spls.json"),
+    (re.compile(r"/ndcs\.json$"), "ndcs.json"),
+    (re.compile(r"/datastore/query/"), "nadac"),
+]
+
+PERCENTILES = (50, 95, 99)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PARSE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+COMMAND_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+# Prometheus metric families: name -> (type, help, unit, histogram buckets)
+FAMILIES = {
+    "xcipient_http_requests": (
+        "counter", "HTTP exchanges with DailyMed and NADAC, retries included", None, None),
+    "xcipient_http_response_bytes": (
+        "counter", "Response body bytes received", "bytes", None),
+    "xcipient_http_retries": (
+        "counter", "Requests retried after a 429, a 5xx or a connection error", None, None),
+    "xcipient_http_request_duration_seconds": (
+        "histogram", "Time from sending a request to receiving its response", "seconds", LATENCY_BUCKETS),
+    "xcipient_cache_lookups": (
+        "counter", "Response cache lookups by result (hit or miss)", None, None),
+    "xcipient_parse_duration_seconds": (
+        "histogram", "Time spent parsing one SPL document", "seconds", PARSE_BUCKETS),
+    "xcipient_records": (
+        "counter", "Records written by each command", None, None),
+    "xcipient_stage_records": (
+        "counter", "Records each command or `drug run` stage read (direction=in) or wrote (out)", None, None),
+    "xcipient_commands": (
+        "counter", "Commands run to completion or failure", None, None),
+    "xcipient_command_duration_seconds": (
+        "histogram", "Wall time of each command", "seconds", COMMAND_BUCKETS),
+    "xcipient_command_last_finished_timestamp_seconds": (
+        "gauge", "When each command last finished, as a Unix time", "seconds", None),
+}
+
+
+def endpoint(url: str) -> str:
+    """Name the API endpoint a URL belongs to, e.g. "spls/{setid}.xml"."""
+    path = urlsplit(url).path
+    for pattern, name in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return path or url
+
+
+def service(name: str) -> str:
+    """The upstream an endpoint name belongs to: "dailymed", "nadac" or "other"."""
+    if name == "nadac":
+        return "nadac"
+    return "dailymed" if any(name == n for _p, n in ENDPOINTS) else "other"
+
+
+def percentiles(values) -> dict:
+    """Nearest-rank p50/p95/p99 of values, in milliseconds ({} if empty)."""
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {f"p{p}": round(ordered[max(0, -(-p * len(ordered) // 100) - 1)] * 1000, 1)
+            for p in PERCENTILES}
+
+
+class Registry:
+    """Prometheus counters, gauges and histograms of the families in FAMILIES.
+
+    Series are keyed by (family, labels), labels being a sorted tuple of
+    (name, value) pairs. A histogram series is its per-bucket counts (the
+    last one for +Inf) followed by the sum of the observed values.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, family: str, labels: dict, amount: float = 1):
+        key = (family, tuple(sorted(labels.items())))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def set(self, family: str, labels: dict, value: float):
+        with self.lock:
+            self.series[family, tuple(sorted(labels.items()))] = value
+
+    def observe(self, family: str, labels: dict, value: float):
+        buckets = FAMILIES[family][3]
+        key = (family, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(buckets) + 1) + [0.0]
+            series[next((i for i, le in enumerate(buckets) if value <= le), len(buckets))] += 1
+            series[-1] += value
+
+    def merge(self, other: "Registry"):
+        """Add other's series to these (gauges take other's value)."""
+        with other.lock:
+            items = list(other.series.items())
+        with self.lock:
+            for key, value in items:
+                mine = self.series.get(key)
+                if mine is None or FAMILIES[key[0]][0] == "gauge":
+                    self.series[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(mine, list):
+                    self.series[key] = [a + b for a, b in zip(mine, value)]
+                else:
+                    self.series[key] = mine + value
+
+    def labelled(self, **extra) -> "Registry":
+        """A copy with extra labels added to every series that lacks them."""
+        copy = Registry()
+        with self.lock:
+            for (family, labels), value in self.series.items():
+                names = {k for k, _v in labels}
+                labels = tuple(sorted(labels + tuple((k, v) for k, v in extra.items() if k not in names)))
+                copy.series[family, labels] = list(value) if isinstance(value, list) else value
+        return copy
+
+    def dump(self) -> list:
+        with self.lock:
+            return [[family, [list(pair) for pair in labels], value]
+                    for (family, labels), value in self.series.items()]
+
+    @classmethod
+    def load(cls, data: list) -> "Registry":
+        registry = cls()
+        for family, labels, value in data:
+            if family in FAMILIES:
+                registry.series[family, tuple(tuple(pair) for pair in labels)] = value
+        return registry
+
+    def exposition(self, openmetrics: bool = True) -> str:
+        """Render as OpenMetrics text, or as Prometheus text format 0.0.4."""
+        with self.lock:
+            series = sorted(self.series.items())
+        lines = []
+        for family, (kind, help_text, unit, buckets) in FAMILIES.items():
+            # OpenMetrics names counter families without the _total suffix
+            name = family + "_total" if kind == "counter" and not openmetrics else family
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if unit and openmetrics:
+                lines.append(f"# UNIT {name} {unit}")
+            for (fam, labels), value in series:
+                if fam != family:
+                    continue
+                if kind != "histogram":
+                    sample = family + "_total" if kind == "counter" else family
+                    lines.append(f"{sample}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for le, count in zip(list(buckets) + [float("inf")], value[:-1]):
+                    cumulative += count
+                    bound = "+Inf" if le == float("inf") else repr(float(le))
+                    lines.append(f"{family}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{family}_count{_labels(labels)} {cumulative}")
+                lines.append(f"{family}_sum{_labels(labels)} {_number(value[-1])}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Collector:
+    """Counts for one command. All methods may be called from any thread.
+
+    Besides the raw numbers report() needs, every event goes into the
+    command's own Registry and into the process's (see totals()).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.retries = 0
+        self.errors = 0
+        self.records = 0
+        self.stage = None  # the command, or the `drug run` stage, running now
+        self.stages = {}  # stage -> {"in": records read, "out": records written}
+        self.timers = {}  # name -> [calls, seconds]
+        self.registry = Registry()
+
+    def _count(self, method: str, family: str, labels: dict, value: float = 1):
+        getattr(self.registry, method)(family, labels, value)
+        getattr(_totals, method)(family, labels, value)
+
+    def _endpoint(self, url: str) -> dict:
+        name = endpoint(url)
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = {"requests": 0, "bytes": 0, "statuses": {}, "latencies": [],
+                                            "cache_hits": 0, "cache_misses": 0, "replayed": 0}
+        return stats
+
+    def request(self, url: str, status, seconds: float, size: int = 0):
+        """One HTTP exchange; status is None if it failed to connect or timed out."""
+        with self.lock:
+            stats = self._endpoint(url)
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["latencies"].append(seconds)
+            key = str(status) if status is not None else "error"
+            stats["statuses"][key] = stats["statuses"].get(key, 0) + 1
+            if status is None or status >= 400:
+                self.errors += 1
+        labels = {"service": service(endpoint(url)), "endpoint": endpoint(url)}
+        self._count("inc", "xcipient_http_requests",
+                    dict(labels, status=str(status) if status is not None else "error"))
+        self._count("inc", "xcipient_http_response_bytes", labels, size)
+        self._count("observe", "xcipient_http_request_duration_seconds", labels, seconds)
+
+    def cache(self, url: str, hit: bool):
+        with self.lock:
+            self._endpoint(url)["cache_hits" if hit else "cache_misses"] += 1
+        self._count("inc", "xcipient_cache_lookups",
+                    {"endpoint": endpoint(url), "result": "hit" if hit else "miss"})
+
+    def replayed(self, url: str):
+        with self.lock:
+            self._endpoint(url)["replayed"] += 1
+
+    def retry(self, url: str):
+        with self.lock:
+            self.retries += 1
+        self._count("inc", "xcipient_http_retries", {"service": service(endpoint(url)),
+                                                      "endpoint": endpoint(url)})
+
+    def timed(self, name: str, seconds: float):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+        if name == "parse_products":
+            self._count("observe", "xcipient_parse_duration_seconds", {}, seconds)
+
+    def wrote(self, records: int):
+        with self.lock:
+            self.records += records
+
+    def passed(self, stage: str, direction: str, records: int = 1):
+        """records went into ("in") or out of ("out") stage."""
+        with self.lock:
+            counts = self.stages.setdefault(stage, {"in": 0, "out": 0})
+            counts[direction] += records
+
+    def report(self, command: str) -> dict:
+        """Sum everything up as the dict emit() writes."""
+        with self.lock:
+            endpoints = {}
+            latencies = []
+            for name, stats in sorted(self.endpoints.items()):
+                latencies += stats["latencies"]
+                entry = {k: v for k, v in stats.items() if k != "latencies"}
+                entry["latency_ms"] = percentiles(stats["latencies"])
+                endpoints[name] = entry
+            parse_calls, parse_seconds = self.timers.get("parse_products", (0, 0.0))
+            return {
+                "command": command,
+                "wall_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                "records": self.records,
+                "requests": sum(e["requests"] for e in endpoints.values()),
+                "bytes": sum(e["bytes"] for e in endpoints.values()),
+                "cache": {"hits": sum(e["cache_hits"] for e in endpoints.values()),
+                          "misses": sum(e["cache_misses"] for e in endpoints.values())},
+                "replayed": sum(e["replayed"] for e in endpoints.values()),
+                "retries": self.retries,
+                "errors": self.errors,
+                "latency_ms": percentiles(latencies),
+                "parse": {"calls": parse_calls, "ms": round(parse_seconds * 1000, 1)},
+                "stages": {name: dict(counts) for name, counts in self.stages.items()},
+                "endpoints": endpoints,
+            }
+
+
+# ============ MODULE STATE ============
+
+_totals = Registry()
+_collector = Collector()
+_target = None  # set by --metrics: a file name, or "-" for stderr
+_textfile_dir = None  # set by --textfile-dir
+
+
+def collector() -> Collector:
+    return _collector
+
+
+def totals() -> Registry:
+    """Everything counted since the process started, e.g. for GET /metrics."""
+    return _totals
+
+
+def reset(command: str = None):
+    """Start counting for a new command, forgetting its --metrics options."""
+    global _collector, _target, _textfile_dir
+    _collector = Collector()
+    _collector.stage = command
+    _target = None
+    _textfile_dir = None
+
+
+def configure(target: str = None, textfile_dir: str = None):
+    """At the end of the command, write its report to target (a file name,
+    or "-" for stderr) and add its counts to textfile_dir."""
+    global _target, _textfile_dir
+    if target:
+        _target = target
+    if textfile_dir:
+        _textfile_dir = textfile_dir
+
+
+def add_metrics_args(parser):
+    """Add --metrics/--metrics-file/--textfile-dir to an argparse parser."""
+    parser.add_argument("--metrics", action="store_const", const="-", default=None,
+                        help="Report requests, cache use, latency and timings as a JSON line on stderr")
+    parser.add_argument("--metrics-file", dest="metrics", metavar="FILE",
+                        help="Append that JSON line to FILE instead")
+    parser.add_argument("--textfile-dir", metavar="DIR",
+                        help="Add this command's Prometheus metrics to DIR/xcipient_<command>.prom "
+                             "(for node_exporter's textfile collector)")
+
+
+def apply_metrics_args(opts):
+    """Apply options added by add_metrics_args()."""
+    configure(opts.metrics, opts.textfile_dir)
+
+
+def write_textfile(directory: str, command: str, registry: Registry):
+    """Add registry's counts to DIR/xcipient_<command>.prom.
+
+    The running totals are kept next to it in a hidden JSON file, which the
+    textfile collector ignores, so counters keep growing across runs as
+    Prometheus expects. Every series gets a command label, since the
+    collector rejects a series that appears in two files. The .prom file is
+    replaced atomically.
+    """
+    path = os.path.join(directory, f"xcipient_{command}.prom")
+    state = os.path.join(directory, f".xcipient_{command}.json")
+    merged = Registry()
+    try:
+        with open(state, encoding="utf-8") as f:
+            merged = Registry.load(json.load(f))
+    except (OSError, ValueError):
+        pass
+    merged.merge(registry.labelled(command=command))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for target, text in ((state, json.dumps(merged.dump())), (path, merged.exposition(openmetrics=False))):
+            tmp = f"{target}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, target)
+    except OSError as e:
+        print(f"Warning: could not write metrics to {path}: {e}", file=sys.stderr)
+
+
+def emit(command: str):
+    """Finish counting for command: record it in the registries, then write
+    the report and textfile if --metrics, --textfile-dir or the environment
+    asks for them."""
+    report = _collector.report(command)
+    labels = {"command": command}
+    _collector._count("inc", "xcipient_records", labels, report["records"])
+    for stage, counts in report["stages"].items():
+        for direction, records in counts.items():
+            _collector._count("inc", "xcipient_stage_records", {"stage": stage, "direction": direction}, records)
+    _collector._count("inc", "xcipient_commands", labels)
+    _collector._count("observe", "xcipient_command_duration_seconds", labels, report["wall_ms"] / 1000)
+    _collector._count("set", "xcipient_command_last_finished_timestamp_seconds", labels, round(time.time(), 3))
+
+    textfile_dir = _textfile_dir or os.environ.get("XCIPIENT_TEXTFILE_DIR", "")
+    if textfile_dir:
+        write_textfile(textfile_dir, command, _collector.registry)
+
+    target = _target or os.environ.get("XCIPIENT_METRICS", "")
+    if not target or target == "0":
+        return
+    line = json.dumps(report)
+    if target == "-":
+        print(line, file=sys.stderr, flush=True)
+        return
+    try:
+        with open(target, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"Warning: could not write metrics to {target}: {e}", file=sys.stderr)
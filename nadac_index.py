@@ -0,0 +1,277 @@
+"""
+Local NADAC snapshot index.
+
+`drug nadac sync` pulls the NADAC dataset from the data.medicaid.gov
+datastore page by page into a SQLite file holding one row per 11-digit NDC
+with its most recent price and effective date. Availability checks then
+answer from an in-memory set built from that file instead of issuing one
+HTTP request per NDC.
+
+Later syncs only ask for rows with an effective date on or after the newest
+one already stored. Without a local index, find_in_nadac() checks many NDCs
+per request using the datastore's "in" operator.
+"""
+
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import http_client
+from spl import normalize_ndc
+
+
+# The NADAC dataset's datastore query endpoint, used by every availability
+# check (point this elsewhere to test against a stand-in)
+NADAC_API = "https://data.medicaid.gov/api/1/datastore/query/99315a95-37ac-4eee-946a-3c523b4c481e/0"
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_BATCH_SIZE = 100
+STALE_AFTER_DAYS = 14
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nadac (
+    ndc TEXT PRIMARY KEY,
+    description TEXT,
+    nadac_per_unit REAL,
+    pricing_unit TEXT,
+    effective_date TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_path() -> str:
+    return os.path.join(http_client.default_cache_dir(), "nadac.sqlite")
+
+
+def _iso_date(value: str) -> str:
+    """Normalize MM/DD/YYYY to YYYY-MM-DD; other formats pass through."""
+    m = re.match(r"(\d{1,2})/(\d{1,2})/(\d{4})", value or "")
+    if m:
+        return f"{m.group(3)}-{int(m.group(1)):02d}-{int(m.group(2)):02d}"
+    return (value or "")[:10]
+
+
+class NadacIndex:
+    """SQLite-backed NADAC snapshot with an in-memory NDC set for lookups."""
+
+    def __init__(self, path: str = None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._ndcs = None
+
+    @classmethod
+    def open_existing(cls, path: str = None):
+        """Return the index at path, or None if it has never been synced."""
+        path = path or default_path()
+        if not os.path.exists(path):
+            return None
+        index = cls(path)
+        if index.get_meta("synced_at") is None:
+            return None
+        return index
+
+    def get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def is_stale(self) -> bool:
+        synced_at = float(self.get_meta("synced_at") or 0)
+        return time.time() - synced_at > STALE_AFTER_DAYS * 86400
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM nadac").fetchone()[0]
+
+    # ============ LOOKUP ============
+
+    def contains(self, ndc: str) -> bool:
+        if self._ndcs is None:
+            self._ndcs = frozenset(row[0] for row in self.db.execute("SELECT ndc FROM nadac"))
+        return normalize_ndc(ndc) in self._ndcs
+
+    def find(self, ndcs: list[str]) -> list[str]:
+        """Return the NDCs from ndcs that are in NADAC, in input order."""
+        return [ndc for ndc in ndcs if self.contains(ndc)]
+
+    def lookup(self, ndc: str):
+        """Return the stored row for an NDC as a dict, or None."""
+        row = self.db.execute(
+            "SELECT ndc, description, nadac_per_unit, pricing_unit, effective_date FROM nadac WHERE ndc = ?",
+            (normalize_ndc(ndc),)).fetchone()
+        if row is None:
+            return None
+        keys = ("ndc", "description", "nadac_per_unit", "pricing_unit", "effective_date")
+        return dict(zip(keys, row))
+
+    # ============ SYNC ============
+
+    def sync(self, api_url: str = None, page_size: int = DEFAULT_PAGE_SIZE,
+             full: bool = False, verbose: bool = False) -> int:
+        """Download NADAC rows into the index. Returns the number of rows read.
+
+        Unless full is set, only rows effective on or after the newest stored
+        effective date are requested, sorted by NDC and date so that pages
+        don't overlap or skip rows. Paging stops at the first empty page,
+        since the server may return fewer rows than page_size asks for.
+        """
+        api_url = api_url or NADAC_API
+        since = None if full else self.get_meta("last_effective_date")
+        if full:
+            self.db.execute("DELETE FROM nadac")
+
+        newest = since or ""
+        offset = 0
+        total = 0
+        while True:
+            # Paging by offset needs an order that can't change between pages
+            params = {"limit": page_size, "offset": offset,
+                      "sorts[0][property]": "ndc", "sorts[0][order]": "asc",
+                      "sorts[1][property]": "effective_date", "sorts[1][order]": "asc"}
+            if since:
+                params.update({
+                    "conditions[0][property]": "effective_date",
+                    "conditions[0][operator]": ">=",
+                    "conditions[0][value]": since,
+                })
+            if verbose:
+                print(f"Fetching NADAC rows {offset}-{offset + page_size}...", file=sys.stderr)
+
+            resp = http_client.get(api_url, params=params, timeout=60, cache=False)
+            resp.raise_for_status()
+            results = resp.json().get("results", [])
+
+            rows = []
+            for rec in results:
+                ndc = rec.get("ndc", "")
+                if not ndc:
+                    continue
+                effective = _iso_date(rec.get("effective_date", ""))
+                newest = max(newest, effective)
+                try:
+                    price = float(rec.get("nadac_per_unit") or 0)
+                except ValueError:
+                    price = None
+                rows.append((normalize_ndc(ndc), rec.get("ndc_description", ""), price,
+                             rec.get("pricing_unit", ""), effective))
+
+            # Keep only the most recent price per NDC
+            self.db.executemany("""
+                INSERT INTO nadac (ndc, description, nadac_per_unit, pricing_unit, effective_date)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(ndc) DO UPDATE SET
+                    description = excluded.description,
+                    nadac_per_unit = excluded.nadac_per_unit,
+                    pricing_unit = excluded.pricing_unit,
+                    effective_date = excluded.effective_date
+                WHERE excluded.effective_date >= nadac.effective_date
+            """, rows)
+
+            if not results:
+                break
+            total += len(results)
+            offset += len(results)
+
+        if newest:
+            self._set_meta("last_effective_date", newest)
+        self._set_meta("synced_at", str(time.time()))
+        self.db.commit()
+        self._ndcs = None
+        return total
+
+
+_shared = {}
+
+
+def shared_index():
+    """Return the default on-disk index, or None if it hasn't been synced.
+
+    The index is opened once per process, and again if the file changes,
+    so a long-running `drug serve` sees later syncs.
+    """
+    path = default_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    if "index" not in _shared or _shared["mtime"] != mtime:
+        _shared["index"] = NadacIndex.open_existing(path) if mtime is not None else None
+        _shared["mtime"] = mtime
+    return _shared["index"]
+
+
+def _batch_params(ndcs: list[str], offset: int = 0) -> dict:
+    params = {
+        "conditions[0][property]": "ndc",
+        "conditions[0][operator]": "in",
+        "properties[0]": "ndc",
+        "groupings[0]": "ndc",
+        "limit": len(ndcs),
+        "offset": offset,
+    }
+    for i, ndc in enumerate(ndcs):
+        params[f"conditions[0][value][{i}]"] = ndc
+    return params
+
+
+def _batch_results(ndcs: list[str], resp, api_url: str, found: set):
+    """Add the NDCs found for one batch to found, following extra pages if
+    needed. A failed page raises, but what earlier pages found is kept."""
+    seen = set()
+    offset = 0
+    while True:
+        resp.raise_for_status()
+        results = resp.json().get("results", [])
+        page = {normalize_ndc(rec["ndc"]) for rec in results if rec.get("ndc")}
+        seen |= page
+        found |= page
+        # Each NDC has one row per price week unless the server groups them
+        if len(results) < len(ndcs) or len(seen) == len(ndcs):
+            return
+        offset += len(results)
+        resp = http_client.get(api_url, params=_batch_params(ndcs, offset))
+
+
+def find_in_nadac(ndcs: list[str], api_url: str = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE, use_index: bool = True,
+                  concurrency: int = 1, engine: str = None) -> list[str]:
+    """Return the NDCs from ndcs that are in NADAC, in input order.
+
+    Answers from the local index when it exists (and use_index is set);
+    otherwise queries the API with up to batch_size NDCs per request and up
+    to concurrency requests at once. NDCs of a batch that fails are counted
+    as not found, with a warning on stderr.
+    """
+    api_url = api_url or NADAC_API
+    index = shared_index() if use_index else None
+    if index is not None:
+        return index.find(ndcs)
+
+    import requests
+
+    unique = list(dict.fromkeys(normalize_ndc(n) for n in ndcs))
+    batches = [unique[i:i + batch_size] for i in range(0, len(unique), batch_size)]
+    found = set()
+    fetched = http_client.get_many(batches, lambda b: (api_url, _batch_params(b), None),
+                                   concurrency=concurrency, engine=engine)
+    for batch, resp in fetched:
+        # get_many() hands back the failed request's exception, whichever engine made it
+        error = resp if isinstance(resp, Exception) else None
+        if error is None:
+            try:
+                _batch_results(batch, resp, api_url, found)
+            except (requests.RequestException, ValueError) as e:
+                error = e
+        if error is not None:
+            missing = len(set(batch) - found)
+            print(f"Warning: NADAC check of {len(batch)} NDC(s) failed ({error}); "
+                  f"{missing} not confirmed are reported as not in NADAC", file=sys.stderr)
+    return [ndc for ndc in ndcs if normalize_ndc(ndc) in found]
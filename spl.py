@@ -0,0 +1,209 @@
+"""
+SPL (Structured Product Labeling) XML parsing.
+
+One label's XML holds everything the tools need about its products: the
+dosage form, strength and route, the active and inactive ingredients with
+their UNIIs, and the package NDCs. parse_products() pulls those out of the
+<subject> blocks with an incremental parser, so both `drug` and
+dailymed_search.py get them from a single download per label.
+"""
+
+import time
+
+import metrics
+
+# SPL XML namespace
+NS = {"v3": "urn:hl7-org:v3"}
+NDC_SYSTEM = "2.16.840.1.113883.6.69"
+UNII_SYSTEM = "2.16.840.1.113883.4.9"
+
+# Bytes handed to the SPL parser at a time
+PARSE_CHUNK = 64 * 1024
+
+# Active ingredient classCodes: by base, by moiety, by reference
+ACTIVE_CLASSES = ("ACTIB", "ACTIM", "ACTIR")
+
+
+def normalize_ndc(ndc):
+    """Normalize an NDC to 11-digit format."""
+    if "-" in ndc:
+        p = ndc.split("-")
+        if len(p) == 3:
+            return p[0].zfill(5) + p[1].zfill(4) + p[2].zfill(2)
+    return ndc.replace("-", "").zfill(11)
+
+
+def _tag(name):
+    return f"{{{NS['v3']}}}{name}"
+
+
+def _quantity(ing):
+    """Format an ingredient's <quantity> as DailyMed does, e.g. "20 mg/5 mL"."""
+    num = ing.find(f"{_tag('quantity')}/{_tag('numerator')}")
+    if num is None or not num.get("value"):
+        return ""
+    text = f"{num.get('value')} {num.get('unit', '')}".strip()
+    den = ing.find(f"{_tag('quantity')}/{_tag('denominator')}")
+    if den is not None and den.get("value"):
+        unit = den.get("unit", "")
+        text += f"/{den.get('value')}" + (f" {unit}" if unit and unit != "1" else "")
+    return text
+
+
+def _product_from_subject(subj):
+    """Extract form, strength, route, ingredients and NDCs from one <subject>.
+
+    Returns None if the subject has no manufacturedProduct.
+    """
+    prod = subj.find(f".//{_tag('manufacturedProduct')}")
+    if prod is None:
+        return None
+
+    # Names: the first <name> is the product's own, then the generic's
+    name_el = prod.find(f".//{_tag('name')}")
+    product_name = (name_el.text or "").strip() if name_el is not None else ""
+    generic_el = prod.find(f".//{_tag('genericMedicine')}/{_tag('name')}")
+    generic = (generic_el.text or "").strip() if generic_el is not None else ""
+
+    # Form: <formCode displayName="CAPSULE" .../>
+    form_el = prod.find(f".//{_tag('formCode')}")
+    form = form_el.get("displayName", "") if form_el is not None else ""
+
+    # Route: <consumedIn><substanceAdministration><routeCode displayName="ORAL"/>
+    route_el = subj.find(f".//{_tag('routeCode')}")
+    route = route_el.get("displayName", "") if route_el is not None else ""
+
+    # Strength: first <numerator> with a real unit (not "1")
+    strength = ""
+    for num in prod.iter(_tag("numerator")):
+        unit = num.get("unit", "")
+        val = num.get("value", "")
+        if unit and unit != "1" and val:
+            strength = f"{val} {unit}"
+            break
+
+    # Ingredients: <ingredient classCode="IACT"> (inactive) or ACTIB/ACTIM/ACTIR
+    # (active) -> <name>, plus the substance's UNII:
+    # <code codeSystem="2.16.840.1.113883.4.9" code="..."/>
+    ingredients = []
+    uniis = []
+    active = []
+    seen = set()
+    for ing in prod.iter(_tag("ingredient")):
+        class_code = ing.get("classCode")
+        if class_code in ACTIVE_CLASSES:
+            name_el = ing.find(f"{_tag('ingredientSubstance')}/{_tag('name')}")
+            if name_el is not None and name_el.text:
+                active.append({"name": name_el.text.strip(), "strength": _quantity(ing)})
+            continue
+        if class_code != "IACT":
+            continue
+        name_el = ing.find(f".//{_tag('name')}")
+        if name_el is not None and name_el.text:
+            name = name_el.text.strip()
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                ingredients.append(name)
+                code_el = ing.find(f".//{_tag('code')}[@codeSystem='{UNII_SYSTEM}']")
+                uniis.append(code_el.get("code", "") if code_el is not None else "")
+
+    # NDCs: <code codeSystem="2.16.840.1.113883.6.69" code="..."/>
+    # Only keep 3-segment NDCs (with two dashes)
+    ndcs = []
+    ndc_seen = set()
+    for code_el in subj.iter(_tag("code")):
+        if code_el.get("codeSystem") == NDC_SYSTEM:
+            raw = code_el.get("code", "")
+            if raw.count("-") == 2 and raw not in ndc_seen:
+                ndc_seen.add(raw)
+                ndcs.append(normalize_ndc(raw))
+
+    return {
+        "name": product_name,
+        "generic_name": generic,
+        "form": form,
+        "strength": strength,
+        "route": route,
+        "active_ingredients": active,
+        "inactive_ingredients": ingredients,
+        "ndcs": ndcs,
+        "inactive_unii": uniis,
+    }
+
+
+def _chunks(source):
+    """Yield pieces of an XML document given as str, bytes or a readable file."""
+    if isinstance(source, (str, bytes)):
+        for i in range(0, len(source), PARSE_CHUNK):
+            yield source[i:i + PARSE_CHUNK]
+        return
+    while True:
+        chunk = source.read(PARSE_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_products(xml_text):
+    """Parse per-product data from SPL XML subject blocks.
+
+    xml_text may be a str, bytes or a binary file object; it is fed to an
+    incremental parser in chunks. Only <subject> subtrees are kept until
+    they are processed; everything else (the narrative sections that make
+    up most of a label) is cleared as soon as it has been parsed, so no
+    element tree of the whole label is built. The callers pass the body
+    http_client.get() has already read in full (it has to, to cache it),
+    so parsing does not overlap the download and the body itself is still
+    held in memory; only a file object is read a chunk at a time.
+
+    Returns a list of dicts with keys: name, generic_name, form, strength,
+    route, active_ingredients (dicts with name and strength),
+    inactive_ingredients, ndcs, inactive_unii (the UNII of each inactive
+    ingredient, or "" where the label gives none).
+    Returns empty list if parsing fails (caller should fall back).
+    The time spent is reported by --metrics.
+    """
+    start = time.perf_counter()
+    try:
+        return _parse_products(xml_text)
+    finally:
+        metrics.collector().timed("parse_products", time.perf_counter() - start)
+
+
+def _parse_products(xml_text):
+    import xml.etree.ElementTree as ET  # here so normalize_ndc() users skip it
+    subject = _tag("subject")
+    parser = ET.XMLPullParser(events=("start", "end"))
+    products = []
+    depth = 0  # number of open <subject> elements
+
+    def drain():
+        nonlocal depth
+        for event, elem in parser.read_events():
+            if elem.tag == subject:
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth:
+                    continue
+                # Each <subject> contains one manufacturedProduct (one strength);
+                # nested subjects are handled in document order like the outer one
+                for subj in elem.iter(subject):
+                    product = _product_from_subject(subj)
+                    if product is not None:
+                        products.append(product)
+                elem.clear()
+            elif event == "end" and not depth:
+                elem.clear()
+
+    try:
+        for chunk in _chunks(xml_text):
+            parser.feed(chunk)
+            drain()
+        parser.close()
+        drain()
+    except ET.ParseError:
+        return []
+
+    return products
@@ -0,0 +1,493 @@
+"""Offline tests, run against upstream_stub.py instead of DailyMed and NADAC.
+
+    python test_offline.py
+
+The stub serves the same generated corpus on every run, on a local port,
+and the response cache and local stores go to a temporary directory, so
+the results don't depend on the network or on what was cached before.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import upstream_stub
+
+LABELS = 40
+
+_stub = {}
+
+
+def stub():
+    """Start the stub once and point the tools at it; returns its Corpus."""
+    if not _stub:
+        import dailymed_search
+        import drug
+        import http_client
+        import nadac_index
+        workdir = tempfile.mkdtemp(prefix="xcipient-test-")
+        os.environ["XCIPIENT_CACHE_DIR"] = workdir
+        for key in ("XCIPIENT_NDJSON", "XCIPIENT_METRICS", "XCIPIENT_TEXTFILE_DIR"):
+            os.environ.pop(key, None)
+        http_client.configure(rate=0, cache_dir=os.path.join(workdir, "http"))
+
+        corpus = upstream_stub.Corpus(LABELS)
+        server = upstream_stub.make_server(corpus)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        drug.BASE_URL = dailymed_search.BASE_URL = url + upstream_stub.DAILYMED_PATH
+        nadac_index.NADAC_API = url + upstream_stub.NADAC_PATH
+        _stub.update(corpus=corpus, server=server, workdir=workdir)
+    return _stub["corpus"]
+
+
+def test_nadac_paths():
+    """Test 1: find_in_nadac() answers the same from the index as from batched queries."""
+    print("\n1. Testing NADAC lookups (local index vs batched API queries)...")
+    import nadac_index
+    corpus = stub()
+    products = [p for label in corpus.labels for p in label["products"]]
+    # Dashed as the labels give them, with a few repeats
+    ndcs = [ndc for p in products for ndc in p["ndcs"]]
+    ndcs += ndcs[:5]
+    priced = {ndc for p in products for ndc in p["nadac"]}
+    expected = [ndc for ndc in ndcs if ndc in priced]
+
+    try:
+        batched = nadac_index.find_in_nadac(ndcs, batch_size=7, use_index=False, concurrency=4)
+        if batched != expected:
+            print(f"   FAIL - batched queries found {len(batched)} of {len(expected)} priced NDCs")
+            return False
+
+        # Smaller pages than the datastore's, so sync has to follow them all
+        rows = nadac_index.NadacIndex().sync(page_size=50)
+        if rows != len(corpus.nadac):
+            print(f"   FAIL - sync read {rows} rows, the stub has {len(corpus.nadac)}")
+            return False
+        indexed = nadac_index.find_in_nadac(ndcs)
+        if indexed != expected:
+            print(f"   FAIL - the index found {len(indexed)} of {len(expected)} priced NDCs")
+            return False
+        print(f"   OK - Both found the same {len(expected)} of {len(ndcs)} NDCs")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_record_writer():
+    """Test 2: _RecordWriter writes what json.dump(indent=2) would, one record at a time."""
+    print("\n2. Testing streamed JSON output (array and NDJSON)...")
+    import io
+    import json
+    import drug
+    cases = [
+        [],
+        [{"setid": "a", "ndcs": []}],
+        [{"title": "CAF\u00c9 \"X\" [Y]", "inactive_ingredients": ["TALC", "GELATIN"],
+          "nested": {"list": [1, 2.5, None, True], "empty": {}}}] * 3,
+    ]
+
+    try:
+        for records in cases:
+            out = io.StringIO()
+            writer = drug._RecordWriter(out)
+            for record in records:
+                writer.write(record)
+            writer.close()
+            if out.getvalue() != json.dumps(records, indent=2):
+                print(f"   FAIL - array output differs for {len(records)} record(s)")
+                return False
+
+            out = io.StringIO()
+            writer = drug._RecordWriter(out, ndjson=True)
+            for record in records:
+                writer.write(record)
+            writer.close()
+            if out.getvalue() != "".join(json.dumps(r) + "\n" for r in records):
+                print(f"   FAIL - NDJSON output differs for {len(records)} record(s)")
+                return False
+            parsed, ndjson = drug._read_records(io.StringIO(out.getvalue()))
+            if list(parsed) != records or (records and not ndjson):
+                print(f"   FAIL - NDJSON of {len(records)} record(s) doesn't read back")
+                return False
+        print(f"   OK - {len(cases)} record lists written byte-identically")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_parse_products():
+    """Test 3: parse_products() agrees with a full-tree parse and with the old
+    packaging.json, ndcs.json and ingredient-regex path."""
+    print("\n3. Testing incremental SPL parsing...")
+    import html
+    import io
+    import xml.etree.ElementTree as ET
+    import dailymed_search
+    import spl
+    corpus = stub()
+    chunk = spl.PARSE_CHUNK
+    spl.PARSE_CHUNK = 997  # split subjects across many feeds
+
+    try:
+        for label in corpus.labels:
+            setid, xml = label["listing"]["setid"], label["xml"]
+            products = spl.parse_products(io.BytesIO(xml))
+            whole = [spl._product_from_subject(subj) for subj in ET.fromstring(xml).iter(spl._tag("subject"))]
+            if products != [p for p in whole if p is not None] or spl.parse_products(xml.decode()) != products:
+                print(f"   FAIL - {setid}: differs from the full-tree parse")
+                return False
+
+            packaging = dailymed_search.get_packaging_info(setid)
+            active = [p["active_ingredients"] for p in packaging["products"]]
+            if [p["active_ingredients"] for p in products] != active:
+                print(f"   FAIL - {setid}: active ingredients differ from packaging.json")
+                return False
+            ndcs = [n for p in products for n in p["ndcs"]]
+            if ndcs != dailymed_search.get_dailymed_ndcs(setid):
+                print(f"   FAIL - {setid}: NDCs differ from ndcs.json")
+                return False
+            # The regex leaves entities as they are, e.g. "FD&amp;C BLUE NO. 1"
+            inactive = list(dict.fromkeys(n for p in products for n in p["inactive_ingredients"]))
+            regex = [html.unescape(i["name"]) for i in dailymed_search.get_inactive_ingredients(setid)]
+            if inactive != regex:
+                print(f"   FAIL - {setid}: inactive ingredients differ from the XML")
+                return False
+        print(f"   OK - {len(corpus.labels)} labels parse the same every way")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+    finally:
+        spl.PARSE_CHUNK = chunk
+
+
+def test_store_query():
+    """Test 4: LabelStore.query() keeps the products drug filter would."""
+    print("\n4. Testing label store queries (include/exclude)...")
+    import excipients
+    import label_store
+    import spl
+    corpus = stub()
+    store = label_store.LabelStore(os.path.join(_stub["workdir"], "labels.sqlite"))
+    for label in corpus.labels:
+        store.put_label(label_store.parse_header(label["xml"]), spl.parse_products(label["xml"]))
+    store.add_unii_names(excipients.builtin_pairs())
+    store.db.commit()
+    resolver = excipients.Resolver(store)
+
+    # (exclude, include); "sunset yellow" and "1,2-propanediol" only match by UNII
+    cases = [(["talc"], []), ([], ["lactose"]), (["sunset yellow"], []),
+             (["1,2-propanediol", "gelatin"], ["lactose", "silica"])]
+    try:
+        everything = store.query(upstream_stub.SEARCH_TERM)
+        if len(everything) != store.product_count():
+            print(f"   FAIL - name query found {len(everything)} of {store.product_count()} products")
+            return False
+        for exclude, include in cases:
+            dropped = excipients.Matcher(exclude, resolver)
+            expected = [r for r in everything if not (exclude and dropped.matches(r))
+                        and all(excipients.Matcher([i], resolver).matches(r) for i in include)]
+            found = store.query(upstream_stub.SEARCH_TERM, exclude=exclude, include=include)
+            if found != expected or not 0 < len(found) < len(everything):
+                print(f"   FAIL - -x {exclude} -i {include}: {len(found)} products, expected {len(expected)}")
+                return False
+        print(f"   OK - {len(cases)} queries match a scan of {len(everything)} products")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_pattern_set():
+    """Test 5: PatternSet.search() agrees with testing each pattern with `in`."""
+    print("\n5. Testing multi-pattern search (Aho-Corasick)...")
+    import random
+    import excipients
+    rng = random.Random(0)
+
+    def word(alphabet, longest):
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, longest)))
+
+    # A small alphabet, so patterns overlap and share prefixes and suffixes
+    texts = [word("abc ", 40) for _ in range(500)] + [""]
+    names = [name for synonyms in excipients.SYNONYMS.values() for name in synonyms]
+    sets = [[], [""], ["ab", "b"], [word("abc", 4) for _ in range(8)],
+            [word("abc", 7) for _ in range(excipients.AUTOMATON_MIN_PATTERNS + 8)], names,
+            # Enough for the automaton; "bc" only ever ends inside "abca"'s path
+            ["abca", "bc"] + ["c" * n for n in range(10, 10 + excipients.AUTOMATON_MIN_PATTERNS)]]
+    # Ingredient lists, and near misses of them
+    lists = ["; ".join(rng.sample(names, 3)) for _ in range(100)]
+    texts += lists + [text.replace("o", "0") for text in lists]
+
+    try:
+        # Once as installed, once with the Python automaton (pyahocorasick hidden)
+        for hidden in (False, True):
+            saved = sys.modules.get("ahocorasick")
+            if hidden:
+                sys.modules["ahocorasick"] = None
+            try:
+                compiled = [excipients.PatternSet(patterns) for patterns in sets]
+            finally:
+                if hidden:
+                    if saved is None:
+                        del sys.modules["ahocorasick"]
+                    else:
+                        sys.modules["ahocorasick"] = saved
+            for patterns, pattern_set in zip(sets, compiled):
+                for text in texts:
+                    if pattern_set.search(text) != any(p in text for p in patterns):
+                        print(f"   FAIL - {len(patterns)} patterns, text {text!r}")
+                        return False
+        print(f"   OK - {len(sets)} pattern sets agree on {len(texts)} texts")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_run_pipeline():
+    """Test 6: `drug run` prints what the same stages print as a shell pipeline."""
+    print("\n6. Testing drug run against a shell pipeline...")
+    import shlex
+    import drug
+    corpus = stub()
+    term = upstream_stub.SEARCH_TERM
+    ndcs = [label["products"][0]["ndcs"][0] for label in corpus.labels[:3]]
+    pipelines = [
+        [["search", term], ["ingredients", "-j", "4"], ["filter", "talc"], ["ndcs"], ["nadac"],
+         ["fmt", "-f", "csv"]],
+        [["search", term, "-n", "10"], ["ingredients"], ["filter", "--keep", "lactose"], ["fmt", "-f", "json"]],
+        [["search", term, "--ndjson"], ["ingredients"], ["nadac", "--online"], ["fmt"]],
+        [["search", term], ["ingredients"], ["compare", *ndcs], ["fmt"]],
+    ]
+
+    try:
+        for stages in pipelines:
+            # Each stage reads the text the previous one printed, as through a pipe
+            piped = ""
+            for argv in stages:
+                status, piped, err = drug._execute(argv, stdin=piped)
+                if status:
+                    print(f"   FAIL - drug {shlex.join(argv)} exited {status}: {err.strip()}")
+                    return False
+            line = " | ".join(shlex.join(argv) for argv in stages)
+            status, out, err = drug._execute(["run", line])
+            if status or out != piped:
+                print(f"   FAIL - drug run \"{line}\" differs (exit {status}) {err.strip()}")
+                return False
+            if not piped.strip():
+                print(f"   FAIL - {line}: no output")
+                return False
+        print(f"   OK - {len(pipelines)} pipelines print the same in one process")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_metrics_text():
+    """Test 7: metrics percentiles, exposition text and textfile counters."""
+    print("\n7. Testing metrics (percentiles, OpenMetrics and Prometheus text)...")
+    import math
+    import random
+    import metrics
+    stub()
+    rng = random.Random(0)
+
+    try:
+        for n in (1, 2, 7, 100, 1001):
+            values = [rng.uniform(0, 2) for _ in range(n)]
+            ordered = sorted(values)
+            expected = {f"p{p}": round(ordered[math.ceil(p * n / 100) - 1] * 1000, 1)
+                        for p in metrics.PERCENTILES}
+            if metrics.percentiles(values) != expected:
+                print(f"   FAIL - percentiles of {n} values: {metrics.percentiles(values)} != {expected}")
+                return False
+        if metrics.percentiles([]) != {}:
+            print("   FAIL - percentiles of nothing should be {}")
+            return False
+
+        # The label value holds a quote, a backslash and a newline, which must be escaped
+        registry = metrics.Registry()
+        registry.inc("xcipient_records", {"command": 'say "hi"\\\n'}, 3)
+        registry.observe("xcipient_parse_duration_seconds", {}, 0.002)
+        registry.observe("xcipient_parse_duration_seconds", {}, 0.2)
+        registry.set("xcipient_command_last_finished_timestamp_seconds", {"command": "fmt"}, 1.5)
+        openmetrics = registry.exposition().splitlines()
+        expected = [
+            "# TYPE xcipient_records counter",
+            'xcipient_records_total{command="say \\"hi\\"\\\\\\n"} 3',
+            "# UNIT xcipient_parse_duration_seconds seconds",
+            'xcipient_parse_duration_seconds_bucket{le="0.001"} 0',
+            'xcipient_parse_duration_seconds_bucket{le="0.005"} 1',
+            'xcipient_parse_duration_seconds_bucket{le="0.25"} 2',
+            'xcipient_parse_duration_seconds_bucket{le="+Inf"} 2',
+            "xcipient_parse_duration_seconds_count 2",
+            "xcipient_parse_duration_seconds_sum 0.202",
+            'xcipient_command_last_finished_timestamp_seconds{command="fmt"} 1.5',
+        ]
+        missing = [line for line in expected if line not in openmetrics]
+        if missing or openmetrics[-1] != "# EOF":
+            print(f"   FAIL - OpenMetrics text lacks {missing or ['# EOF']}")
+            return False
+        prometheus = registry.exposition(openmetrics=False).splitlines()
+        if ("# TYPE xcipient_records_total counter" not in prometheus
+                or expected[1] not in prometheus
+                or any(line.startswith(("# UNIT", "# EOF")) for line in prometheus)):
+            print("   FAIL - Prometheus text format is wrong")
+            return False
+
+        # Counters keep rising from one run to the next; gauges are replaced
+        directory = os.path.join(_stub["workdir"], "textfile")
+        for stamp in (1.5, 2.5):
+            run = metrics.Registry()
+            run.inc("xcipient_records", {}, 3)
+            run.set("xcipient_command_last_finished_timestamp_seconds", {}, stamp)
+            metrics.write_textfile(directory, "fmt", run)
+        with open(os.path.join(directory, "xcipient_fmt.prom"), encoding="utf-8") as f:
+            text = f.read().splitlines()
+        if ('xcipient_records_total{command="fmt"} 6' not in text
+                or 'xcipient_command_last_finished_timestamp_seconds{command="fmt"} 2.5' not in text):
+            print("   FAIL - textfile counters don't add up across runs")
+            return False
+        print("   OK - Percentiles, both text formats and textfile totals are right")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_stage_records():
+    """Test 8: --metrics counts the records each stage reads and writes."""
+    print("\n8. Testing per-stage record counts...")
+    import json
+    import drug
+    stub()
+    term = upstream_stub.SEARCH_TERM
+    directory = os.path.join(_stub["workdir"], "stages")
+    env = {"XCIPIENT_METRICS": "-", "XCIPIENT_TEXTFILE_DIR": directory}
+
+    try:
+        status, out, err = drug._execute(["run", f"search {term} -n 12 | ingredients | filter talc | fmt -f csv"],
+                                         env=env)
+        report = json.loads(err.strip().splitlines()[-1])
+        stages = report["stages"]
+        rows = len(out.splitlines()) - 1  # CSV header
+        chained = [stages["search"]["out"] == 12, stages["ingredients"]["in"] == 12,
+                   stages["filter"]["in"] == stages["ingredients"]["out"],
+                   stages["fmt"]["in"] == stages["filter"]["out"] == rows, stages["fmt"]["out"] == rows,
+                   report["records"] == rows, 0 < rows < stages["ingredients"]["out"]]
+        if status or not all(chained):
+            print(f"   FAIL - run stages counted {stages}, {rows} rows printed")
+            return False
+
+        status, out, err = drug._execute(["fmt"], stdin=json.dumps([{"manufacturer": "X"}] * 4), env=env)
+        if json.loads(err.strip().splitlines()[-1])["stages"] != {"fmt": {"in": 4, "out": 0}}:
+            print(f"   FAIL - fmt summary counted {err.strip()}")
+            return False
+
+        with open(os.path.join(directory, "xcipient_run.prom"), encoding="utf-8") as f:
+            text = f.read()
+        if f'xcipient_stage_records_total{{command="run",direction="out",stage="search"}} 12' not in text:
+            print("   FAIL - stage counts missing from the textfile")
+            return False
+        status, out, err = drug._execute(["fmt"], stdin="[]", env=env, trusted=False)
+        if status != 2 or "XCIPIENT_TEXTFILE_DIR" not in err:
+            print("   FAIL - a TCP request may set XCIPIENT_TEXTFILE_DIR")
+            return False
+        print(f"   OK - {len(stages)} stages counted, textfile written, TCP refused")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def test_cache_rewrites():
+    """Test 9: rewriting a cache entry doesn't count its bytes twice."""
+    print("\n9. Testing cache size accounting on rewrites...")
+    from types import SimpleNamespace
+    import http_client
+    stub()
+    cache = http_client.ResponseCache(os.path.join(_stub["workdir"], "rewrites"), 16 * 1024)
+    resp = SimpleNamespace(status_code=200, headers={}, encoding="utf-8", content=b"x" * 1024)
+    urls = [f"https://example.test/{i}" for i in range(6)]
+
+    try:
+        for url in urls:
+            cache.put(url, {}, resp)
+        # An expired entry is refetched and written to the same file, many times over
+        for _ in range(50):
+            cache.put(urls[0], {}, resp)
+        kept = [url for url in urls if cache.get(url) is not None]
+        if kept != urls:
+            print(f"   FAIL - {len(urls) - len(kept)} of {len(urls)} entries were evicted")
+            return False
+        if cache._total != cache._disk_usage():
+            print(f"   FAIL - counted {cache._total} bytes, {cache._disk_usage()} on disk")
+            return False
+        print(f"   OK - {len(urls)} entries kept after 50 rewrites")
+        return True
+    except Exception as e:
+        print(f"   FAIL - {e}")
+        return False
+
+
+def main():
+    print("=" * 50)
+    print("Offline tests (upstream_stub.py)")
+    print("=" * 50)
+
+    results = []
+
+    try:
+        # Test 1: NADAC index vs batched queries
+        results.append(test_nadac_paths())
+
+        # Test 2: Streamed JSON output
+        results.append(test_record_writer())
+
+        # Test 3: Incremental SPL parsing
+        results.append(test_parse_products())
+
+        # Test 4: Label store queries
+        results.append(test_store_query())
+
+        # Test 5: Multi-pattern search
+        results.append(test_pattern_set())
+
+        # Test 6: drug run vs a shell pipeline
+        results.append(test_run_pipeline())
+
+        # Test 7: Metrics text
+        results.append(test_metrics_text())
+
+        # Test 8: Per-stage record counts
+        results.append(test_stage_records())
+
+        # Test 9: Cache size accounting
+        results.append(test_cache_rewrites())
+    finally:
+        if _stub:
+            _stub["server"].shutdown()
+            shutil.rmtree(_stub["workdir"], ignore_errors=True)
+
+    # Summary
+    passed = sum(results)
+    total = len(results)
+
+    print("\n" + "=" * 50)
+    if passed == total:
+        print(f"All {total} tests passed!")
+        return 0
+    else:
+        print(f"FAILED: {passed}/{total} tests passed")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
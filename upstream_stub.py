@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the DailyMed and NADAC APIs, used by bench.py and
+test_offline.py.
+
+    python upstream_stub.py [--labels N] [--seed N] [--latency MS] [--jitter MS]
+                            [--error-rate P] [--host HOST] [--port PORT]
+
+Serves a generated corpus of N labels and prints its base URL as the first
+line of stdout. The endpoints are the ones the tools call:
+
+    GET /dailymed/services/v2/spls.json                 search listing (drug_name, page, pagesize)
+    GET /dailymed/services/v2/spls/{setid}.xml          the SPL document
+    GET /dailymed/services/v2/spls/{setid}/ndcs.json    the label's package NDCs
+    GET /dailymed/services/v2/spls/{setid}/packaging.json
+    GET /dailymed/services/v2/ndcs.json                 NDCs by setid
+    GET /api/1/datastore/query/{dataset}/0              NADAC rows (conditions, sorts, limit, offset)
+    GET /stats                                          requests served so far, per endpoint
+
+The corpus is built from the seed, so every run serves the same bytes: one
+generic drug (SEARCH_TERM) sold by many labelers in several forms and
+strengths, each product with its own mix of the excipients in
+excipients.SYNONYMS, package NDCs of which about NADAC_SHARE are priced in
+NADAC, and a narrative about the size of a real label's. --latency adds a
+delay to every answer, --jitter varies it by up to that much either way,
+and --error-rate answers that share of requests with a 503.
+"""
+
+import http.server
+import json
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl, urlsplit
+
+import excipients
+import spl
+
+DAILYMED_PATH = "/dailymed/services/v2"
+NADAC_PATH = "/api/1/datastore/query/99315a95-37ac-4eee-946a-3c523b4c481e/0"
+
+# Every label is for this drug, so a search for it lists the whole corpus
+SEARCH_TERM = "fluoxetine"
+
+# (formCode displayName, routeCode displayName)
+FORMS = [("CAPSULE", "ORAL"), ("TABLET", "ORAL"), ("TABLET, FILM COATED", "ORAL"),
+         ("SOLUTION", "ORAL")]
+STRENGTHS_MG = [10, 20, 40, 60]
+LABELER_WORDS = ["Apex", "Blue Ridge", "Cardinal", "Delta", "Everest", "Fairview", "Granite",
+                 "Harbor", "Ironwood", "Juniper", "Keystone", "Lakeside", "Meridian", "Northstar"]
+LABELER_KINDS = ["Pharmaceuticals, Inc.", "Laboratories", "Health LLC", "Pharma Ltd."]
+
+# Share of package NDCs that have a NADAC price
+NADAC_SHARE = 0.7
+
+# Narrative sections per label and paragraphs per section (about 90 KB of XML)
+SECTIONS = 12
+PARAGRAPHS = 8
+WORDS = ("patients treatment dose dosage administered daily clinical studies adverse reactions "
+         "reported placebo controlled trials hepatic renal impairment serotonin syndrome "
+         "discontinuation monitor increase decrease risk pregnancy lactation pediatric geriatric "
+         "pharmacokinetics plasma concentration half-life metabolism elimination interaction "
+         "inhibitors contraindicated warnings precautions overdosage symptoms").split()
+
+
+def _paragraphs(rng, count=200):
+    """A pool of narrative paragraphs that labels pick from."""
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(60, 110))).capitalize() + "."
+            for _ in range(count)]
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _label(rng, i, pairs, paragraphs):
+    """Generate label i: its listing entry, products and SPL XML."""
+    setid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    labeler = f"{rng.choice(LABELER_WORDS)} {rng.choice(LABELER_KINDS)}"
+    form, route = rng.choice(FORMS)
+    labeler_code = 10000 + i  # unique per label, so NDCs never collide
+
+    products = []
+    for j, mg in enumerate(sorted(rng.sample(STRENGTHS_MG, rng.randint(1, 3)))):
+        ingredients = rng.sample(pairs, rng.randint(4, 12))
+        ndcs = [f"{labeler_code:05d}-{j + 1:03d}-{k + 1:02d}" for k in range(rng.randint(1, 3))]
+        products.append({"strength": mg, "ingredients": ingredients, "ndcs": ndcs,
+                         "nadac": [ndc for ndc in ndcs if rng.random() < NADAC_SHARE]})
+
+    name = SEARCH_TERM.upper()
+    title = f"{name} ({name} HYDROCHLORIDE) {form} [{labeler.upper()}]"
+    version = rng.randint(1, 30)
+    published = f"20{rng.randint(18, 25)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+    subjects = []
+    for p in products:
+        inactive = "".join(
+            f'<ingredient classCode="IACT"><ingredientSubstance>'
+            f'<code code="{unii}" codeSystem="2.16.840.1.113883.4.9"/><name>{_escape(n)}</name>'
+            f'</ingredientSubstance></ingredient>' for n, unii in p["ingredients"])
+        packages = "".join(
+            f'<asContent><quantity><numerator value="30" unit="{form.split(",")[0].lower()}"/>'
+            f'</quantity><containerPackagedProduct><code code="{ndc}" codeSystem="2.16.840.1.113883.6.69"/>'
+            f'<formCode displayName="BOTTLE"/></containerPackagedProduct></asContent>' for ndc in p["ndcs"])
+        subjects.append(
+            f'<subject><manufacturedProduct><manufacturedProduct>'
+            f'<code code="{p["ndcs"][0].rsplit("-", 1)[0]}" codeSystem="2.16.840.1.113883.6.69"/>'
+            f'<name>{name}</name><formCode displayName="{form}"/>'
+            f'<asEntityWithGeneric><genericMedicine><name>{name}</name></genericMedicine></asEntityWithGeneric>'
+            f'<ingredient classCode="ACTIM"><quantity><numerator value="{p["strength"]}" unit="mg"/>'
+            f'<denominator value="1" unit="1"/></quantity><ingredientSubstance>'
+            f'<code code="01K63SUP8D" codeSystem="2.16.840.1.113883.4.9"/><name>{name} HYDROCHLORIDE</name>'
+            f'</ingredientSubstance></ingredient>{inactive}{packages}</manufacturedProduct>'
+            f'<consumedIn><substanceAdministration><routeCode displayName="{route}"/>'
+            f'</substanceAdministration></consumedIn></manufacturedProduct></subject>')
+
+    sections = "".join(
+        f'<component><section><code code="34067-9"/><title>SECTION {s + 1}</title><text>'
+        + "".join(f"<paragraph>{rng.choice(paragraphs)}</paragraph>" for _ in range(PARAGRAPHS))
+        + "</text></section></component>" for s in range(SECTIONS))
+    xml = (f'<?xml version="1.0" encoding="UTF-8"?>\n<document xmlns="urn:hl7-org:v3">'
+           f'<id root="{uuid.UUID(int=rng.getrandbits(128), version=4)}"/>'
+           f'<effectiveTime value="{published.replace("-", "")}"/><setId root="{setid}"/>'
+           f'<versionNumber value="{version}"/><author><assignedEntity><representedOrganization>'
+           f'<name>{_escape(labeler)}</name></representedOrganization></assignedEntity></author>'
+           f'<component><structuredBody>{sections}<component><section><code code="48780-1"/>'
+           f'{"".join(subjects)}</section></component></structuredBody></component></document>')
+
+    return {
+        "listing": {"setid": setid, "spl_version": version, "title": title, "published_date": published},
+        "labeler": labeler,
+        "products": products,
+        "xml": xml.encode("utf-8"),
+    }
+
+
+class Corpus:
+    """A generated set of labels and the NADAC rows for their packages."""
+
+    def __init__(self, labels: int, seed: int = 0):
+        rng = random.Random(seed)
+        pairs = [(names[0].upper(), unii) for unii, names in excipients.SYNONYMS.items()]
+        paragraphs = _paragraphs(rng)
+        self.labels = [_label(rng, i, pairs, paragraphs) for i in range(labels)]
+        self.by_setid = {label["listing"]["setid"]: label for label in self.labels}
+        self.nadac = [
+            {"ndc": spl.normalize_ndc(ndc),
+             "ndc_description": f"{SEARCH_TERM.upper()} HCL {p['strength']} MG",
+             "nadac_per_unit": f"{rng.uniform(0.01, 2):.5f}", "pricing_unit": "EA",
+             "effective_date": "2026-09-16"}
+            for label in self.labels for p in label["products"] for ndc in p["nadac"]]
+
+    def search(self, query: dict):
+        name = query.get("drug_name", "").lower()
+        items = [label["listing"] for label in self.labels
+                 if name in label["listing"]["title"].lower()]
+        size = int(query.get("pagesize", 100))
+        page = int(query.get("page", 1))
+        return {"data": items[(page - 1) * size:page * size],
+                "metadata": {"total_elements": len(items), "total_pages": max(1, -(-len(items) // size)),
+                             "current_page": page, "elements_per_page": size}}
+
+    def ndcs(self, setid: str):
+        label = self.by_setid.get(setid, {"products": []})
+        return {"data": {"setid": setid, "ndcs": [{"ndc": ndc} for p in label["products"] for ndc in p["ndcs"]]}}
+
+    def packaging(self, setid: str):
+        label = self.by_setid[setid]
+        name = SEARCH_TERM.upper()
+        return {"data": {"setid": setid, "products": [
+            {"product_name": name, "active_ingredients": [{"name": f"{name} HYDROCHLORIDE",
+                                                           "strength": f"{p['strength']} mg/1"}],
+             "packaging": [{"ndc": ndc} for ndc in p["ndcs"]]} for p in label["products"]]}}
+
+    def nadac_query(self, query: dict):
+        """Answer a datastore query: conditions[k] with in, =, >= or LIKE, sorts[k], limit and offset."""
+        conditions = {}
+        for key, value in query.items():
+            m = re.match(r"conditions\[(\d+)\]\[(property|operator|value)\](?:\[\d+\])?$", key)
+            if m:
+                cond = conditions.setdefault(m.group(1), {"values": []})
+                if m.group(2) == "value":
+                    cond["values"].append(value)
+                else:
+                    cond[m.group(2)] = value
+
+        def matches(row):
+            for cond in conditions.values():
+                field = str(row.get(cond.get("property"), ""))
+                op = cond.get("operator", "=").lower()
+                if op == "in" and field not in cond["values"]:
+                    return False
+                if op == "=" and field != cond["values"][0]:
+                    return False
+                if op == ">=" and field < cond["values"][0]:
+                    return False
+                if op == "like" and not re.fullmatch(re.escape(cond["values"][0]).replace("%", ".*"),
+                                                     field, re.IGNORECASE):
+                    return False
+            return True
+
+        rows = [row for row in self.nadac if matches(row)]
+        sorts = {}
+        for key, value in query.items():
+            m = re.match(r"sorts\[(\d+)\]\[(property|order)\]$", key)
+            if m:
+                sorts.setdefault(int(m.group(1)), {})[m.group(2)] = value
+        for sort in reversed([sorts[i] for i in sorted(sorts)]):  # last key first; sort() is stable
+            rows.sort(key=lambda row: str(row.get(sort.get("property"), "")),
+                      reverse=sort.get("order", "asc").lower() == "desc")
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 500))
+        fields = [v for k, v in query.items() if k.startswith("properties[")]
+        page = rows[offset:offset + limit]
+        if fields:
+            page = [{f: row.get(f) for f in fields} for row in page]
+        return {"results": page, "count": len(rows)}
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real servers
+    # Headers and body go out in separate writes; without this the second
+    # waits on the client's delayed ACK and every answer takes 40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code: int, body, content_type: str = "application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        path = url.path
+
+        if path == "/stats":
+            with server.lock:
+                return self._reply(200, dict(server.stats))
+
+        corpus = server.corpus
+        endpoint = None
+        if path == NADAC_PATH:
+            endpoint, answer = "nadac", lambda: corpus.nadac_query(query)
+        elif path.startswith(DAILYMED_PATH + "/"):
+            rest = path[len(DAILYMED_PATH) + 1:]
+            m = re.fullmatch(r"spls/([^/]+?)(\.xml|/ndcs\.json|/packaging\.json)", rest)
+            if rest == "spls.json":
+                endpoint, answer = "spls.json", lambda: corpus.search(query)
+            elif rest == "ndcs.json":
+                endpoint, answer = "ndcs.json", lambda: {"data": corpus.ndcs(query.get("setid", ""))["data"]["ndcs"]}
+            elif m and m.group(1) in corpus.by_setid:
+                setid = m.group(1)
+                endpoint, answer = {
+                    ".xml": ("spl.xml", lambda: corpus.by_setid[setid]["xml"]),
+                    "/ndcs.json": ("spl.ndcs.json", lambda: corpus.ndcs(setid)),
+                    "/packaging.json": ("spl.packaging.json", lambda: corpus.packaging(setid)),
+                }[m.group(2)]
+        if endpoint is None:
+            return self._reply(404, {"error": f"no such endpoint: GET {path}"})
+
+        with server.lock:
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+            failed = server.rng.random() < server.error_rate
+            server.stats["requests"] += 1
+            server.stats[endpoint] = server.stats.get(endpoint, 0) + 1
+            if failed:
+                server.stats["errors"] += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self._reply(503, {"error": "injected failure"})
+        body = answer()
+        if isinstance(body, bytes):
+            return self._reply(200, body, "text/xml")
+        self._reply(200, body)
+
+
+def make_server(corpus: Corpus, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+    """Return an HTTP server for corpus; latency and jitter are in seconds."""
+    server = _Server((host, port), _Handler)
+    server.corpus = corpus
+    server.latency, server.jitter, server.error_rate = latency, jitter, error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "errors": 0}
+    return server
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a generated DailyMed/NADAC corpus locally.")
+    parser.add_argument("--labels", type=int, default=100, help="Labels in the corpus (default: 100)")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus and fault seed (default: 0)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay per answer in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Vary the delay by up to this many ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=0, help="Port (default: any free one)")
+    opts = parser.parse_args()
+
+    server = make_server(Corpus(opts.labels, opts.seed), opts.host, opts.port, opts.latency / 1000,
+                         opts.jitter / 1000, opts.error_rate, opts.seed)
+    host, port = server.server_address[:2]
+    print(f"http://{host}:{port}", flush=True)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()